@@ -0,0 +1,3 @@
+# Dash appends the version of a package to the urls of the
+# scripts it serves from it (see dash_deep/static)
+__version__ = '0.1.0'
@@ -0,0 +1,112 @@
+import numpy as np
+
+
+def merge_duplicate_steps(steps, values):
+    """Averages the values that share a step.
+
+    Traces loaded from the rollups have the minimum and the maximum of
+    each bucket at the same step (see rollups.load_trace_at_resolution()),
+    they are replaced by their average so that the steps are increasing.
+
+    Parameters
+    ----------
+    steps : numpy.ndarray
+        Sorted steps of the trace.
+
+    values : numpy.ndarray
+        Respective values.
+
+    Returns
+    -------
+    unique_steps, mean_values : numpy.ndarray
+        Increasing steps and the average value at each of them.
+    """
+
+    unique_steps, inverse_indices, counts = np.unique(steps, return_inverse=True, return_counts=True)
+
+    if len(unique_steps) == len(steps):
+
+        return steps, values
+
+    mean_values = np.bincount(inverse_indices, weights=values) / counts
+
+    return unique_steps, mean_values
+
+
+def align_traces(traces, number_of_points):
+    """Resamples traces of multiple experiments onto common steps.
+
+    The common steps are the union of the steps of all the traces, evenly
+    thinned to number_of_points. Values of each trace are linearly
+    interpolated at the common steps inside of its own range and are NaN
+    outside of it, so shorter runs don't drag the statistics of the longer ones.
+
+    Parameters
+    ----------
+    traces : list
+        List of (steps, values) pairs of numpy arrays with sorted steps.
+
+    number_of_points : int
+        Maximum number of common steps.
+
+    Returns
+    -------
+    common_steps : numpy.ndarray
+        Common steps.
+
+    aligned_values : numpy.ndarray
+        Matrix of shape (number of traces, number of common steps).
+    """
+
+    merged_traces = [merge_duplicate_steps(np.asarray(steps), np.asarray(values, dtype=np.float64))
+                     for steps, values in traces if len(steps) > 0]
+
+    if not merged_traces:
+
+        return np.array([], dtype=np.int64), np.zeros((0, 0))
+
+    common_steps = np.unique(np.concatenate([steps for steps, values in merged_traces]))
+
+    if len(common_steps) > number_of_points:
+
+        common_steps = common_steps[np.unique(np.linspace(0, len(common_steps) - 1, number_of_points).astype(np.int64))]
+
+    aligned_values = np.vstack([np.interp(common_steps, steps, values, left=np.nan, right=np.nan)
+                                for steps, values in merged_traces])
+
+    return common_steps, aligned_values
+
+
+def aggregate_traces(traces, number_of_points):
+    """Computes per-step statistics of the same trace of multiple experiments.
+
+    Parameters
+    ----------
+    traces : list
+        List of (steps, values) pairs, see align_traces().
+
+    number_of_points : int
+        Maximum number of steps of the statistics.
+
+    Returns
+    -------
+    statistics : dict
+        'steps' and the 'mean', 'std', 'min', 'max' and 'count' of the values
+        of the experiments that reached each of the steps. None if none of
+        the traces has values.
+    """
+
+    common_steps, aligned_values = align_traces(traces, number_of_points)
+
+    if len(common_steps) == 0:
+
+        return None
+
+    # Every common step is a step of at least one trace, so
+    # each column has at least one value that is not NaN
+    return {'steps': common_steps,
+            'mean': np.nanmean(aligned_values, axis=0),
+            'std': np.nanstd(aligned_values, axis=0),
+            'min': np.nanmin(aligned_values, axis=0),
+            'max': np.nanmax(aligned_values, axis=0),
+            'count': np.sum(~np.isnan(aligned_values), axis=0)}
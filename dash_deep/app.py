@@ -23,14 +23,89 @@ server = Flask(__name__)
 # Creating database connection and initializing the database in case
 # it's the first time the app is run
 
-database_file_location = "~/.dash-deep/experiments.db"
+# The database can be moved with the DASH_DEEP_DATABASE environment
+# variable, for example, to run the benchmark command on a scratch database
+database_file_location = os.environ.get('DASH_DEEP_DATABASE', "~/.dash-deep/experiments.db")
 models_save_folder_path = "~/.dash-deep/models"
+archive_folder_path = "~/.dash-deep/archive"
 
 database_file_location = os.path.expanduser( database_file_location )
 models_save_folder_path = os.path.expanduser( models_save_folder_path )
+archive_folder_path = os.path.expanduser( archive_folder_path )
 
 database_path = os.path.dirname(database_file_location)
 
+# Maximum number of points of each trace that is sent to the browser
+# by the plots page. Longer traces are downsampled with the specified
+# method -- 'lttb' or 'min_max' (see dash_deep/downsampling.py).
+plot_points_per_trace = 2000
+plot_downsampling_method = 'lttb'
+
+# Encoding of the x/y arrays of the plotted traces -- 'json' sends them as
+# lists of numbers, 'base64' packs them into base64 encoded int32/float32
+# arrays which are decoded in the browser by dash_deep/static/trace_encoding.js.
+# The packed arrays are several times smaller and faster to serialize, but
+# the values are rounded to float32.
+plot_trace_encoding = 'json'
+
+# Smoothed copies of every reported trace are computed incrementally when
+# the values are reported and are stored next to the raw values as traces
+# named like '<trace>:ema0.9' and '<trace>:mean20' (see dash_deep/smoothing.py).
+# They can be selected on the plots page. Set a parameter to None to
+# stop writing the respective copy. Copies with other parameters are not
+# plotted, the migrate_metrics command recomputes them after a change.
+trace_smoothing_ema_weight = 0.9
+trace_smoothing_window_size = 20
+
+# Checkpoints saved with Experiment.save_checkpoint() are written from a
+# background thread (see dash_deep/checkpoints.py). The checkpoints_keep_top_k
+# best scored checkpoints of each experiment and its latest one are kept, the
+# training waits if checkpoints_max_pending checkpoints are not written yet.
+checkpoints_keep_top_k = 3
+checkpoints_max_pending = 2
+
+# Checkpoints are stored in '<models folder>/store' by the hashes of their
+# contents (see dash_deep/model_store.py). With model_store_chunk_tensors
+# each tensor is a separate object, so the tensors shared by checkpoints
+# are stored once. Objects that no experiment references are removed by
+# the gc command once they weren't used for model_store_gc_grace_seconds.
+model_store_chunk_tensors = True
+model_store_gc_grace_seconds = 600
+
+# Archive of finished experiments (see dash_deep/archive.py). Reported
+# values of experiments that were created and last reported more than
+# archive_experiments_older_than_days days ago are moved into compressed
+# files in archive_folder_path, the database keeps only the rollup that the
+# plots page displays when the traces are not zoomed. The server checks for
+# such experiments every archive_policy_interval_hours hours, None disables
+# the automatic archiving (the archive command still works). Values of
+# archive_cache_size archived experiments are kept in memory once loaded.
+archive_experiments_older_than_days = 90
+archive_policy_interval_hours = 24
+archive_cache_size = 16
+
+# Number of experiments displayed on one page of the experiment tables
+experiments_table_page_size = 50
+
+# Number of experiments whose legend-tagged traces are kept in
+# memory for assembling the comparison plots (see dash_deep/plot.py)
+figure_fragment_cache_size = 256
+
+# Number of pages of the experiment tables kept in memory (see dash_deep/table_cache.py)
+experiments_table_cache_size = 256
+
+# Number of experiments whose plotted traces are kept in memory
+# between the live updates of the plots page (see dash_deep/live.py)
+live_plot_cache_size = 64
+
+# Live metrics stream (see dash_deep/stream.py). New metric points and
+# task states are read by a single thread every stream_poll_interval_ms
+# and pushed to all the open pages. Pages that fall more than
+# stream_subscriber_queue_size events behind are disconnected and reconnect.
+stream_poll_interval_ms = 500
+stream_keepalive_interval_s = 15
+stream_subscriber_queue_size = 1000
+
 if not os.path.exists(database_path):
     
     os.makedirs(database_path)
@@ -61,26 +136,101 @@ auth = dash_auth.BasicAuth(
                            VALID_USERNAME_PASSWORD_PAIRS
 )
 
+# Scheduling of the tasks started from the pages (see dash_deep/task.py).
+# A task starts on the gpu with the most free memory that runs less than
+# scheduler_jobs_per_device tasks and has at least scheduler_min_free_memory_mb
+# megabytes of free memory, otherwise it waits in the queue. Tasks with a
+# non-negative gpu_id wait for that gpu. Machines without gpus run
+# scheduler_cpu_jobs tasks at once. The queue is checked every
+# scheduler_poll_interval_s seconds and whenever a task finishes.
+scheduler_jobs_per_device = 1
+scheduler_min_free_memory_mb = 1000
+scheduler_cpu_jobs = 1
+scheduler_poll_interval_s = 5
+
+# Among the tasks of the same priority the queue is ordered by fair share:
+# the task whose user and model class used the gpus the least recently goes
+# first. Usage is the device time of the finished tasks, halved every
+# scheduler_fair_share_half_life_s seconds, and the time of the running
+# tasks, which are charged at least scheduler_fair_share_min_charge_s. Usage
+# is divided by the weight of the user (basic auth name) or the model class
+# (table name), 1 by default. Running tasks are never preempted.
+scheduler_user_weights = {}
+scheduler_model_weights = {}
+scheduler_fair_share_half_life_s = 3600
+scheduler_fair_share_min_charge_s = 60
+
+# Inference of the experiments runs in inference_pool_workers long-lived
+# processes, separate from the training tasks (see dash_deep/inference.py).
+# Each of them keeps up to inference_cache_max_models loaded models that
+# take up to inference_cache_max_memory_mb megabytes. Inputs are sent to
+# the workers in batches of up to inference_batch_size, the batches of
+# different experiments run concurrently.
+inference_pool_workers = 2
+inference_cache_max_models = 4
+inference_cache_max_memory_mb = 2048
+inference_batch_size = 8
+
+# Inference endpoint at /inference/<table>/<experiment id> (see
+# dash_deep/serving.py). Concurrent requests to the same experiment wait up
+# to inference_server_max_wait_ms for each other and are run as one batch
+# of up to inference_server_max_batch_size images -- longer waits and larger
+# batches give more throughput under load and more latency to lone requests.
+# Requests over inference_server_max_queue_size waiting ones are rejected.
+# The batching thread of an experiment that received no requests for
+# inference_server_idle_timeout_s seconds is stopped.
+inference_server_max_batch_size = 8
+inference_server_max_wait_ms = 20
+inference_server_max_queue_size = 256
+inference_server_timeout_s = 60
+inference_server_idle_timeout_s = 600
+
 from dash_deep.task import TaskManager
 
 task_manager = TaskManager()
 
+from dash_deep.inference import InferencePool
+
+inference_pool = InferencePool()
+
 # In order for all our database models representing the scripts
 # to be available in db object, we need to import dash_deep.models
 
 import dash_deep.models
+
+# Table that stores the reported values of all experiments
+# and the table of their aggregates used for plotting
+import dash_deep.metrics
+import dash_deep.rollups
+
+from dash_deep.mixins import BasicExperimentMixin
     
 # Now gettting all the classes representing database models of each script
 # https://stackoverflow.com/questions/26514823/get-all-models-from-flask-sqlalchemy-db/26518401
+# Only models that describe experiments are taken, since we also
+# have service tables like the metric points one.
 
 scripts_db_models = [cls for cls in db.Model._decl_class_registry.values()
-                     if isinstance(cls, type) and issubclass(cls, db.Model)]
+                     if isinstance(cls, type) and issubclass(cls, db.Model)
+                     and issubclass(cls, BasicExperimentMixin)]
 
 
 # Adding default command line commands
 # They are registered automatically after we import this module
 import dash_deep.cli.default_commands
 
+# Route that pushes live metrics to the pages, registered on import
+import dash_deep.stream
+
+# Route of the batched inference of the experiments, registered on import
+import dash_deep.serving
+
+# Automatic archiving of old experiments, started with the server
+import dash_deep.archive
+
+# Route with the statistics of the cache of the experiment tables, registered on import
+import dash_deep.table_cache
+
 # Initializing the Dash application
 
 
@@ -97,4 +247,16 @@ app.scripts.config.serve_locally = True
 
 app.css.append_css({
     'external_url': 'https://codepen.io/chriddyp/pen/bWLwgP.css'
+})
+
+# Client side of the live metrics stream, served from the package
+app.scripts.append_script({
+    'relative_package_path': 'static/live_stream.js',
+    'namespace': 'dash_deep'
+})
+
+# Decodes the packed trace arrays, see plot_trace_encoding
+app.scripts.append_script({
+    'relative_package_path': 'static/trace_encoding.js',
+    'namespace': 'dash_deep'
 })
\ No newline at end of file
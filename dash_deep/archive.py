@@ -0,0 +1,636 @@
+from dash_deep.app import (server,
+                           db,
+                           archive_folder_path,
+                           archive_experiments_older_than_days,
+                           archive_policy_interval_hours,
+                           archive_cache_size,
+                           plot_points_per_trace)
+from dash_deep.metrics import MetricPoint, insert_metric_points
+from dash_deep.rollups import (MetricRollup,
+                               compute_trace_rollups,
+                               get_rollup_level,
+                               metric_rollups_insert_statement)
+
+import calendar
+import datetime
+import os
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Names of the arrays of a trace inside of an archive file
+# are '<trace name><separator><column>'
+ARCHIVE_ARRAY_SEPARATOR = '/'
+
+archive_columns = ['steps', 'wall_times', 'values']
+
+# Number of metric points inserted at once when an experiment is restored
+RESTORE_INSERT_CHUNK_SIZE = 100000
+
+
+def get_experiment_archive_path(experiment_table, experiment_id):
+    """Returns the path of the archive file of an experiment."""
+
+    return os.path.join(archive_folder_path, experiment_table, '{}.npz'.format(experiment_id))
+
+
+def load_experiment_points(sql_model_instance):
+    """Loads all the metric points of an experiment, including the smoothed traces.
+
+    Returns
+    -------
+    traces : OrderedDict
+        Maps trace name into (steps, wall_times, values) tuple of numpy arrays.
+    """
+
+    query = db.session.query(MetricPoint.trace_name).filter(MetricPoint.experiment_table == sql_model_instance.__tablename__,
+                                                            MetricPoint.experiment_id == sql_model_instance.id)
+
+    trace_names = sorted(trace_name for trace_name, in query.distinct())
+
+    traces = OrderedDict()
+
+    for trace_name in trace_names:
+
+        query = db.session.query(MetricPoint.step, MetricPoint.wall_time, MetricPoint.value)
+
+        query = query.filter(MetricPoint.experiment_table == sql_model_instance.__tablename__,
+                             MetricPoint.experiment_id == sql_model_instance.id,
+                             MetricPoint.trace_name == trace_name)
+
+        points = query.order_by(MetricPoint.step).all()
+
+        traces[trace_name] = (np.array([step for step, wall_time, value in points], dtype=np.int64),
+                              np.array([wall_time for step, wall_time, value in points], dtype=np.float64),
+                              np.array([value for step, wall_time, value in points], dtype=np.float64))
+
+    return traces
+
+
+def write_experiment_archive(archive_path, traces):
+    """Writes the traces of an experiment into a compressed npz file.
+
+    The file is written next to its final path first and renamed after
+    that, so an interrupted write never leaves a truncated archive.
+    """
+
+    archive_directory = os.path.dirname(archive_path)
+
+    if not os.path.exists(archive_directory):
+
+        os.makedirs(archive_directory)
+
+    arrays = {}
+
+    for trace_name, trace_columns in traces.items():
+
+        for column, array in zip(archive_columns, trace_columns):
+
+            arrays[trace_name + ARCHIVE_ARRAY_SEPARATOR + column] = array
+
+    temporary_path = archive_path + '.tmp'
+
+    with open(temporary_path, 'wb') as archive_file:
+
+        np.savez_compressed(archive_file, **arrays)
+
+    if os.path.exists(archive_path):
+
+        # Left by an archiving that was interrupted before the database
+        # was updated, rename() can't replace files on windows
+        os.remove(archive_path)
+
+    os.rename(temporary_path, archive_path)
+
+
+def read_experiment_archive(archive_path):
+    """Reads the traces of an experiment written by write_experiment_archive().
+
+    Returns
+    -------
+    traces : OrderedDict
+        Maps trace name into (steps, wall_times, values) tuple of numpy arrays.
+    """
+
+    arrays = {}
+
+    with np.load(archive_path) as archive:
+
+        for array_name in archive.files:
+
+            trace_name, column = array_name.rsplit(ARCHIVE_ARRAY_SEPARATOR, 1)
+
+            arrays.setdefault(trace_name, {})[column] = archive[array_name]
+
+    return OrderedDict((trace_name, tuple(arrays[trace_name][column] for column in archive_columns))
+                       for trace_name in sorted(arrays))
+
+
+class ExperimentArchiveCache(object):
+    """Keeps the traces of recently displayed archived experiments in memory.
+
+    Zooming into a trace of an archived experiment needs the points that
+    are not stored in the database anymore, they are read from the archive
+    file once and are kept until the experiment is evicted in least recently
+    used order or is archived again.
+
+    """
+
+    def __init__(self, maximum_size=archive_cache_size):
+
+        self.maximum_size = maximum_size
+
+        self.entries = OrderedDict()
+
+        self.lock = threading.Lock()
+
+
+    def get_traces(self, sql_model_instance):
+        """Returns the archived traces of an experiment.
+
+        Returns
+        -------
+        traces : OrderedDict or None
+            See read_experiment_archive(). None if the archive file
+            doesn't exist.
+        """
+
+        key = (sql_model_instance.__tablename__, sql_model_instance.id)
+
+        with self.lock:
+
+            entry = self.entries.get(key)
+
+            if entry is not None and entry['archived_at'] == sql_model_instance.archived_at:
+
+                self.entries.pop(key)
+                self.entries[key] = entry
+
+                return entry['traces']
+
+        archive_path = get_experiment_archive_path(*key)
+
+        if not os.path.exists(archive_path):
+
+            return None
+
+        # Read outside of the lock, so that reading a large archive
+        # doesn't block the plots of other experiments
+        traces = read_experiment_archive(archive_path)
+
+        with self.lock:
+
+            self.entries.pop(key, None)
+            self.entries[key] = {'archived_at': sql_model_instance.archived_at,
+                                 'traces': traces}
+
+            while len(self.entries) > self.maximum_size:
+
+                self.entries.popitem(last=False)
+
+        return traces
+
+
+    def invalidate(self, experiment_table, experiment_id):
+
+        with self.lock:
+
+            self.entries.pop((experiment_table, experiment_id), None)
+
+
+experiment_archive_cache = ExperimentArchiveCache()
+
+
+def load_archived_trace_at_level(sql_model_instance, trace_name, level, first_step, last_step):
+    """Loads a trace of an archived experiment at the specified rollup level.
+
+    The result is the same as the one of rollups.load_trace_at_resolution()
+    for an experiment that is not archived: the complete buckets of the level
+    are displayed as their minimum and maximum, the points after the last
+    complete bucket are displayed as they are.
+
+    Parameters
+    ----------
+    sql_model_instance : sqlalchemy model instance
+        Archived experiment.
+
+    trace_name : string
+        Name of the trace.
+
+    level : int
+        Rollup level, 0 loads the raw points.
+
+    first_step, last_step : int
+        Inclusive window of steps.
+
+    Returns
+    -------
+    steps, values : numpy.ndarray
+        Steps and values of the trace. None if the archive
+        file of the experiment doesn't exist.
+    """
+
+    traces = experiment_archive_cache.get_traces(sql_model_instance)
+
+    if traces is None:
+
+        return None
+
+    if trace_name not in traces:
+
+        return np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+
+    steps, wall_times, values = traces[trace_name]
+
+    if level == 0:
+
+        window = slice(np.searchsorted(steps, first_step, side='left'),
+                       np.searchsorted(steps, last_step, side='right'))
+
+        return steps[window], values[window]
+
+    # The bucket of the last point is still open
+    open_bucket = int(steps[-1]) >> level
+
+    # Rollups of the buckets which overlap with the window are displayed whole
+    first_bucket = first_step >> level
+    last_bucket = min(last_step >> level, open_bucket - 1)
+
+    rollup_window = slice(np.searchsorted(steps, first_bucket << level, side='left'),
+                          np.searchsorted(steps, ((last_bucket + 1) << level) - 1, side='right'))
+
+    rollup_steps = steps[rollup_window]
+    rollup_values = values[rollup_window]
+
+    bucket_width = 1 << level
+
+    if len(rollup_steps):
+
+        buckets, bucket_starts = np.unique(rollup_steps >> level, return_index=True)
+
+        minimums = np.minimum.reduceat(rollup_values, bucket_starts)
+        maximums = np.maximum.reduceat(rollup_values, bucket_starts)
+
+        rollup_steps = np.repeat(buckets * bucket_width + bucket_width // 2, 2)
+        rollup_values = np.column_stack((minimums, maximums)).reshape(-1)
+
+    tail_first_step = max(first_step, (last_bucket + 1) << level)
+
+    tail_window = slice(np.searchsorted(steps, tail_first_step, side='left'),
+                        np.searchsorted(steps, last_step, side='right'))
+
+    return (np.concatenate((rollup_steps.astype(np.int64), steps[tail_window])),
+            np.concatenate((rollup_values.astype(np.float64), values[tail_window])))
+
+
+def archive_experiment(sql_model_instance, number_of_points=plot_points_per_trace):
+    """Moves the reported values of an experiment into its archive file.
+
+    All the metric points of the experiment are written into a compressed
+    file. For each trace the database keeps only the rollups of the level
+    that displays the whole trace with number_of_points points and the points
+    after the last complete bucket of this level, so the plots page displays
+    archived experiments without reading the archive file until a trace is
+    zoomed. The columns of the experiment are not changed.
+
+    Parameters
+    ----------
+    sql_model_instance : sqlalchemy model instance
+        Experiment to archive.
+
+    number_of_points : int
+        Number of points of each trace that stay in the database.
+
+    Returns
+    -------
+    summary : dict
+        Path of the archive file, numbers of archived points and of points
+        left in the database. None if the experiment has no metric points
+        or is already archived.
+    """
+
+    if sql_model_instance.archived_at is not None:
+
+        return None
+
+    if sql_model_instance.graphs is not None and sql_model_instance.graphs.has_values():
+
+        raise ValueError('Experiment {} of {} keeps its values in the graphs column, '
+                         'run the migrate_metrics command first'.format(sql_model_instance.id,
+                                                                        sql_model_instance.__tablename__))
+
+    traces = load_experiment_points(sql_model_instance)
+
+    if not traces:
+
+        return None
+
+    archive_path = get_experiment_archive_path(sql_model_instance.__tablename__, sql_model_instance.id)
+
+    write_experiment_archive(archive_path, traces)
+
+    number_of_archived_points = sum(len(steps) for steps, wall_times, values in traces.values())
+    number_of_kept_points = 0
+
+    for trace_name, (steps, wall_times, values) in traces.items():
+
+        last_step = int(steps[-1])
+
+        level = get_rollup_level(last_step + 1, number_of_points)
+
+        MetricRollup.query.filter(MetricRollup.experiment_table == sql_model_instance.__tablename__,
+                                  MetricRollup.experiment_id == sql_model_instance.id,
+                                  MetricRollup.trace_name == trace_name,
+                                  MetricRollup.level != level).delete(synchronize_session=False)
+
+        if level == 0:
+
+            # Short traces stay in the database as they are
+            number_of_kept_points += len(steps)
+
+            continue
+
+        metric_rollups = [metric_rollup for metric_rollup in compute_trace_rollups(sql_model_instance.__tablename__,
+                                                                                   sql_model_instance.id,
+                                                                                   trace_name,
+                                                                                   steps,
+                                                                                   values)
+                          if metric_rollup['level'] == level]
+
+        if metric_rollups:
+
+            db.session.execute(metric_rollups_insert_statement, metric_rollups)
+
+        tail_first_step = (last_step >> level) << level
+
+        MetricPoint.query.filter(MetricPoint.experiment_table == sql_model_instance.__tablename__,
+                                 MetricPoint.experiment_id == sql_model_instance.id,
+                                 MetricPoint.trace_name == trace_name,
+                                 MetricPoint.step < tail_first_step).delete(synchronize_session=False)
+
+        number_of_kept_points += int(np.sum(steps >= tail_first_step))
+
+    sql_model_instance.archived_at = datetime.datetime.utcnow()
+    sql_model_instance.version = sql_model_instance.__class__.version + 1
+
+    db.session.add(sql_model_instance)
+    db.session.commit()
+
+    experiment_archive_cache.invalidate(sql_model_instance.__tablename__, sql_model_instance.id)
+
+    return {'path': archive_path,
+            'number_of_archived_points': number_of_archived_points,
+            'number_of_kept_points': number_of_kept_points}
+
+
+def restore_experiment(sql_model_instance):
+    """Moves the values of an archived experiment back into the database.
+
+    Used when an archived experiment is resumed. The metric points and all
+    the rollup levels are written back and the archive file is removed.
+
+    Returns
+    -------
+    number_of_restored_points : int
+        Number of metric points written back.
+    """
+
+    if sql_model_instance.archived_at is None:
+
+        return 0
+
+    archive_path = get_experiment_archive_path(sql_model_instance.__tablename__, sql_model_instance.id)
+
+    if not os.path.exists(archive_path):
+
+        raise IOError('Archive file {} of experiment {} of {} is missing'.format(archive_path,
+                                                                                 sql_model_instance.id,
+                                                                                 sql_model_instance.__tablename__))
+
+    traces = read_experiment_archive(archive_path)
+
+    # The points and the rollups that stayed in the database
+    # are replaced by the complete ones from the archive
+    MetricPoint.query.filter(MetricPoint.experiment_table == sql_model_instance.__tablename__,
+                             MetricPoint.experiment_id == sql_model_instance.id).delete(synchronize_session=False)
+
+    MetricRollup.query.filter(MetricRollup.experiment_table == sql_model_instance.__tablename__,
+                              MetricRollup.experiment_id == sql_model_instance.id).delete(synchronize_session=False)
+
+    number_of_restored_points = 0
+
+    for trace_name, (steps, wall_times, values) in traces.items():
+
+        for chunk_start in range(0, len(steps), RESTORE_INSERT_CHUNK_SIZE):
+
+            chunk = slice(chunk_start, chunk_start + RESTORE_INSERT_CHUNK_SIZE)
+
+            insert_metric_points(db.session, [{'experiment_table': sql_model_instance.__tablename__,
+                                               'experiment_id': sql_model_instance.id,
+                                               'trace_name': trace_name,
+                                               'step': step,
+                                               'wall_time': wall_time,
+                                               'value': value}
+                                              for step, wall_time, value in zip(steps[chunk].tolist(),
+                                                                                wall_times[chunk].tolist(),
+                                                                                values[chunk].tolist())])
+
+        metric_rollups = compute_trace_rollups(sql_model_instance.__tablename__,
+                                               sql_model_instance.id,
+                                               trace_name,
+                                               steps,
+                                               values)
+
+        if metric_rollups:
+
+            db.session.execute(metric_rollups_insert_statement, metric_rollups)
+
+        number_of_restored_points += len(steps)
+
+    sql_model_instance.archived_at = None
+    sql_model_instance.version = sql_model_instance.__class__.version + 1
+
+    db.session.add(sql_model_instance)
+    db.session.commit()
+
+    experiment_archive_cache.invalidate(sql_model_instance.__tablename__, sql_model_instance.id)
+
+    os.remove(archive_path)
+
+    return number_of_restored_points
+
+
+def get_last_wall_time(sql_model_instance):
+    """Returns the time of the last reported value of an experiment or None."""
+
+    query = db.session.query(db.func.max(MetricPoint.wall_time))
+
+    query = query.filter(MetricPoint.experiment_table == sql_model_instance.__tablename__,
+                         MetricPoint.experiment_id == sql_model_instance.id)
+
+    return query.scalar()
+
+
+def get_experiments_to_archive(sql_model_class, older_than_days):
+    """Returns the experiments that the archiving policy applies to.
+
+    An experiment is archived once it was created and has last reported a
+    value more than older_than_days days ago. Experiments without any values
+    and experiments that keep their values in the graphs column are skipped.
+
+    Parameters
+    ----------
+    sql_model_class : sqlalchemy model class
+        Experiment type.
+
+    older_than_days : float
+        Age in days.
+
+    Returns
+    -------
+    sql_model_instances : list
+        Experiments to archive.
+    """
+
+    if not db.engine.has_table(sql_model_class.__tablename__):
+
+        return []
+
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=older_than_days)
+    cutoff_wall_time = calendar.timegm(cutoff.utctimetuple())
+
+    query = sql_model_class.query.filter(sql_model_class.archived_at.is_(None),
+                                         sql_model_class.created_at < cutoff)
+
+    sql_model_instances = []
+
+    for sql_model_instance in query.order_by(sql_model_class.id):
+
+        if sql_model_instance.graphs is not None and sql_model_instance.graphs.has_values():
+
+            continue
+
+        last_wall_time = get_last_wall_time(sql_model_instance)
+
+        if last_wall_time is not None and last_wall_time < cutoff_wall_time:
+
+            sql_model_instances.append(sql_model_instance)
+
+    return sql_model_instances
+
+
+def archive_old_experiments(sql_model_classes,
+                            older_than_days=archive_experiments_older_than_days,
+                            number_of_points=plot_points_per_trace):
+    """Archives all the experiments that the archiving policy applies to.
+
+    Parameters
+    ----------
+    sql_model_classes : list
+        Experiment types to archive.
+
+    older_than_days : float
+        See get_experiments_to_archive().
+
+    number_of_points : int
+        See archive_experiment().
+
+    Returns
+    -------
+    summaries : list
+        (sql_model_instance, summary) pairs of the archived experiments,
+        see archive_experiment().
+    """
+
+    summaries = []
+
+    for sql_model_class in sql_model_classes:
+
+        for sql_model_instance in get_experiments_to_archive(sql_model_class, older_than_days):
+
+            summary = archive_experiment(sql_model_instance, number_of_points)
+
+            if summary is not None:
+
+                summaries.append((sql_model_instance, summary))
+
+    return summaries
+
+
+class ArchivePolicy(object):
+    """Archives old experiments from a background thread of the server.
+
+    The thread is started with the first request to the server and checks
+    for experiments to archive every interval_hours hours. Commands run
+    from the command line don't start it.
+
+    """
+
+    def __init__(self,
+                 older_than_days=archive_experiments_older_than_days,
+                 interval_hours=archive_policy_interval_hours):
+
+        self.older_than_days = older_than_days
+        self.interval = interval_hours * 3600
+
+        self.sql_model_classes = []
+
+        self.thread = None
+
+
+    def start(self, sql_model_classes):
+
+        if self.older_than_days is None or self.thread is not None:
+
+            return
+
+        self.sql_model_classes = list(sql_model_classes)
+
+        self.thread = threading.Thread(target=self.run, name='dash-deep-archive-policy')
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def run(self):
+        """Main loop of the policy thread."""
+
+        while True:
+
+            try:
+
+                summaries = archive_old_experiments(self.sql_model_classes, self.older_than_days)
+
+                if summaries:
+
+                    print('Archived {} experiments'.format(len(summaries)))
+
+            except Exception:
+
+                # Archiving is retried on the next check instead of killing
+                # the thread, the experiment that failed stays in the database
+                print('Archiving of old experiments failed:\n{}'.format(traceback.format_exc()))
+
+                db.session.rollback()
+
+            finally:
+
+                db.session.remove()
+
+            time.sleep(self.interval)
+
+
+archive_policy = ArchivePolicy()
+
+
+@server.before_first_request
+def start_archive_policy():
+
+    # Imported here, since this module is imported by the experiment
+    # scripts before the models are collected in dash_deep/app.py
+    from dash_deep.app import scripts_db_models
+
+    archive_policy.start(scripts_db_models)
@@ -0,0 +1,594 @@
+from dash_deep.app import db, experiments_table_page_size
+from dash_deep.sql import (generate_table_contents_from_sql_model_class,
+                           get_table_signature,
+                           get_column_names_and_values_from_sql_model_instance)
+from dash_deep.metrics import MetricPoint, insert_metric_points
+from dash_deep.rollups import MetricRollup, compute_trace_rollups, metric_rollups_insert_statement
+from dash_deep.plot import create_mutual_plot, figure_fragment_cache
+from dash_deep.logging import Experiment
+
+import json
+import numbers
+import platform
+import random
+import threading
+import time
+import timeit
+
+import numpy as np
+import psutil
+from plotly.utils import PlotlyJSONEncoder
+
+
+# Synthetic experiments are marked with this model path, so that
+# they can be told apart from the real ones and deleted afterwards
+BENCHMARK_MODEL_PATH = 'dash-deep-benchmark'
+
+# Number of rows passed to a single executemany call
+BENCHMARK_INSERT_CHUNK_SIZE = 100000
+
+# Sections of the results that describe the run rather than measure it,
+# they are not compared against the baseline
+BENCHMARK_DESCRIPTION_SECTIONS = ['environment', 'parameters']
+
+# Trace encodings that the figures are built with, see create_mutual_plot()
+BENCHMARK_TRACE_ENCODINGS = ['json', 'base64']
+
+# Seconds between the samples of the memory of the process, see RssSampler
+BENCHMARK_RSS_SAMPLING_INTERVAL_S = 0.01
+
+
+class RssSampler(object):
+    """Measures how much the memory of the process grows during a section of the benchmark.
+
+    The peak resident set size reported by the os is the high-water mark of
+    the whole process, so every section after the largest one would report
+    its memory. The sampler reads the resident set size at the start of the
+    section and then every interval_s seconds from a background thread until
+    the section ends, the growth of the peak sample over the start is reported.
+
+    Used as a context manager:
+
+        with RssSampler() as rss_sampler:
+            ...
+
+        rss_sampler.get_peak_rss_growth_mb()
+
+    """
+
+    def __init__(self, interval_s=BENCHMARK_RSS_SAMPLING_INTERVAL_S):
+
+        self.interval_s = interval_s
+
+        self.process = psutil.Process()
+
+        self.start_rss = None
+        self.peak_rss = None
+
+        self.stop_event = threading.Event()
+
+        self.thread = threading.Thread(target=self.sample_rss, name='dash-deep-benchmark-rss-sampler')
+        self.thread.daemon = True
+
+
+    def __enter__(self):
+
+        self.start_rss = self.process.memory_info().rss
+        self.peak_rss = self.start_rss
+
+        self.thread.start()
+
+        return self
+
+
+    def __exit__(self, exception_type, exception_value, traceback):
+
+        self.stop_event.set()
+
+        self.thread.join()
+
+        self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+
+        return False
+
+
+    def sample_rss(self):
+
+        while not self.stop_event.wait(self.interval_s):
+
+            self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+
+
+    def get_peak_rss_growth_mb(self):
+
+        return (self.peak_rss - self.start_rss) / 1024.0 / 1024.0
+
+
+def summarize_latencies(latencies):
+    """Computes the statistics of a list of latencies in seconds.
+
+    Returns
+    -------
+    summary : dict
+        Mean, percentiles and maximum in milliseconds.
+    """
+
+    latencies_ms = np.array(latencies) * 1000.0
+
+    p50, p90, p99 = np.percentile(latencies_ms, [50, 90, 99]).tolist()
+
+    return {'mean_ms': float(latencies_ms.mean()),
+            'p50_ms': p50,
+            'p90_ms': p90,
+            'p99_ms': p99,
+            'max_ms': float(latencies_ms.max())}
+
+
+def measure_median_time(function, number_of_repeats):
+    """Calls the function number_of_repeats times.
+
+    Returns
+    -------
+    median_time_ms : float
+        Median time of a call in milliseconds.
+
+    result : object
+        Return value of the last call.
+    """
+
+    times = []
+    result = None
+
+    for repeat in range(number_of_repeats):
+
+        start_time = timeit.default_timer()
+        result = function()
+        times.append(timeit.default_timer() - start_time)
+
+    return float(np.median(times) * 1000.0), result
+
+
+def create_synthetic_experiments(sql_model_class, number_of_experiments):
+    """Inserts synthetic experiments with a single executemany call.
+
+    The default values of the model are taken as a template, the
+    hyperparameters and the results are filled with random values, so
+    that sorting and filtering have something to work on.
+
+    Returns
+    -------
+    experiment_ids : list
+        Ids of the inserted experiments.
+    """
+
+    template = get_column_names_and_values_from_sql_model_instance(sql_model_class())
+
+    del template['id']
+
+    template['model_path'] = BENCHMARK_MODEL_PATH
+
+    experiments = []
+
+    for experiment_index in range(number_of_experiments):
+
+        experiment = dict(template)
+
+        experiment['batch_size'] = random.choice([100, 50, 10, 5, 1])
+        experiment['learning_rate'] = random.choice([1.0, 0.1, 0.01, 0.001])
+        experiment['training_loss'] = random.random()
+        experiment['training_accuracy'] = random.random()
+        experiment['validation_accuracy'] = random.random()
+
+        experiments.append(experiment)
+
+    last_id = db.session.query(db.func.max(sql_model_class.id)).scalar() or 0
+
+    for chunk_start in range(0, len(experiments), BENCHMARK_INSERT_CHUNK_SIZE):
+
+        db.session.execute(sql_model_class.__table__.insert(),
+                           experiments[chunk_start:chunk_start + BENCHMARK_INSERT_CHUNK_SIZE])
+
+    db.session.commit()
+
+    query = db.session.query(sql_model_class.id).filter(sql_model_class.id > last_id,
+                                                        sql_model_class.model_path == BENCHMARK_MODEL_PATH)
+
+    return [experiment_id for experiment_id, in query.order_by(sql_model_class.id)]
+
+
+def insert_synthetic_metric_points(sql_model_instance, number_of_points):
+    """Fills every trace of an experiment with a random walk of number_of_points points.
+
+    Points and their rollups are written with bulk inserts, which gives the
+    same tables as if the points were reported by Experiment one by one.
+    """
+
+    experiment_table = sql_model_instance.__tablename__
+
+    for trace_name in sql_model_instance.graphs.graph_column_names:
+
+        steps = np.arange(number_of_points, dtype=np.int64)
+        values = np.cumsum(np.random.randn(number_of_points)) / np.sqrt(number_of_points)
+
+        for chunk_start in range(0, number_of_points, BENCHMARK_INSERT_CHUNK_SIZE):
+
+            chunk_steps = steps[chunk_start:chunk_start + BENCHMARK_INSERT_CHUNK_SIZE].tolist()
+            chunk_values = values[chunk_start:chunk_start + BENCHMARK_INSERT_CHUNK_SIZE].tolist()
+
+            insert_metric_points(db.session, [{'experiment_table': experiment_table,
+                                               'experiment_id': sql_model_instance.id,
+                                               'trace_name': trace_name,
+                                               'step': step,
+                                               'wall_time': 0.0,
+                                               'value': value}
+                                              for step, value in zip(chunk_steps, chunk_values)])
+
+        metric_rollups = compute_trace_rollups(experiment_table,
+                                               sql_model_instance.id,
+                                               trace_name,
+                                               steps,
+                                               values)
+
+        for chunk_start in range(0, len(metric_rollups), BENCHMARK_INSERT_CHUNK_SIZE):
+
+            db.session.execute(metric_rollups_insert_statement,
+                               metric_rollups[chunk_start:chunk_start + BENCHMARK_INSERT_CHUNK_SIZE])
+
+    db.session.commit()
+
+
+def delete_synthetic_experiments(sql_model_class):
+    """Deletes the synthetic experiments with their metric points and rollups."""
+
+    query = db.session.query(sql_model_class.id).filter(sql_model_class.model_path == BENCHMARK_MODEL_PATH)
+
+    experiment_ids = [experiment_id for experiment_id, in query]
+
+    for chunk_start in range(0, len(experiment_ids), 500):
+
+        chunk_ids = experiment_ids[chunk_start:chunk_start + 500]
+
+        for metric_table in (MetricPoint, MetricRollup):
+
+            metric_table.query.filter(metric_table.experiment_table == sql_model_class.__tablename__,
+                                      metric_table.experiment_id.in_(chunk_ids)).delete(synchronize_session=False)
+
+    sql_model_class.query.filter(sql_model_class.model_path == BENCHMARK_MODEL_PATH).delete(synchronize_session=False)
+
+    db.session.commit()
+
+
+def benchmark_append_latency(sql_model_class, number_of_appends, buffered):
+    """Measures the latency of Experiment.add_next_iteration_results().
+
+    Returns
+    -------
+    results : dict
+        Latency statistics of the calls and the time taken by finish(),
+        which waits for the buffered writes.
+    """
+
+    experiment_id, = create_synthetic_experiments(sql_model_class, 1)
+
+    sql_model_instance = sql_model_class.query.get(experiment_id)
+
+    db.session.expunge(sql_model_instance)
+
+    trace_names = sql_model_instance.graphs.graph_column_names
+
+    latencies = []
+
+    with RssSampler() as rss_sampler:
+
+        experiment = Experiment(sql_model_instance, buffered=buffered)
+
+        for iteration in range(number_of_appends):
+
+            results = dict((trace_name, random.random()) for trace_name in trace_names)
+
+            start_time = timeit.default_timer()
+            experiment.add_next_iteration_results(**results)
+            latencies.append(timeit.default_timer() - start_time)
+
+        start_time = timeit.default_timer()
+        experiment.finish()
+        finish_time = timeit.default_timer() - start_time
+
+    results = summarize_latencies(latencies)
+
+    results['finish_ms'] = finish_time * 1000.0
+    results['peak_rss_growth_mb'] = rss_sampler.get_peak_rss_growth_mb()
+
+    return results
+
+
+def benchmark_table_load(sql_model_class, numbers_of_rows, number_of_repeats):
+    """Measures the loading of experiment tables of growing size.
+
+    Synthetic experiments are added until the table has each of the
+    requested numbers of rows. Tables that already have more rows
+    are measured as they are.
+
+    Returns
+    -------
+    results : dict
+        Dict that maps the number of rows into the timings of loading
+        the first page, the first page sorted by a result column,
+        the whole table and the signature used to detect changes.
+    """
+
+    results = {}
+
+    for number_of_rows in sorted(numbers_of_rows):
+
+        number_of_existing_rows = sql_model_class.query.count()
+
+        if number_of_existing_rows < number_of_rows:
+
+            create_synthetic_experiments(sql_model_class, number_of_rows - number_of_existing_rows)
+
+        db.session.expire_all()
+
+        with RssSampler() as rss_sampler:
+
+            first_page_ms, rows = measure_median_time(
+                lambda: generate_table_contents_from_sql_model_class(sql_model_class,
+                                                                     page_size=experiments_table_page_size),
+                number_of_repeats)
+
+            sorted_page_ms, rows = measure_median_time(
+                lambda: generate_table_contents_from_sql_model_class(sql_model_class,
+                                                                     sort_column_name='validation_accuracy',
+                                                                     descending=True,
+                                                                     page_size=experiments_table_page_size),
+                number_of_repeats)
+
+            whole_table_ms, rows = measure_median_time(
+                lambda: generate_table_contents_from_sql_model_class(sql_model_class),
+                number_of_repeats)
+
+            signature_ms, signature = measure_median_time(lambda: get_table_signature(sql_model_class),
+                                                          number_of_repeats)
+
+        results[str(number_of_rows)] = {'number_of_rows': len(rows),
+                                        'first_page_ms': first_page_ms,
+                                        'sorted_first_page_ms': sorted_page_ms,
+                                        'whole_table_ms': whole_table_ms,
+                                        'whole_table_json_bytes': len(json.dumps(rows, default=str)),
+                                        'signature_ms': signature_ms,
+                                        'peak_rss_growth_mb': rss_sampler.get_peak_rss_growth_mb()}
+
+    return results
+
+
+def benchmark_figure_build(sql_model_class, numbers_of_points, number_of_plotted_experiments, number_of_repeats):
+    """Measures the building of comparison plots of growing experiments.
+
+    For each number of points, new synthetic experiments with this number
+    of points at every trace are created and plotted together.
+
+    Returns
+    -------
+    results : dict
+        Dict that maps the number of points into the build time with
+        an empty figure fragment cache (cold) and with the traces already
+        cached (warm), the time of serializing the figure the same way as
+        dash does and the size of the serialized figure. They are measured
+        for every trace encoding, see plot_trace_encoding in dash_deep/app.py.
+    """
+
+    results = {}
+
+    for number_of_points in sorted(numbers_of_points):
+
+        experiment_ids = create_synthetic_experiments(sql_model_class, number_of_plotted_experiments)
+
+        sql_model_instances = sql_model_class.query.filter(sql_model_class.id.in_(experiment_ids)).all()
+
+        insert_start_time = timeit.default_timer()
+
+        for sql_model_instance in sql_model_instances:
+
+            insert_synthetic_metric_points(sql_model_instance, number_of_points)
+
+        insert_time = timeit.default_timer() - insert_start_time
+
+        results[str(number_of_points)] = {'insert_ms': insert_time * 1000.0}
+
+        with RssSampler() as rss_sampler:
+
+            for trace_encoding in BENCHMARK_TRACE_ENCODINGS:
+
+                def build_cold_figure():
+
+                    figure_fragment_cache.clear()
+
+                    return create_mutual_plot(sql_model_instances, trace_encoding=trace_encoding)
+
+                cold_build_ms, figure = measure_median_time(build_cold_figure, number_of_repeats)
+
+                warm_build_ms, figure = measure_median_time(
+                    lambda: create_mutual_plot(sql_model_instances, trace_encoding=trace_encoding),
+                    number_of_repeats)
+
+                serialization_ms, figure_json = measure_median_time(
+                    lambda: json.dumps(figure, cls=PlotlyJSONEncoder),
+                    number_of_repeats)
+
+                results[str(number_of_points)][trace_encoding] = {'cold_build_ms': cold_build_ms,
+                                                                  'warm_build_ms': warm_build_ms,
+                                                                  'serialization_ms': serialization_ms,
+                                                                  'figure_json_bytes': len(figure_json)}
+
+                if trace_encoding == 'json':
+
+                    results[str(number_of_points)]['number_of_plotted_points'] = sum(len(trace['x'])
+                                                                                     for trace in figure['data'])
+
+        results[str(number_of_points)]['peak_rss_growth_mb'] = rss_sampler.get_peak_rss_growth_mb()
+
+    figure_fragment_cache.clear()
+
+    return results
+
+
+def run_benchmark(sql_model_class,
+                  numbers_of_points=(100, 1000, 10000, 100000, 1000000),
+                  numbers_of_rows=(10, 100, 1000, 10000),
+                  number_of_appends=1000,
+                  number_of_plotted_experiments=2,
+                  number_of_repeats=5,
+                  seed=0):
+    """Runs the whole benchmark suite.
+
+    Synthetic experiments are created in the configured database and
+    are deleted afterwards, even if the benchmark fails. The benchmark
+    command runs it only on a scratch database set with the
+    DASH_DEEP_DATABASE environment variable, so that the existing
+    experiments don't affect the timings and keep their ids.
+
+    The memory of each section is the growth of the resident set size
+    of the process during the section, see RssSampler.
+
+    Parameters
+    ----------
+    sql_model_class : sqlalchemy model class
+        Experiment type to benchmark.
+
+    numbers_of_points : list of ints
+        Numbers of points per trace of the plotted experiments.
+
+    numbers_of_rows : list of ints
+        Numbers of rows of the loaded tables.
+
+    number_of_appends : int
+        Number of iterations reported by the append latency benchmark.
+
+    number_of_plotted_experiments : int
+        Number of experiments shown in each comparison plot.
+
+    number_of_repeats : int
+        Number of times each load is repeated, the median is reported.
+
+    seed : int
+        Seed of the random values, makes the synthetic data reproducible.
+
+    Returns
+    -------
+    results : dict
+        Results that can be serialized into json and compared
+        with compare_benchmark_results().
+    """
+
+    random.seed(seed)
+    np.random.seed(seed)
+
+    results = {'environment': {'python': platform.python_version(),
+                               'platform': platform.platform(),
+                               'sqlalchemy_url': str(db.engine.url),
+                               'created_at': time.strftime('%Y-%m-%d %H:%M:%S')},
+               'parameters': {'experiment_table': sql_model_class.__tablename__,
+                              'numbers_of_points': sorted(numbers_of_points),
+                              'numbers_of_rows': sorted(numbers_of_rows),
+                              'number_of_appends': number_of_appends,
+                              'number_of_plotted_experiments': number_of_plotted_experiments,
+                              'number_of_repeats': number_of_repeats,
+                              'seed': seed}}
+
+    try:
+
+        with RssSampler() as rss_sampler:
+
+            results['append'] = {'unbuffered': benchmark_append_latency(sql_model_class, number_of_appends, False),
+                                 'buffered': benchmark_append_latency(sql_model_class, number_of_appends, True)}
+
+            results['table'] = benchmark_table_load(sql_model_class, numbers_of_rows, number_of_repeats)
+
+            results['figure'] = benchmark_figure_build(sql_model_class,
+                                                       numbers_of_points,
+                                                       number_of_plotted_experiments,
+                                                       number_of_repeats)
+
+    finally:
+
+        db.session.rollback()
+
+        delete_synthetic_experiments(sql_model_class)
+
+    results['peak_rss_growth_mb'] = rss_sampler.get_peak_rss_growth_mb()
+
+    return results
+
+
+def flatten_benchmark_results(results, prefix=''):
+    """Flattens the numeric values of nested results into a dict with dotted keys."""
+
+    flattened_results = {}
+
+    for key, value in results.items():
+
+        if not prefix and key in BENCHMARK_DESCRIPTION_SECTIONS:
+
+            continue
+
+        name = prefix + str(key)
+
+        if isinstance(value, dict):
+
+            flattened_results.update(flatten_benchmark_results(value, name + '.'))
+
+        elif isinstance(value, numbers.Number) and not isinstance(value, bool):
+
+            flattened_results[name] = value
+
+    return flattened_results
+
+
+def compare_benchmark_results(results, baseline_results, tolerance=1.2):
+    """Compares the results with a stored baseline.
+
+    All the measured values (times, sizes and memory) are better when
+    lower, so a value is considered a regression if it's more than
+    tolerance times larger than the baseline one.
+
+    Parameters
+    ----------
+    results : dict
+        Results of run_benchmark().
+
+    baseline_results : dict
+        Results of an earlier run_benchmark(), usually loaded from json.
+
+    tolerance : float
+        Allowed ratio of the current and the baseline value.
+
+    Returns
+    -------
+    comparison : list of dicts
+        Metric name, baseline value, current value, their ratio and
+        whether it is a regression, for the metrics present in both.
+    """
+
+    flattened_results = flatten_benchmark_results(results)
+    flattened_baseline_results = flatten_benchmark_results(baseline_results)
+
+    comparison = []
+
+    for name in sorted(set(flattened_results) & set(flattened_baseline_results)):
+
+        value = flattened_results[name]
+        baseline_value = flattened_baseline_results[name]
+
+        ratio = None
+
+        if baseline_value:
+
+            ratio = float(value) / baseline_value
+
+        comparison.append({'metric': name,
+                           'baseline': baseline_value,
+                           'current': value,
+                           'ratio': ratio,
+                           'regression': ratio is not None and ratio > tolerance})
+
+    return comparison
@@ -0,0 +1,381 @@
+from dash_deep.app import db, models_save_folder_path, checkpoints_keep_top_k, checkpoints_max_pending
+from dash_deep.model_store import store_state_dict, copy_dict_metadata, collect_garbage
+
+import json
+import os
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+def snapshot_state_dict(state_dict):
+    """Copies the tensors of a state dict to the cpu memory.
+
+    The training loop keeps updating the parameters in place after the
+    checkpoint is requested, so the tensors are copied before the call
+    returns and are serialized later from the copy. Nested dicts and lists
+    (like the state of an optimizer) are copied as well, other values are
+    taken as they are.
+
+    Parameters
+    ----------
+    state_dict : dict
+        State dict of a model or an optimizer.
+
+    Returns
+    -------
+    snapshot : dict
+        State dict of the same structure with cpu tensors.
+    """
+
+    # Imported here, so that the dashboard itself doesn't depend on pytorch
+    import torch
+
+    def snapshot_value(value):
+
+        if torch.is_tensor(value):
+
+            value = value.detach()
+
+            # cpu() doesn't copy the tensors that are already on the cpu
+            return value.cpu() if value.is_cuda else value.clone()
+
+        if isinstance(value, dict):
+
+            return copy_dict_metadata(value, value.__class__((key, snapshot_value(item)) for key, item in value.items()))
+
+        if isinstance(value, (list, tuple)):
+
+            return value.__class__(snapshot_value(item) for item in value)
+
+        return value
+
+    return snapshot_value(state_dict)
+
+
+def select_kept_checkpoints(checkpoints, keep_top_k, higher_score_is_better=True):
+    """Selects the checkpoints that are kept after a new one is written.
+
+    Parameters
+    ----------
+    checkpoints : list of dicts
+        Records of the written checkpoints with 'number' and 'score' keys.
+
+    keep_top_k : int
+        Number of checkpoints with the best scores to keep.
+
+    higher_score_is_better : bool
+        Direction of the scores.
+
+    Returns
+    -------
+    kept_checkpoints : list of dicts
+        The top keep_top_k scored checkpoints and the latest one,
+        in the order they were written.
+    """
+
+    if not checkpoints:
+
+        return []
+
+    latest_checkpoint = max(checkpoints, key=lambda checkpoint: checkpoint['number'])
+
+    scored_checkpoints = [checkpoint for checkpoint in checkpoints if checkpoint['score'] is not None]
+
+    # Earlier checkpoints win the ties
+    scored_checkpoints.sort(key=lambda checkpoint: ((-checkpoint['score'] if higher_score_is_better else checkpoint['score']),
+                                                    checkpoint['number']))
+
+    kept_numbers = set(checkpoint['number'] for checkpoint in scored_checkpoints[:keep_top_k])
+    kept_numbers.add(latest_checkpoint['number'])
+
+    return [checkpoint for checkpoint in checkpoints if checkpoint['number'] in kept_numbers]
+
+
+def get_best_checkpoint(checkpoints, higher_score_is_better=True):
+    """Returns the record of the best scored checkpoint or of the latest one if none is scored."""
+
+    scored_checkpoints = [checkpoint for checkpoint in checkpoints if checkpoint['score'] is not None]
+
+    if not scored_checkpoints:
+
+        return max(checkpoints, key=lambda checkpoint: checkpoint['number'])
+
+    if higher_score_is_better:
+
+        # Earlier checkpoints win the ties
+        return max(scored_checkpoints, key=lambda checkpoint: (checkpoint['score'], -checkpoint['number']))
+
+    return min(scored_checkpoints, key=lambda checkpoint: (checkpoint['score'], checkpoint['number']))
+
+
+class CheckpointWriter(object):
+    """Writes checkpoints of an experiment from a background thread.
+
+    save() copies the tensors to the cpu and returns, a single writer
+    thread writes the copies into the model store (see dash_deep/model_store.py)
+    in the order they were saved, keeps the best scored checkpoints and the
+    latest one and releases the rest. The kept checkpoints are recorded in
+    the checkpoints column of the experiment as json, the model_path column
+    points to the best one, so the inference of the experiment picks it up.
+    Objects of the released checkpoints are removed from the store once no
+    experiment references them.
+
+    At most max_pending snapshots wait for the writer, save() blocks if
+    the disk can't keep up instead of filling the memory with copies.
+
+    Errors that happen in the writer thread are raised in the training
+    thread on the next call to any method of the writer.
+
+    """
+
+    def __init__(self,
+                 sql_model_instance,
+                 keep_top_k=checkpoints_keep_top_k,
+                 higher_score_is_better=True,
+                 max_pending=checkpoints_max_pending):
+        """Starts the writer thread.
+
+        Parameters
+        ----------
+        sql_model_instance : sqlalchemy model instance
+            Experiment that the checkpoints belong to. Checkpoints recorded
+            by an earlier run of the experiment are taken over.
+
+        keep_top_k : int
+            Number of checkpoints with the best scores to keep.
+
+        higher_score_is_better : bool
+            Direction of the scores.
+
+        max_pending : int
+            Number of snapshots that can wait for the writer.
+        """
+
+        self.sql_model_class = sql_model_instance.__class__
+        self.experiment_id = sql_model_instance.id
+
+        self.keep_top_k = keep_top_k
+        self.higher_score_is_better = higher_score_is_better
+
+        self.checkpoints = json.loads(sql_model_instance.checkpoints or '[]')
+
+        self.next_number = max([checkpoint['number'] for checkpoint in self.checkpoints] or [-1]) + 1
+
+        # Objects of the released checkpoints that were not removed
+        # yet, because they were used too recently
+        self.released_paths = []
+
+        self.queue = queue.Queue(maxsize=max_pending)
+
+        self.error = None
+        self.closed = False
+
+        self.thread = threading.Thread(target=self.drain_queue,
+                                       name='dash-deep-checkpoint-writer')
+
+        # The thread should never keep the process alive, we wait
+        # for the pending checkpoints explicitly in close() instead
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def save(self, state_dict, score=None):
+        """Snapshots a state dict and puts it into the queue.
+
+        Parameters
+        ----------
+        state_dict : dict
+            State dict to save, see snapshot_state_dict().
+
+        score : float
+            Optional score of the checkpoint, only scored
+            checkpoints compete for the top places.
+
+        Returns
+        -------
+        number : int
+            Number of the checkpoint in the checkpoints column.
+        """
+
+        self.raise_error_if_any()
+
+        if self.closed:
+
+            raise RuntimeError('The checkpoint writer was already closed')
+
+        checkpoint = {'number': self.next_number,
+                      'score': None if score is None else float(score)}
+
+        self.next_number += 1
+
+        self.put(('save', snapshot_state_dict(state_dict), checkpoint))
+
+        return checkpoint['number']
+
+
+    def flush(self):
+        """Blocks until all the saved checkpoints are written."""
+
+        self.put_and_wait('flush')
+
+
+    def close(self):
+        """Writes all the saved checkpoints and stops the writer thread.
+
+        It is safe to call it multiple times.
+        """
+
+        if self.closed:
+
+            self.raise_error_if_any()
+
+            return
+
+        self.put_and_wait('stop')
+        self.closed = True
+
+
+    def put(self, operation):
+
+        # Waiting with a timeout in a loop, otherwise the main thread
+        # doesn't receive signals in python 2 while waiting
+        while True:
+
+            self.raise_error_if_any()
+
+            if not self.thread.is_alive():
+
+                raise RuntimeError('The checkpoint writer has stopped')
+
+            try:
+
+                self.queue.put(operation, timeout=0.1)
+
+                return
+
+            except queue.Full:
+
+                continue
+
+
+    def put_and_wait(self, command):
+
+        done_event = threading.Event()
+
+        self.put((command, done_event))
+
+        while not done_event.wait(0.1):
+
+            if not self.thread.is_alive():
+
+                break
+
+        self.raise_error_if_any()
+
+
+    def raise_error_if_any(self):
+
+        if self.error is not None:
+
+            error, self.error = self.error, None
+
+            raise error
+
+
+    def drain_queue(self):
+        """Main loop of the writer thread."""
+
+        while True:
+
+            operation = self.queue.get()
+
+            if operation[0] == 'save':
+
+                _, snapshot, checkpoint = operation
+
+                try:
+
+                    self.write_checkpoint(snapshot, checkpoint)
+
+                except Exception as error:
+
+                    # Surfacing the error in the training thread,
+                    # the failed checkpoint is dropped
+                    self.error = error
+
+                continue
+
+            if operation[0] == 'stop':
+
+                try:
+
+                    # Last try for the objects that were used too recently,
+                    # the rest is left for the gc command
+                    self.remove_released_objects()
+
+                except Exception as error:
+
+                    self.error = error
+
+            done_event = operation[1]
+            done_event.set()
+
+            if operation[0] == 'stop':
+
+                return
+
+
+    def write_checkpoint(self, snapshot, checkpoint):
+        """Writes a checkpoint, records the kept ones in the experiment
+        row and removes the objects of the released ones."""
+
+        write_start_time = time.time()
+
+        checkpoint['path'], checkpoint['size'], checkpoint['written_size'] = store_state_dict(snapshot)
+        checkpoint['write_time'] = time.time() - write_start_time
+
+        kept_checkpoints = select_kept_checkpoints(self.checkpoints + [checkpoint],
+                                                   self.keep_top_k,
+                                                   self.higher_score_is_better)
+
+        kept_numbers = set(kept_checkpoint['number'] for kept_checkpoint in kept_checkpoints)
+
+        best_checkpoint = get_best_checkpoint(kept_checkpoints, self.higher_score_is_better)
+
+        table = self.sql_model_class.__table__
+
+        # Recording first, so that the row never points to a removed file
+        with db.engine.begin() as connection:
+
+            connection.execute(table.update().where(table.c.id == self.experiment_id).values(version=table.c.version + 1,
+                                                                                          model_path=best_checkpoint['path'],
+                                                                                          checkpoints=json.dumps(kept_checkpoints)))
+
+        self.released_paths.extend(released_checkpoint['path'] for released_checkpoint in self.checkpoints + [checkpoint]
+                                   if released_checkpoint['number'] not in kept_numbers)
+
+        self.checkpoints = kept_checkpoints
+
+        self.remove_released_objects()
+
+
+    def remove_released_objects(self):
+        """Removes the objects of the released checkpoints that no experiment references."""
+
+        if not self.released_paths:
+
+            return
+
+        # Imported here, since this module is imported by the experiment
+        # scripts before the models are collected in dash_deep/app.py
+        from dash_deep.app import scripts_db_models
+
+        collect_garbage(scripts_db_models, self.released_paths)
+
+        self.released_paths = [released_path for released_path in self.released_paths
+                               if os.path.exists(os.path.join(models_save_folder_path, released_path))]
@@ -1,9 +1,99 @@
 import click
-from dash_deep.app import server, db
-from dash_deep.sql import create_dummy_endovis_records
+from dash_deep.app import (server,
+                           db,
+                           scripts_db_models,
+                           database_file_location,
+                           plot_points_per_trace,
+                           archive_experiments_older_than_days,
+                           model_store_gc_grace_seconds,
+                           inference_server_max_batch_size,
+                           inference_server_max_wait_ms)
+from dash_deep.sql import (create_dummy_endovis_records,
+                           add_missing_columns,
+                           add_missing_indexes,
+                           convert_table_filter_value)
+from dash_deep.metrics import migrate_graphs_to_metric_points
+from dash_deep.smoothing import rebuild_experiment_smoothed_traces
+from dash_deep.models import EndovisBinary
+from dash_deep.logging import Experiment
+from dash_deep.stream import metric_stream
+from dash_deep.benchmark import run_benchmark, compare_benchmark_results
+from dash_deep.export import export_experiments, export_formats
+from dash_deep.model_store import collect_garbage, import_experiment_model_files
+from dash_deep.archive import (archive_experiment,
+                               restore_experiment,
+                               get_experiments_to_archive)
+from dash_deep.task import TaskManager, ScheduledTask, FakeDeviceProbe
+from dash_deep.serving import MicroBatcher
+from dash_deep.testing import (create_fake_experiments,
+                               delete_fake_experiments,
+                               run_fake_task,
+                               run_tiny_model,
+                               load_tiny_model,
+                               run_tiny_model_inference,
+                               run_tiny_model_batch_inference,
+                               send_test_request,
+                               run_endpoint_request)
+
+import functools
+import json
+import numpy as np
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 # with_appcontext=False because we have server and db as global variables
 
+
+def rerun_with_temporary_database():
+    """Runs the current command again in a subprocess with a new temporary database.
+    
+    Test commands create and delete experiments, so they don't run in the
+    database of the user, whose ids SQLite would reuse for the next
+    experiments. If DASH_DEEP_DATABASE is set, the command runs in that
+    database in the current process.
+    
+    Returns
+    -------
+    rerun : bool
+        Whether the command already ran in the subprocess.
+    """
+    
+    if 'DASH_DEEP_DATABASE' in os.environ:
+        
+        return False
+    
+    temporary_folder_path = tempfile.mkdtemp(prefix='dash-deep-test-')
+    
+    environment = dict(os.environ, DASH_DEEP_DATABASE=os.path.join(temporary_folder_path, 'experiments.db'))
+    
+    click.echo('Running in the temporary database {}'.format(environment['DASH_DEEP_DATABASE']))
+    
+    try:
+        
+        return_code = subprocess.call([sys.executable, '-m', 'dash_deep.index'] + sys.argv[1:], env=environment)
+        
+    finally:
+        
+        shutil.rmtree(temporary_folder_path, ignore_errors=True)
+    
+    if return_code != 0:
+        
+        sys.exit(return_code)
+    
+    return True
+
+
 @server.cli.command(with_appcontext=False)
 @click.argument('host', default='0.0.0.0')
 @click.argument('port', default='5000')
@@ -15,7 +105,9 @@ def run_server(port, host):
     dash_deep/models.py file.
     """
     
-    server.run(port=port, host=host)
+    # Pages keep a connection open for the metric stream,
+    # so each request needs its own thread
+    server.run(port=port, host=host, threaded=True)
     
 @server.cli.command(with_appcontext=False)
 def drop_database():
@@ -53,5 +145,755 @@ def populate_database():
     db.session.add_all(dummy_model_instances_list)
     db.session.commit()
 
+    # Dummy values are generated inside of the pickled graphs,
+    # moving them into the metric points table
+    migrate_graphs_to_metric_points(EndovisBinary)
+
+
+def upgrade_database_schema():
+    """Creates missing tables and adds missing columns and indexes to the existing ones."""
+    
+    db.create_all()
+    
+    for script_db_model in scripts_db_models:
+        
+        for column_name in add_missing_columns(script_db_model):
+            
+            click.echo('{}: added column {}'.format(script_db_model.title, column_name))
+        
+        for index_name in add_missing_indexes(script_db_model):
+            
+            click.echo('{}: added index {}'.format(script_db_model.title, index_name))
+
+
+@server.cli.command(with_appcontext=False)
+def upgrade_database():
+    """Brings the tables created by older versions up to date.
+    
+    Creates the tables and adds the columns and indexes that were introduced
+    after the database was initiated. It is safe to run it multiple times.
+    """
+    
+    upgrade_database_schema()
+
+
+@server.cli.command(with_appcontext=False)
+def migrate_metrics():
+    """Moves values of old experiments into the metric points table.
+    
+    Experiments recorded before the metric points table was introduced
+    keep all their values inside of the pickled graphs column. This
+    command upgrades the tables (see upgrade_database) and moves them into
+    the metric points table. Smoothed copies of the traces that are missing
+    (see dash_deep/smoothing.py) are computed as well. It is safe to run it
+    multiple times.
+    """
+    
+    upgrade_database_schema()
+    
+    for script_db_model in scripts_db_models:
+        
+        number_of_migrated_experiments = migrate_graphs_to_metric_points(script_db_model)
+        
+        number_of_smoothed_traces = sum(len(rebuild_experiment_smoothed_traces(sql_model_instance))
+                                        for sql_model_instance in script_db_model.query.all())
+        
+        click.echo('{}: migrated {} experiments, computed {} smoothed traces'.format(script_db_model.title,
+                                                                                     number_of_migrated_experiments,
+                                                                                     number_of_smoothed_traces))
+
+
+@server.cli.command(with_appcontext=False)
+@click.option('--number-of-experiments', default=3, help='Number of fake experiments.')
+@click.option('--number-of-iterations', default=200, help='Number of iterations reported by each experiment.')
+@click.option('--iteration-delay', default=0.01, help='Seconds between the iterations.')
+@click.option('--timeout', default=30.0, help='Seconds to wait for the pushed points.')
+def test_metric_stream(number_of_experiments, number_of_iterations, iteration_delay, timeout):
+    """Checks the live metrics stream with fake experiments.
+    
+    Creates fake experiments that report random values from a background
+    thread while a subscriber of the metric stream collects the pushed
+    points. Fails if any reported point wasn't pushed exactly once and in
+    order. Run it with a larger iteration delay to watch the fake experiments
+    on the plots page of a running server with the same DASH_DEEP_DATABASE.
+    Runs in a temporary database unless DASH_DEEP_DATABASE is set, the fake
+    experiments are deleted afterwards.
+    """
+    
+    if rerun_with_temporary_database():
+        
+        return
+    
+    db.create_all()
+    
+    # Fake experiments are reported from another thread, which has its own
+    # session, so they are detached
+    fake_experiments = create_fake_experiments(number_of_experiments)
+    
+    experiments = [(fake_experiment.__tablename__, fake_experiment.id) for fake_experiment in fake_experiments]
+    trace_names = ['training_loss', 'training_accuracy', 'validation_accuracy']
+    
+    click.echo('Fake experiments: {}'.format(', '.join(str(experiment_id) for _, experiment_id in experiments)))
+    
+    subscriber = metric_stream.subscribe(['metrics'], experiments)
+    
+    def report_fake_results():
+        
+        fake_experiment_loggers = [Experiment(fake_experiment) for fake_experiment in fake_experiments]
+        
+        for iteration in range(number_of_iterations):
+            
+            for fake_experiment_logger in fake_experiment_loggers:
+                
+                fake_experiment_logger.add_next_iteration_results(**dict((trace_name, random.random())
+                                                                         for trace_name in trace_names))
+            
+            time.sleep(iteration_delay)
+    
+    start_time = time.time()
+    
+    reporting_thread = threading.Thread(target=report_fake_results)
+    reporting_thread.start()
+    
+    # Maps (experiment table, experiment id, trace name) into the list of pushed steps
+    pushed_steps = dict(((experiment_table, experiment_id, trace_name), [])
+                        for experiment_table, experiment_id in experiments
+                        for trace_name in trace_names)
+    
+    number_of_expected_points = len(pushed_steps) * number_of_iterations
+    number_of_pushed_points = 0
+    
+    try:
+        
+        while number_of_pushed_points < number_of_expected_points and time.time() - start_time < timeout:
+            
+            try:
+                event = subscriber.queue.get(timeout=1)
+                
+            except queue.Empty:
+                
+                continue
+            
+            if event is None:
+                
+                raise click.ClickException('The subscriber was disconnected, it fell behind the stream')
+            
+            _, data = event
+            
+            for trace_name, trace in data['traces'].items():
+                
+                trace_key = (data['experiment_table'], data['experiment_id'], trace_name)
+                
+                # Smoothed copies of the traces are pushed too, only the
+                # reported values are checked
+                if trace_key not in pushed_steps:
+                    
+                    continue
+                
+                pushed_steps[trace_key].extend(trace['steps'])
+                number_of_pushed_points += len(trace['steps'])
+        
+        elapsed_time = time.time() - start_time
+        
+    finally:
+        
+        reporting_thread.join()
+        metric_stream.unsubscribe(subscriber)
+        
+        delete_fake_experiments(fake_experiments)
+    
+    click.echo('Pushed {} of {} points in {:.2f} s'.format(number_of_pushed_points,
+                                                         number_of_expected_points,
+                                                         elapsed_time))
+    
+    expected_steps = list(range(number_of_iterations))
+    
+    failed_traces = [trace for trace, steps in pushed_steps.items() if steps != expected_steps]
+    
+    if failed_traces:
+        
+        raise click.ClickException('Traces with missing, duplicated or reordered points: {}'.format(failed_traces))
+    
+    click.echo('OK')
+
+
+@server.cli.command(with_appcontext=False)
+@click.option('--table', default=EndovisBinary.__tablename__, help='Table of the experiment type to benchmark.')
+@click.option('--points', multiple=True, type=int, default=[100, 1000, 10000, 100000, 1000000],
+              help='Number of points per trace of the plotted experiments, can be repeated.')
+@click.option('--rows', multiple=True, type=int, default=[10, 100, 1000, 10000],
+              help='Number of rows of the loaded tables, can be repeated.')
+@click.option('--appends', default=1000, help='Number of iterations reported by the append benchmark.')
+@click.option('--plotted-experiments', default=2, help='Number of experiments in each comparison plot.')
+@click.option('--repeats', default=5, help='Number of repetitions of each load, the median is reported.')
+@click.option('--seed', default=0, help='Seed of the synthetic values.')
+@click.option('--output', type=click.Path(), default=None, help='File to save the results to.')
+@click.option('--baseline', type=click.Path(exists=True), default=None, help='Results of an earlier run to compare with.')
+@click.option('--tolerance', default=1.2, help='Allowed ratio of the current and the baseline values.')
+@click.option('--fail-on-regression', is_flag=True, help='Exit with an error if any value regressed.')
+def benchmark(table, points, rows, appends, plotted_experiments, repeats, seed,
+              output, baseline, tolerance, fail_on_regression):
+    """Measures how reporting, tables and plots scale.
+    
+    Creates synthetic experiments with bulk inserts and reports the latency
+    of reporting an iteration, the time of loading the experiment tables, the
+    time of building comparison plots, the size of the plots and the growth
+    of the memory of the process during each of them as json. The synthetic
+    experiments are deleted afterwards. Runs only with DASH_DEEP_DATABASE
+    pointing to a scratch database, so that the existing experiments stay
+    out of the measurements and the database of the user isn't changed.
+    """
+    
+    if 'DASH_DEEP_DATABASE' not in os.environ:
+        
+        raise click.UsageError('Set DASH_DEEP_DATABASE to a scratch database, '
+                               'the benchmark creates and deletes experiments')
+    
+    db.create_all()
+    
+    sql_model_classes = dict((script_db_model.__tablename__, script_db_model)
+                             for script_db_model in scripts_db_models)
+    
+    if table not in sql_model_classes:
+        
+        raise click.BadParameter('Unknown table, choose from: {}'.format(', '.join(sorted(sql_model_classes))),
+                                 param_hint='--table')
+    
+    results = run_benchmark(sql_model_classes[table],
+                            numbers_of_points=points,
+                            numbers_of_rows=rows,
+                            number_of_appends=appends,
+                            number_of_plotted_experiments=plotted_experiments,
+                            number_of_repeats=repeats,
+                            seed=seed)
+    
+    results_json = json.dumps(results, indent=2, sort_keys=True)
+    
+    if output:
+        
+        with open(output, 'w') as output_file:
+            
+            output_file.write(results_json)
+    else:
+        
+        click.echo(results_json)
+    
+    if not baseline:
+        
+        return
+    
+    with open(baseline) as baseline_file:
+        
+        baseline_results = json.load(baseline_file)
+    
+    comparison = compare_benchmark_results(results, baseline_results, tolerance)
+    
+    for metric in comparison:
+        
+        ratio = 'n/a' if metric['ratio'] is None else '{:.2f}x'.format(metric['ratio'])
+        
+        click.echo('{:<50} {:>14.3f} {:>14.3f} {:>8} {}'.format(metric['metric'],
+                                                              metric['baseline'],
+                                                              metric['current'],
+                                                              ratio,
+                                                              'REGRESSION' if metric['regression'] else ''))
+    
+    regressions = [metric['metric'] for metric in comparison if metric['regression']]
+    
+    if regressions and fail_on_regression:
+        
+        raise click.ClickException('Regressed: {}'.format(', '.join(regressions)))
+
+
+@server.cli.command(with_appcontext=False)
+@click.argument('output_directory')
+@click.option('--format', 'export_format', type=click.Choice(export_formats), default='csv', help='Format of the files.')
+@click.option('--table', multiple=True, help='Table of the experiment type to export, can be repeated. All by default.')
+@click.option('--first-id', type=int, default=None, help='Smallest exported id.')
+@click.option('--last-id', type=int, default=None, help='Largest exported id.')
+@click.option('--created-after', default=None, help='Earliest creation date, YYYY-MM-DD [HH:MM[:SS]].')
+@click.option('--created-before', default=None, help='Latest creation date, YYYY-MM-DD [HH:MM[:SS]].')
+@click.option('--chunk-size', default=100000, help='Number of metric points read at once.')
+def export(output_directory, export_format, table, first_id, last_id, created_after, created_before, chunk_size):
+    """Exports experiments with all their metric traces.
+    
+    Writes the hyperparameters and results of the experiments and all the
+    reported values of their traces into csv, npz or parquet (requires
+    pyarrow) files in the output directory -- one set of files per experiment
+    type. Experiments and values are read in chunks, so exports of any size
+    take the same memory.
+    """
+    
+    sql_model_classes = dict((script_db_model.__tablename__, script_db_model)
+                             for script_db_model in scripts_db_models)
+    
+    unknown_tables = [table_name for table_name in table if table_name not in sql_model_classes]
+    
+    if unknown_tables:
+        
+        raise click.BadParameter('Unknown tables {}, choose from: {}'.format(', '.join(unknown_tables),
+                                                                           ', '.join(sorted(sql_model_classes))),
+                                 param_hint='--table')
+    
+    table_names = list(table) or sorted(sql_model_classes)
+    
+    try:
+        created_after = convert_table_filter_value(EndovisBinary.created_at, created_after) if created_after else None
+        created_before = convert_table_filter_value(EndovisBinary.created_at, created_before) if created_before else None
+        
+    except ValueError as error:
+        
+        raise click.BadParameter(str(error))
+    
+    for table_name in table_names:
+        
+        try:
+            summary = export_experiments(sql_model_classes[table_name],
+                                         output_directory,
+                                         export_format,
+                                         first_id=first_id,
+                                         last_id=last_id,
+                                         created_after=created_after,
+                                         created_before=created_before,
+                                         points_chunk_size=chunk_size)
+            
+        except ImportError as error:
+            
+            raise click.ClickException(str(error))
+        
+        click.echo('{}: exported {} experiments and {} points into {}'.format(sql_model_classes[table_name].title,
+                                                                             summary['number_of_experiments'],
+                                                                             summary['number_of_points'],
+                                                                             ', '.join(summary['paths'])))
+
+
+@server.cli.command(with_appcontext=False)
+@click.option('--table', multiple=True, help='Table of the experiment type to archive, can be repeated. All by default.')
+@click.option('--older-than-days', type=float, default=archive_experiments_older_than_days,
+              help='Archive experiments created and last reported more than this number of days ago.')
+@click.option('--experiment-id', multiple=True, type=int,
+              help='Archive this experiment regardless of its age, can be repeated. Requires a single --table.')
+@click.option('--restore', is_flag=True, help='Move the values of the --experiment-id experiments back into the database.')
+@click.option('--points', default=plot_points_per_trace, help='Number of points of each trace kept in the database.')
+@click.option('--dry-run', is_flag=True, help='Only list the experiments that would be archived.')
+@click.option('--vacuum', is_flag=True, help='Shrink the database file afterwards.')
+def archive(table, older_than_days, experiment_id, restore, points, dry_run, vacuum):
+    """Moves the values of old experiments into compressed archive files.
+    
+    Reported values of each archived experiment are written into a compressed
+    file in the archive folder (see dash_deep/app.py), the database keeps the
+    columns of the experiment and a rollup of each trace that the plots page
+    displays when the traces are not zoomed. Zoomed traces are read from the
+    archive files. Resumed experiments are restored automatically. The server
+    archives old experiments by itself every archive_policy_interval_hours
+    hours, --vacuum returns the freed space of the database file to the disk.
+    """
+    
+    upgrade_database_schema()
+    
+    sql_model_classes = dict((script_db_model.__tablename__, script_db_model)
+                             for script_db_model in scripts_db_models)
+    
+    unknown_tables = [table_name for table_name in table if table_name not in sql_model_classes]
+    
+    if unknown_tables:
+        
+        raise click.BadParameter('Unknown tables {}, choose from: {}'.format(', '.join(unknown_tables),
+                                                                           ', '.join(sorted(sql_model_classes))),
+                                 param_hint='--table')
+    
+    table_names = list(table) or sorted(sql_model_classes)
+    
+    if (experiment_id or restore) and len(table_names) != 1:
+        
+        raise click.BadParameter('Ids of experiments are only unique inside of a table, specify a single table',
+                                 param_hint='--table')
+    
+    if restore and not experiment_id:
+        
+        raise click.BadParameter('Specify the experiments to restore', param_hint='--experiment-id')
+    
+    if not experiment_id and older_than_days is None:
+        
+        raise click.BadParameter('Specify the age of the experiments to archive', param_hint='--older-than-days')
+    
+    database_size = os.path.getsize(database_file_location)
+    
+    for table_name in table_names:
+        
+        sql_model_class = sql_model_classes[table_name]
+        
+        if experiment_id:
+            
+            sql_model_instances = sql_model_class.query.filter(sql_model_class.id.in_(experiment_id)).all()
+            
+            missing_ids = set(experiment_id) - set(sql_model_instance.id for sql_model_instance in sql_model_instances)
+            
+            if missing_ids:
+                
+                raise click.BadParameter('No experiments with ids {}'.format(', '.join(str(missing_id)
+                                                                                        for missing_id in sorted(missing_ids))),
+                                         param_hint='--experiment-id')
+        else:
+            
+            sql_model_instances = get_experiments_to_archive(sql_model_class, older_than_days)
+        
+        for sql_model_instance in sql_model_instances:
+            
+            if dry_run:
+                
+                click.echo('{}: {} experiment {}'.format(sql_model_class.title,
+                                                         'would restore' if restore else 'would archive',
+                                                         sql_model_instance.id))
+                
+                continue
+            
+            try:
+                
+                if restore:
+                    
+                    number_of_restored_points = restore_experiment(sql_model_instance)
+                    
+                    click.echo('{}: restored {} points of experiment {}'.format(sql_model_class.title,
+                                                                                number_of_restored_points,
+                                                                                sql_model_instance.id))
+                    
+                    continue
+                
+                summary = archive_experiment(sql_model_instance, points)
+                
+            except (ValueError, IOError) as error:
+                
+                raise click.ClickException(str(error))
+            
+            if summary is None:
+                
+                click.echo('{}: experiment {} has no values or is already archived'.format(sql_model_class.title,
+                                                                                          sql_model_instance.id))
+                
+                continue
+            
+            click.echo('{}: archived {} points of experiment {} into {}, kept {}'.format(sql_model_class.title,
+                                                                                         summary['number_of_archived_points'],
+                                                                                         sql_model_instance.id,
+                                                                                         summary['path'],
+                                                                                         summary['number_of_kept_points']))
+    
+    if vacuum and not dry_run:
+        
+        # VACUUM can't run inside of a transaction
+        db.session.remove()
+        db.engine.execute('VACUUM')
+    
+    click.echo('Database size: {:.1f} MB -> {:.1f} MB'.format(database_size / 1e6,
+                                                                os.path.getsize(database_file_location) / 1e6))
+
 
-    
\ No newline at end of file
+@server.cli.command(with_appcontext=False)
+@click.option('--grace-seconds', default=model_store_gc_grace_seconds,
+              help='Keep the unreferenced objects that were used less than this number of seconds ago.')
+@click.option('--import-models', is_flag=True, help='Move the model files saved outside of the store into it first.')
+@click.option('--dry-run', is_flag=True, help='Only report the objects that would be removed.')
+def gc(grace_seconds, import_models, dry_run):
+    """Removes the checkpoints that no experiment references from the model store.
+    
+    Checkpoints are stored in the models folder by the hashes of their contents
+    (see dash_deep/model_store.py), the objects shared by multiple experiments
+    are stored once. An object is referenced by the checkpoints and the model
+    path columns of the experiment rows, so deleting experiments or keeping
+    fewer checkpoints leaves objects that are removed by this command.
+    --import-models moves the models saved by older versions into the store,
+    so that equal files are stored once too.
+    """
+    
+    upgrade_database_schema()
+    
+    if import_models and not dry_run:
+        
+        for script_db_model in scripts_db_models:
+            
+            number_of_imported_files = sum(import_experiment_model_files(sql_model_instance)
+                                           for sql_model_instance in script_db_model.query.all())
+            
+            click.echo('{}: imported {} model files'.format(script_db_model.title, number_of_imported_files))
+    
+    summary = collect_garbage(scripts_db_models, grace_seconds=grace_seconds, dry_run=dry_run)
+    
+    click.echo('{} objects, {} referenced, {} {} unreferenced objects ({:.1f} MB)'.format(summary['number_of_objects'],
+                                                                                         summary['number_of_referenced_objects'],
+                                                                                         'would remove' if dry_run else 'removed',
+                                                                                         summary['number_of_removed_objects'],
+                                                                                         summary['number_of_removed_bytes'] / 1e6))
+
+
+@server.cli.command(with_appcontext=False)
+@click.option('--number-of-tasks', default=8, help='Number of fake tasks.')
+@click.option('--jobs-per-device', default=2, help='Number of tasks that run on one gpu at once.')
+@click.option('--task-duration', default=1.0, help='Seconds that each task runs.')
+@click.option('--timeout', default=60.0, help='Seconds to wait for the tasks.')
+def test_scheduler(number_of_tasks, jobs_per_device, task_duration, timeout):
+    """Checks the task scheduler with a fake inventory of two gpus.
+    
+    The first gpu is free and the second one has too little free memory,
+    so the fake tasks queue up on the first gpu. Once the first task
+    finishes the memory of the second gpu is freed and the remaining tasks
+    spread over both gpus. The last task is pinned to the second gpu. Fails
+    if a task ran on a wrong gpu or a gpu ran more than --jobs-per-device
+    tasks at once. Runs in a temporary database unless DASH_DEEP_DATABASE
+    is set, the fake experiments are deleted afterwards.
+    """
+    
+    if rerun_with_temporary_database():
+        
+        return
+    
+    db.create_all()
+    
+    fake_experiments = create_fake_experiments(number_of_tasks - 1) + create_fake_experiments(1, gpu_id=1)
+    
+    device_probe = FakeDeviceProbe([{'index': 0, 'memory_total': 8000, 'memory_used': 0},
+                                    {'index': 1, 'memory_total': 8000, 'memory_used': 7500}])
+    
+    test_task_manager = TaskManager(device_probe=device_probe,
+                                    jobs_per_device=jobs_per_device,
+                                    min_free_memory_mb=1000,
+                                    poll_interval_s=0.2)
+    
+    tasks = [ScheduledTask(functools.partial(run_fake_task, task_duration),
+                           fake_experiment,
+                           fake_experiment.gpu_id if fake_experiment.gpu_id >= 0 else None)
+             for fake_experiment in fake_experiments]
+    
+    start_time = time.time()
+    
+    try:
+        
+        for task in tasks:
+            
+            test_task_manager.schedule_task(task)
+        
+        while not tasks[0].done() and time.time() - start_time < timeout:
+            
+            time.sleep(0.1)
+        
+        device_probe.set_memory_used(1, 0)
+        
+        while not all(task.done() for task in tasks) and time.time() - start_time < timeout:
+            
+            time.sleep(0.1)
+        
+        if not all(task.done() for task in tasks):
+            
+            raise click.ClickException('The tasks didn\'t finish in {} seconds'.format(timeout))
+        
+        results = [task.future.result() for task in tasks]
+        
+    finally:
+        
+        test_task_manager.shutdown()
+        
+        delete_fake_experiments(fake_experiments)
+    
+    for task, (visible_devices, task_start_time, task_end_time) in zip(tasks, results):
+        
+        click.echo('Task of experiment {}: gpu {}, waited {:.2f} s, ran from {:.2f} s to {:.2f} s'.format(task.sql_model_instance.id,
+                                                                                                       visible_devices,
+                                                                                                       task.started_at - task.queued_at,
+                                                                                                       task_start_time - start_time,
+                                                                                                       task_end_time - start_time))
+    
+    if results[-1][0] != '1':
+        
+        raise click.ClickException('The pinned task ran on gpu {}'.format(results[-1][0]))
+    
+    first_task_end_time = results[0][2]
+    
+    for visible_devices, task_start_time, task_end_time in results:
+        
+        if visible_devices == '1' and task_start_time < first_task_end_time:
+            
+            raise click.ClickException('A task started on the gpu without enough free memory')
+    
+    for visible_devices, task_start_time, _ in results:
+        
+        number_of_running_tasks = sum(1 for other_visible_devices, other_start_time, other_end_time in results
+                                      if other_visible_devices == visible_devices
+                                      and other_start_time <= task_start_time < other_end_time)
+        
+        if number_of_running_tasks > jobs_per_device:
+            
+            raise click.ClickException('gpu {} ran {} tasks at once'.format(visible_devices, number_of_running_tasks))
+    
+    click.echo('All {} tasks ran on the expected gpus in {:.2f} s'.format(number_of_tasks, time.time() - start_time))
+
+
+def run_inference_load_test(run_request, number_of_clients, requests_per_client, image_size):
+    """Sends requests from concurrent clients and checks the results.
+    
+    Parameters
+    ----------
+    run_request : function
+        Function that receives an image and returns the result of its inference.
+    
+    Returns
+    -------
+    latencies : numpy.ndarray
+        Seconds that each request waited for its result.
+    
+    elapsed_time : float
+        Seconds that all the requests took.
+    """
+    
+    random_state = np.random.RandomState(1)
+    
+    client_images = [[random_state.randint(0, 256, size=(image_size, image_size, 3)).astype(np.uint8)
+                      for _ in range(requests_per_client)]
+                     for _ in range(number_of_clients)]
+    
+    # Computed beforehand, so that the checks don't slow down the clients
+    client_expected_results = [[run_tiny_model([image])[0] for image in images] for images in client_images]
+    
+    latencies = []
+    errors = []
+    
+    def send_requests(images, expected_results):
+        
+        for image, expected_result in zip(images, expected_results):
+            
+            start_time = time.time()
+            
+            try:
+                
+                result = run_request(image)
+                
+                # Every caller has to receive the result of its own image
+                if not np.array_equal(result, expected_result):
+                    
+                    raise RuntimeError('A request received the result of another request')
+                
+            except Exception as error:
+                
+                errors.append(error)
+                
+                return
+            
+            latencies.append(time.time() - start_time)
+    
+    clients = [threading.Thread(target=send_requests, args=(images, expected_results))
+               for images, expected_results in zip(client_images, client_expected_results)]
+    
+    start_time = time.time()
+    
+    for client in clients:
+        
+        client.start()
+    
+    for client in clients:
+        
+        client.join()
+    
+    elapsed_time = time.time() - start_time
+    
+    if errors:
+        
+        raise click.ClickException(str(errors[0]))
+    
+    return np.array(latencies), elapsed_time
+
+
+def echo_inference_load_test_results(run_name, latencies, elapsed_time, mean_batch_size):
+    
+    click.echo('{}: {:.1f} requests/s, latency p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms, '
+               'mean batch size {:.2f}'.format(run_name,
+                                               len(latencies) / elapsed_time,
+                                               np.percentile(latencies, 50) * 1000,
+                                               np.percentile(latencies, 95) * 1000,
+                                               np.percentile(latencies, 99) * 1000,
+                                               mean_batch_size))
+
+
+@server.cli.command(with_appcontext=False)
+@click.option('--clients', default=16, help='Number of concurrent clients.')
+@click.option('--requests-per-client', default=50, help='Number of requests sent by each client one after another.')
+@click.option('--image-size', default=128, help='Width and height of the random images.')
+@click.option('--max-batch-size', default=inference_server_max_batch_size, help='Maximum number of requests in one batch.')
+@click.option('--max-wait-ms', default=inference_server_max_wait_ms, help='Time the first request of a batch waits for more.')
+def test_inference_server(clients, requests_per_client, image_size, max_batch_size, max_wait_ms):
+    """Load tests the batched inference of the requests with a tiny cpu model.
+    
+    Concurrent clients send single images to a MicroBatcher (see
+    dash_deep/serving.py) of a 1x1 convolution model that runs in the
+    process of the command, first without batching and then with the
+    specified batch size and waiting time. Then they post the images to
+    the inference endpoint of a fake experiment with the test client of
+    the server, so the requests go through the view, the InferenceServer
+    and the workers of the inference pool, which use the inference_server_*
+    settings of dash_deep/app.py. The fake experiment runs the tiny model
+    instead of its own. Prints the throughput, the latencies and the mean
+    batch size of every run. Fails if any request received a wrong result
+    or a broken image wasn't rejected with 400. Runs in a temporary database
+    unless DASH_DEEP_DATABASE is set, the fake experiment is deleted afterwards.
+    """
+    
+    if rerun_with_temporary_database():
+        
+        return
+    
+    for run_name, run_max_batch_size, run_max_wait_ms in [('unbatched', 1, 0),
+                                                          ('batched', max_batch_size, max_wait_ms)]:
+        
+        batcher = MicroBatcher(run_tiny_model,
+                               max_batch_size=run_max_batch_size,
+                               max_wait_ms=run_max_wait_ms,
+                               max_queue_size=clients)
+        
+        latencies, elapsed_time = run_inference_load_test(lambda image: batcher.submit(image).wait(60),
+                                                          clients,
+                                                          requests_per_client,
+                                                          image_size)
+        
+        echo_inference_load_test_results(run_name, latencies, elapsed_time, batcher.get_stats()['mean_batch_size'])
+    
+    db.create_all()
+    
+    fake_experiment = create_fake_experiments(1)[0]
+    
+    experiment_key = '{}/{}'.format(fake_experiment.__tablename__, fake_experiment.id)
+    
+    url = '/inference/' + experiment_key
+    
+    # The actions are passed to the workers of the inference pool by
+    # the endpoint, so the workers run the tiny model as well
+    original_actions = EndovisBinary.actions
+    
+    EndovisBinary.actions = dict(original_actions,
+                                 inference=run_tiny_model_inference,
+                                 load_model=load_tiny_model,
+                                 batch_inference=run_tiny_model_batch_inference)
+    
+    try:
+        
+        response = send_test_request(url, {'image': 'not an image'})
+        
+        if response.status_code != 400:
+            
+            raise click.ClickException('A broken image received {} instead of 400'.format(response.status_code))
+        
+        latencies, elapsed_time = run_inference_load_test(functools.partial(run_endpoint_request, url),
+                                                          clients,
+                                                          requests_per_client,
+                                                          image_size)
+        
+        stats = json.loads(send_test_request('/inference/stats').get_data(as_text=True))
+        
+    finally:
+        
+        EndovisBinary.actions = original_actions
+        
+        delete_fake_experiments([fake_experiment])
+    
+    batcher_stats = stats['batchers'][experiment_key]
+    
+    echo_inference_load_test_results('endpoint', latencies, elapsed_time, batcher_stats['mean_batch_size'])
+    
+    click.echo('Model cache of the inference workers: {}'.format(stats['model_cache']))
@@ -0,0 +1,199 @@
+import numpy as np
+
+
+def get_bucket_extremum_indices(values, bucket_starts, bucket_sizes, reduce_function):
+    """Finds the index of the extremum value inside of each bucket.
+
+    Buckets are contiguous slices of the values array. The reduction is
+    performed for all buckets at once with ufunc.reduceat() and the first
+    position of the extremum inside of each bucket is found afterwards.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Values to search in. Shouldn't contain NaNs.
+
+    bucket_starts : numpy.ndarray
+        Start index of each bucket.
+
+    bucket_sizes : numpy.ndarray
+        Number of elements in each bucket (all greater than zero).
+
+    reduce_function : numpy.ufunc
+        np.maximum or np.minimum.
+
+    Returns
+    -------
+    indices : numpy.ndarray
+        Index of the extremum of each bucket in the values array.
+    """
+
+    bucket_extremums = reduce_function.reduceat(values, bucket_starts)
+
+    is_extremum = values == np.repeat(bucket_extremums, bucket_sizes)
+
+    candidate_indices = np.flatnonzero(is_extremum)
+    candidate_buckets = np.repeat(np.arange(len(bucket_sizes)), bucket_sizes)[candidate_indices]
+
+    # Buckets can have multiple equal extremums, taking the first one
+    _, first_candidate_positions = np.unique(candidate_buckets, return_index=True)
+
+    return candidate_indices[first_candidate_positions]
+
+
+def downsample_lttb(x, y, number_of_points):
+    """Selects points of a trace with the Largest-Triangle-Three-Buckets algorithm.
+
+    The first and the last points are always kept, the rest of the points
+    are split into number_of_points - 2 buckets and the point forming the
+    largest triangle with its neighbouring buckets is selected from each bucket.
+    The original algorithm uses the point selected in the previous bucket as
+    one of the vertices which makes it sequential -- we use the average of
+    the previous bucket instead, so that all buckets are processed at once.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Steps of the trace, sorted.
+
+    y : numpy.ndarray
+        Values of the trace.
+
+    number_of_points : int
+        Maximum number of points to keep.
+
+    Returns
+    -------
+    indices : numpy.ndarray
+        Sorted indices of the selected points.
+    """
+
+    length = len(x)
+
+    if length <= number_of_points:
+
+        return np.arange(length)
+
+    if number_of_points < 3:
+
+        return np.array([0, length - 1])[:number_of_points]
+
+    number_of_buckets = number_of_points - 2
+
+    # Buckets are formed from all the points except for the first and the last
+    bucket_edges = np.linspace(1, length - 1, number_of_buckets + 1).astype(np.int64)
+    bucket_starts = bucket_edges[:-1]
+    bucket_sizes = np.diff(bucket_edges)
+
+    interior_x = x[1:-1]
+    interior_y = y[1:-1]
+
+    bucket_average_x = np.add.reduceat(interior_x, bucket_starts - 1) / bucket_sizes
+    bucket_average_y = np.add.reduceat(interior_y, bucket_starts - 1) / bucket_sizes
+
+    previous_x = np.repeat(np.concatenate(([x[0]], bucket_average_x[:-1])), bucket_sizes)
+    previous_y = np.repeat(np.concatenate(([y[0]], bucket_average_y[:-1])), bucket_sizes)
+
+    next_x = np.repeat(np.concatenate((bucket_average_x[1:], [x[-1]])), bucket_sizes)
+    next_y = np.repeat(np.concatenate((bucket_average_y[1:], [y[-1]])), bucket_sizes)
+
+    # Doubled area of the triangle, the factor doesn't change the argmax
+    areas = np.abs((previous_x - next_x) * (interior_y - previous_y) -
+                   (previous_x - interior_x) * (next_y - previous_y))
+
+    areas[np.isnan(areas)] = -1
+
+    selected_indices = get_bucket_extremum_indices(areas,
+                                                   bucket_starts - 1,
+                                                   bucket_sizes,
+                                                   np.maximum) + 1
+
+    return np.concatenate(([0], selected_indices, [length - 1]))
+
+
+def downsample_min_max(x, y, number_of_points):
+    """Selects the minimum and the maximum points of each bucket of a trace.
+
+    Points are split into buckets of equal size and the minimum and the
+    maximum of each bucket are kept in their original order together with
+    the first and the last points.
+    Unlike LTTB, it always preserves the spikes of a trace which is useful for
+    noisy training losses.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Steps of the trace, sorted.
+
+    y : numpy.ndarray
+        Values of the trace.
+
+    number_of_points : int
+        Maximum number of points to keep.
+
+    Returns
+    -------
+    indices : numpy.ndarray
+        Sorted indices of the selected points.
+    """
+
+    length = len(x)
+
+    if length <= number_of_points:
+
+        return np.arange(length)
+
+    # Two points are left for the first and the last points of the trace
+    number_of_buckets = max((number_of_points - 2) // 2, 1)
+
+    bucket_edges = np.linspace(0, length, number_of_buckets + 1).astype(np.int64)
+    bucket_starts = bucket_edges[:-1]
+    bucket_sizes = np.diff(bucket_edges)
+
+    # NaNs would break the comparison with the reduced values
+    y_without_nans = np.where(np.isnan(y), np.nanmean(y), y)
+
+    minimum_indices = get_bucket_extremum_indices(y_without_nans, bucket_starts, bucket_sizes, np.minimum)
+    maximum_indices = get_bucket_extremum_indices(y_without_nans, bucket_starts, bucket_sizes, np.maximum)
+
+    return np.unique(np.concatenate(([0], minimum_indices, maximum_indices, [length - 1])))
+
+
+downsampling_methods = {'lttb': downsample_lttb,
+                        'min_max': downsample_min_max}
+
+
+def downsample_trace(steps, values, number_of_points, method='lttb'):
+    """Reduces the number of points of a trace while preserving its shape.
+
+    Parameters
+    ----------
+    steps : iterable of ints
+        Steps of the trace, sorted.
+
+    values : iterable of floats
+        Values of the trace.
+
+    number_of_points : int
+        Maximum number of points to keep. Traces that already fit
+        are returned as they are.
+
+    method : string
+        'lttb' or 'min_max'.
+
+    Returns
+    -------
+    steps, values : lists
+        Steps and values of the selected points.
+    """
+
+    steps = np.asarray(steps, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+
+    if len(steps) <= number_of_points:
+
+        return steps.astype(np.int64).tolist(), values.tolist()
+
+    indices = downsampling_methods[method](steps, values, number_of_points)
+
+    return steps[indices].astype(np.int64).tolist(), values[indices].tolist()
@@ -0,0 +1,575 @@
+from dash_deep.app import db
+from dash_deep.sql import get_table_columns
+from dash_deep.metrics import MetricPoint
+from dash_deep.archive import get_experiment_archive_path, read_experiment_archive
+
+import csv
+import datetime
+import io
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # Parquet export is optional
+    pyarrow = None
+
+
+export_formats = ['csv', 'npz', 'parquet']
+
+# Columns of the exported metric points, the points are
+# exported in the long format: one row per point
+metric_point_export_columns = ['experiment_id', 'trace_name', 'step', 'wall_time', 'value']
+
+
+def generate_experiment_chunks(sql_model_class,
+                               first_id=None,
+                               last_id=None,
+                               created_after=None,
+                               created_before=None,
+                               chunk_size=1000):
+    """Reads the experiments of a model class in chunks ordered by id.
+
+    Each chunk is read with a separate query that continues after the
+    last id of the previous chunk, so the memory doesn't depend on the
+    number of experiments. The graphs column is not read.
+
+    Parameters
+    ----------
+    sql_model_class : sqlalchemy model class
+        Experiment type to read.
+
+    first_id, last_id : int
+        Optional inclusive range of ids.
+
+    created_after, created_before : datetime.datetime
+        Optional inclusive range of creation dates.
+
+    chunk_size : int
+        Number of experiments in a chunk.
+
+    Yields
+    ------
+    experiments : list of dicts
+        Column names and values of the experiments of the chunk.
+    """
+
+    columns = get_table_columns(sql_model_class)
+
+    query = db.session.query(*columns)
+
+    if first_id is not None:
+
+        query = query.filter(sql_model_class.id >= first_id)
+
+    if last_id is not None:
+
+        query = query.filter(sql_model_class.id <= last_id)
+
+    if created_after is not None:
+
+        query = query.filter(sql_model_class.created_at >= created_after)
+
+    if created_before is not None:
+
+        query = query.filter(sql_model_class.created_at <= created_before)
+
+    last_read_id = None
+
+    while True:
+
+        chunk_query = query
+
+        if last_read_id is not None:
+
+            chunk_query = chunk_query.filter(sql_model_class.id > last_read_id)
+
+        rows = chunk_query.order_by(sql_model_class.id).limit(chunk_size).all()
+
+        if not rows:
+
+            return
+
+        experiments = [dict((column.name, value) for column, value in zip(columns, row)) for row in rows]
+
+        last_read_id = experiments[-1]['id']
+
+        yield experiments
+
+
+def get_experiment_trace_names(sql_model_class, experiment_id):
+    """Returns the names of the traces that have metric points."""
+
+    query = db.session.query(MetricPoint.trace_name).filter(MetricPoint.experiment_table == sql_model_class.__tablename__,
+                                                            MetricPoint.experiment_id == experiment_id)
+
+    return sorted(trace_name for trace_name, in query.distinct())
+
+
+def generate_trace_chunks(sql_model_class, experiment_id, trace_name, chunk_size=100000):
+    """Reads the metric points of a trace in chunks ordered by step.
+
+    Each chunk continues after the last step of the previous one, which
+    is served by the index of the metric points table.
+
+    Yields
+    ------
+    steps, wall_times, values : numpy.ndarray
+        Columns of the points of the chunk.
+    """
+
+    query = db.session.query(MetricPoint.step, MetricPoint.wall_time, MetricPoint.value)
+
+    query = query.filter(MetricPoint.experiment_table == sql_model_class.__tablename__,
+                         MetricPoint.experiment_id == experiment_id,
+                         MetricPoint.trace_name == trace_name)
+
+    last_read_step = None
+
+    while True:
+
+        chunk_query = query
+
+        if last_read_step is not None:
+
+            chunk_query = chunk_query.filter(MetricPoint.step > last_read_step)
+
+        points = chunk_query.order_by(MetricPoint.step).limit(chunk_size).all()
+
+        if not points:
+
+            return
+
+        steps = np.array([step for step, wall_time, value in points], dtype=np.int64)
+        wall_times = np.array([wall_time for step, wall_time, value in points], dtype=np.float64)
+        values = np.array([value for step, wall_time, value in points], dtype=np.float64)
+
+        last_read_step = int(steps[-1])
+
+        yield steps, wall_times, values
+
+
+def generate_experiment_traces(sql_model_class, experiment, chunk_size=100000):
+    """Reads the traces of an experiment in chunks.
+
+    Traces of archived experiments are read from their archive
+    files (see dash_deep/archive.py).
+
+    Yields
+    ------
+    trace_name, trace_chunks : string, iterable
+        Name of the trace and its chunks, see generate_trace_chunks().
+    """
+
+    if experiment.get('archived_at') is None:
+
+        for trace_name in get_experiment_trace_names(sql_model_class, experiment['id']):
+
+            yield trace_name, generate_trace_chunks(sql_model_class, experiment['id'], trace_name, chunk_size)
+
+        return
+
+    archive_path = get_experiment_archive_path(sql_model_class.__tablename__, experiment['id'])
+
+    for trace_name, (steps, wall_times, values) in read_experiment_archive(archive_path).items():
+
+        yield trace_name, [(steps[chunk_start:chunk_start + chunk_size],
+                            wall_times[chunk_start:chunk_start + chunk_size],
+                            values[chunk_start:chunk_start + chunk_size])
+                           for chunk_start in range(0, len(steps), chunk_size)]
+
+
+def convert_value_to_text(value):
+    """Converts a column value into the text written into exported files."""
+
+    if value is None:
+
+        return ''
+
+    if isinstance(value, datetime.datetime):
+
+        return value.isoformat(' ')
+
+    return value
+
+
+class CsvExportWriter(object):
+    """Writes experiments and metric points into two csv files.
+
+    <prefix>_experiments.csv has a row per experiment and
+    <prefix>_metrics.csv has a row per metric point.
+
+    """
+
+    def __init__(self, path_prefix, columns):
+
+        self.paths = [path_prefix + '_experiments.csv', path_prefix + '_metrics.csv']
+
+        # csv module of python 2 expects files opened in the binary mode
+        if sys.version_info[0] == 2:
+
+            self.experiments_file = open(self.paths[0], 'wb')
+            self.metrics_file = open(self.paths[1], 'wb')
+        else:
+
+            self.experiments_file = open(self.paths[0], 'w', newline='')
+            self.metrics_file = open(self.paths[1], 'w', newline='')
+
+        self.column_names = [column.name for column in columns]
+
+        self.experiments_writer = csv.writer(self.experiments_file)
+        self.experiments_writer.writerow(self.column_names)
+
+        self.metrics_writer = csv.writer(self.metrics_file)
+        self.metrics_writer.writerow(metric_point_export_columns)
+
+
+    def write_experiments(self, experiments):
+
+        self.experiments_writer.writerows([convert_value_to_text(experiment[column_name])
+                                           for column_name in self.column_names]
+                                          for experiment in experiments)
+
+
+    def write_trace_chunk(self, experiment_id, trace_name, steps, wall_times, values):
+
+        self.metrics_writer.writerows([experiment_id, trace_name, step, wall_time, value]
+                                      for step, wall_time, value in zip(steps.tolist(),
+                                                                        wall_times.tolist(),
+                                                                        values.tolist()))
+
+
+    def finish_trace(self, experiment_id, trace_name):
+
+        pass
+
+
+    def close(self):
+
+        self.experiments_file.close()
+        self.metrics_file.close()
+
+
+class NpzExportWriter(object):
+    """Writes experiments and metric points into a numpy .npz archive.
+
+    The archive has an 'experiments/<column name>' array per column and
+    'metrics/<experiment id>/<trace name>/<step|wall_time|value>' arrays
+    per trace. The header of a .npy file needs the number of points and the
+    entries of a zip archive are written one at a time, so the columns of
+    the chunks are appended to temporary files and each of them is streamed
+    into its entry after the header once the trace is complete. The memory
+    doesn't depend on the length of the traces.
+
+    """
+
+    # Types of the columns of the metric points in the archive
+    trace_column_dtypes = [('step', np.dtype(np.int64)),
+                           ('wall_time', np.dtype(np.float64)),
+                           ('value', np.dtype(np.float64))]
+
+    def __init__(self, path_prefix, columns):
+
+        self.paths = [path_prefix + '.npz']
+
+        self.archive = zipfile.ZipFile(self.paths[0], 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+
+        self.columns = columns
+
+        # Experiments are small comparing to the metrics,
+        # they are collected and written on close()
+        self.column_values = dict((column.name, []) for column in columns)
+
+        # Raw values of the columns of the current trace
+        self.trace_column_files = [tempfile.TemporaryFile() for _ in self.trace_column_dtypes]
+
+        self.number_of_trace_points = 0
+
+
+    def write_array(self, name, values_array):
+
+        array_file = io.BytesIO()
+
+        np.save(array_file, values_array, allow_pickle=False)
+
+        self.archive.writestr(name + '.npy', array_file.getvalue())
+
+
+    def write_array_from_file(self, name, dtype, number_of_values, values_file):
+        """Writes a one-dimensional array whose raw values are in a file without reading them at once."""
+
+        header_file = io.BytesIO()
+
+        np.lib.format.write_array_header_1_0(header_file, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                                           'fortran_order': False,
+                                                           'shape': (number_of_values,)})
+
+        values_file.seek(0)
+
+        # Entries of zip archives can be opened for writing since python 3.6
+        if sys.version_info >= (3, 6):
+
+            with self.archive.open(name + '.npy', 'w', force_zip64=True) as array_file:
+
+                array_file.write(header_file.getvalue())
+
+                shutil.copyfileobj(values_file, array_file)
+
+            return
+
+        with tempfile.NamedTemporaryFile() as array_file:
+
+            array_file.write(header_file.getvalue())
+
+            shutil.copyfileobj(values_file, array_file)
+
+            array_file.flush()
+
+            self.archive.write(array_file.name, name + '.npy')
+
+
+    def write_experiments(self, experiments):
+
+        for column in self.columns:
+
+            self.column_values[column.name].extend(experiment[column.name] for experiment in experiments)
+
+
+    def write_trace_chunk(self, experiment_id, trace_name, steps, wall_times, values):
+
+        for (column_name, dtype), column_file, column_values in zip(self.trace_column_dtypes,
+                                                                    self.trace_column_files,
+                                                                    [steps, wall_times, values]):
+
+            column_file.write(np.ascontiguousarray(column_values, dtype=dtype).tobytes())
+
+        self.number_of_trace_points += len(steps)
+
+
+    def finish_trace(self, experiment_id, trace_name):
+
+        if not self.number_of_trace_points:
+
+            return
+
+        prefix = 'metrics/{}/{}/'.format(experiment_id, trace_name)
+
+        for (column_name, dtype), column_file in zip(self.trace_column_dtypes, self.trace_column_files):
+
+            self.write_array_from_file(prefix + column_name, dtype, self.number_of_trace_points, column_file)
+
+            column_file.seek(0)
+            column_file.truncate()
+
+        self.number_of_trace_points = 0
+
+
+    def close(self):
+
+        for column in self.columns:
+
+            values = self.column_values[column.name]
+
+            if column.type.python_type in (int, float) and None not in values:
+
+                values_array = np.array(values, dtype=column.type.python_type)
+
+            elif column.type.python_type in (int, float):
+
+                # Missing numbers become NaNs
+                values_array = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+            else:
+
+                values_array = np.array([u'{}'.format(convert_value_to_text(value)) for value in values])
+
+            self.write_array('experiments/' + column.name, values_array)
+
+        self.archive.close()
+
+        for column_file in self.trace_column_files:
+
+            column_file.close()
+
+
+def get_arrow_type(column):
+    """Returns the parquet type of an sqlalchemy column."""
+
+    python_type = column.type.python_type
+
+    if python_type is bool:
+
+        return pyarrow.bool_()
+
+    if python_type is int:
+
+        return pyarrow.int64()
+
+    if python_type is float:
+
+        return pyarrow.float64()
+
+    if python_type is datetime.datetime:
+
+        return pyarrow.timestamp('us')
+
+    return pyarrow.string()
+
+
+class ParquetExportWriter(object):
+    """Writes experiments and metric points into two parquet files.
+
+    Same layout as CsvExportWriter, each written chunk becomes a row group.
+    Requires pyarrow.
+
+    """
+
+    def __init__(self, path_prefix, columns):
+
+        if pyarrow is None:
+
+            raise ImportError('Parquet export requires pyarrow, install it or choose another format')
+
+        self.paths = [path_prefix + '_experiments.parquet', path_prefix + '_metrics.parquet']
+
+        self.experiments_schema = pyarrow.schema([(column.name, get_arrow_type(column)) for column in columns])
+
+        self.metrics_schema = pyarrow.schema([('experiment_id', pyarrow.int64()),
+                                              ('trace_name', pyarrow.string()),
+                                              ('step', pyarrow.int64()),
+                                              ('wall_time', pyarrow.float64()),
+                                              ('value', pyarrow.float64())])
+
+        self.experiments_writer = pyarrow.parquet.ParquetWriter(self.paths[0], self.experiments_schema)
+        self.metrics_writer = pyarrow.parquet.ParquetWriter(self.paths[1], self.metrics_schema)
+
+
+    def write_experiments(self, experiments):
+
+        arrays = [pyarrow.array([experiment[field.name] for experiment in experiments], type=field.type)
+                  for field in self.experiments_schema]
+
+        self.experiments_writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.experiments_schema))
+
+
+    def write_trace_chunk(self, experiment_id, trace_name, steps, wall_times, values):
+
+        arrays = [pyarrow.array(np.full(len(steps), experiment_id, dtype=np.int64)),
+                  pyarrow.array([trace_name] * len(steps), type=pyarrow.string()),
+                  pyarrow.array(steps),
+                  pyarrow.array(wall_times),
+                  pyarrow.array(values)]
+
+        self.metrics_writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.metrics_schema))
+
+
+    def finish_trace(self, experiment_id, trace_name):
+
+        pass
+
+
+    def close(self):
+
+        self.experiments_writer.close()
+        self.metrics_writer.close()
+
+
+export_writer_classes = {'csv': CsvExportWriter,
+                         'npz': NpzExportWriter,
+                         'parquet': ParquetExportWriter}
+
+
+def export_experiments(sql_model_class,
+                       output_directory,
+                       export_format='csv',
+                       first_id=None,
+                       last_id=None,
+                       created_after=None,
+                       created_before=None,
+                       experiments_chunk_size=1000,
+                       points_chunk_size=100000):
+    """Exports the experiments of a model class with all their metric traces.
+
+    Experiments and metric points are streamed from the database in chunks
+    straight into the files, see generate_experiment_chunks() and
+    generate_trace_chunks(). Values of experiments that weren't moved
+    into the metric points table (see migrate_metrics command) are not
+    exported, values of archived experiments are read from their archive
+    files.
+
+    Parameters
+    ----------
+    sql_model_class : sqlalchemy model class
+        Experiment type to export.
+
+    output_directory : string
+        Directory to create the files in, the names of the files
+        start with the name of the table of the experiments.
+
+    export_format : string
+        'csv', 'npz' or 'parquet' (requires pyarrow).
+
+    For the filters see generate_experiment_chunks().
+
+    Returns
+    -------
+    summary : dict
+        Paths of the created files, numbers of exported experiments and points.
+    """
+
+    if export_format not in export_writer_classes:
+
+        raise ValueError('Unknown export format {}, expected one of: {}'.format(export_format,
+                                                                                ', '.join(export_formats)))
+
+    if not os.path.exists(output_directory):
+
+        os.makedirs(output_directory)
+
+    path_prefix = os.path.join(output_directory, sql_model_class.__tablename__)
+
+    writer = export_writer_classes[export_format](path_prefix, get_table_columns(sql_model_class))
+
+    number_of_experiments = 0
+    number_of_points = 0
+
+    try:
+
+        for experiments in generate_experiment_chunks(sql_model_class,
+                                                      first_id,
+                                                      last_id,
+                                                      created_after,
+                                                      created_before,
+                                                      experiments_chunk_size):
+
+            writer.write_experiments(experiments)
+
+            number_of_experiments += len(experiments)
+
+            for experiment in experiments:
+
+                for trace_name, trace_chunks in generate_experiment_traces(sql_model_class,
+                                                                           experiment,
+                                                                           points_chunk_size):
+
+                    for steps, wall_times, values in trace_chunks:
+
+                        writer.write_trace_chunk(experiment['id'], trace_name, steps, wall_times, values)
+
+                        number_of_points += len(steps)
+
+                    writer.finish_trace(experiment['id'], trace_name)
+
+    finally:
+
+        writer.close()
+
+    return {'paths': writer.paths,
+            'number_of_experiments': number_of_experiments,
+            'number_of_points': number_of_points}
@@ -1,5 +1,8 @@
+from dash_deep.task import format_waiting_time
 
-def generate_table_from_future_objects(future_objects):
+
+
+def generate_table_from_future_objects(future_objects, queue_estimates=None):
     """Generates a table representation of provided concurrent.futures.Future
     objects.
     
@@ -11,6 +14,10 @@ def generate_table_from_future_objects(future_objects):
     future_object : list
         List of concurrent.futures.Future
     
+    queue_estimates : dict
+        Positions and waiting times of the queued tasks,
+        see TaskManager.get_queue_estimates().
+    
     Returns
     -------
     table : list
@@ -23,6 +30,16 @@ def generate_table_from_future_objects(future_objects):
         
         table_row = generate_table_row_from_future_object(future_object)
         table_row['id'] = index
+        
+        queue_estimate = (queue_estimates or {}).get(future_object)
+        
+        table_row['queue position'] = ''
+        table_row['estimated wait'] = ''
+        
+        if queue_estimate is not None:
+            
+            table_row['queue position'] = queue_estimate['position']
+            table_row['estimated wait'] = format_waiting_time(queue_estimate['estimated_wait'])
         table.append(table_row)
         
     
@@ -40,8 +57,8 @@ def generate_table_row_from_future_object(future_object):
     
     Parameters
     ----------
-    future_object : concurrent.futures.Future
-        Future object
+    future_object : dash_deep.task.ScheduledTask
+        Scheduled task that wraps the future object
     
     Returns
     -------
@@ -51,9 +68,13 @@ def generate_table_row_from_future_object(future_object):
     
     table_row_dict = {}
     
-    # TODO: since we use a non public attribute it might
-    # be changed in a future -- need to investigate more
-    table_row_dict['state'] = future_object._state
+    # Tasks that wait for a device are 'QUEUED', see task.ScheduledTask
+    table_row_dict['state'] = future_object.state
+    
+    table_row_dict['device'] = future_object.get_device_name()
+    
+    table_row_dict['priority'] = future_object.priority
+    table_row_dict['submitted by'] = future_object.submitted_by or ''
     
     table_row_dict['error traceback'] = 'None'
     
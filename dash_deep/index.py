@@ -1,4 +1,4 @@
-from dash_deep.app import app, scripts_db_models, server, task_manager
+from dash_deep.app import app, scripts_db_models, server, task_manager, inference_pool
 
 import dash
 import dash_core_components as dcc
@@ -71,5 +71,6 @@ if __name__ == '__main__':
     finally:
         
         task_manager.shutdown()
+        inference_pool.shutdown()
     
     
\ No newline at end of file
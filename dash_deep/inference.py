@@ -0,0 +1,448 @@
+from dash_deep.app import (models_save_folder_path,
+                           inference_pool_workers,
+                           inference_cache_max_models,
+                           inference_cache_max_memory_mb,
+                           inference_batch_size)
+
+import pebble
+
+import gc
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+def get_model_memory_size(model):
+    """Returns the number of bytes taken by the parameters and the buffers of a model.
+
+    Objects that are not pytorch modules are measured with sys.getsizeof().
+    """
+
+    if hasattr(model, 'parameters') and hasattr(model, 'buffers'):
+
+        tensors = list(model.parameters()) + list(model.buffers())
+
+        return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+    return sys.getsizeof(model)
+
+
+def get_experiment_key(sql_model_instance):
+    """Returns the key of the loaded model of an experiment in the ModelCache."""
+
+    return (sql_model_instance.__tablename__, sql_model_instance.id)
+
+
+def get_checkpoint_version(sql_model_instance):
+    """Returns the path of the checkpoint of an experiment and its modification time.
+
+    Checkpoints in the model store get a new path with every new best
+    checkpoint, the modification time covers the model files saved outside
+    of the store, which are overwritten in place.
+    """
+
+    model_path = sql_model_instance.model_path
+
+    absolute_model_path = os.path.join(models_save_folder_path, model_path)
+
+    modification_time = os.path.getmtime(absolute_model_path) if os.path.exists(absolute_model_path) else None
+
+    return (model_path, modification_time)
+
+
+class ModelCache(object):
+    """Keeps the recently used models loaded for the inference.
+
+    Models are evicted in least recently used order once there are more
+    than maximum_models of them or they take more than maximum_memory_mb
+    megabytes (see get_model_memory_size()). The models are evicted before
+    a new one is loaded, so that the memory of the new model, estimated by
+    the previous model of the experiment or the largest loaded model, fits
+    the limit together with the kept ones. The model that was loaded last
+    is kept even if it alone exceeds the memory limit.
+
+    Each experiment has at most one cached model, the model of an older
+    checkpoint is replaced once the experiment saves a new one.
+
+    Each worker of the InferencePool has its own cache.
+
+    """
+
+    def __init__(self, maximum_models=inference_cache_max_models, maximum_memory_mb=inference_cache_max_memory_mb):
+
+        self.maximum_models = maximum_models
+        self.maximum_memory_size = maximum_memory_mb * 1024 * 1024
+
+        # Maps experiment key into the model, the version of its checkpoint and its size in bytes
+        self.entries = OrderedDict()
+
+        self.memory_size = 0
+
+        # Size of the largest loaded model, the expected size of a model
+        # of an experiment that wasn't loaded before
+        self.largest_model_size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
+
+
+    def get_model(self, key, checkpoint_version, load_model):
+        """Returns the cached model or loads it.
+
+        Parameters
+        ----------
+        key : tuple
+            See get_experiment_key().
+
+        checkpoint_version : tuple
+            See get_checkpoint_version(). The cached model of an
+            other version of the checkpoint is replaced.
+
+        load_model : function
+            Function without arguments that loads the model.
+
+        Returns
+        -------
+        model : object
+            Loaded model.
+
+        is_hit : bool
+            Whether the model was taken from the cache.
+        """
+
+        with self.lock:
+
+            entry = self.entries.pop(key, None)
+
+            if entry is not None and entry['checkpoint_version'] == checkpoint_version:
+
+                self.entries[key] = entry
+                self.hits += 1
+
+                return entry['model'], True
+
+            self.misses += 1
+
+            expected_size = self.largest_model_size
+
+            # Model of the older checkpoint of the experiment is not used anymore,
+            # the local reference is dropped so that its memory is freed before loading
+            if entry is not None:
+
+                expected_size = entry['size']
+
+                self.entries[key] = entry
+
+                del entry
+
+                self.remove(key)
+
+            self.evict(self.maximum_models - 1, self.maximum_memory_size - expected_size)
+
+        self.release_memory()
+
+        # Loaded outside of the lock, so that the statistics and the
+        # cached models of the other experiments stay available
+        model = load_model()
+
+        size = get_model_memory_size(model)
+
+        with self.lock:
+
+            # The model could be loaded by another thread meanwhile
+            if key in self.entries:
+
+                self.remove(key)
+
+            self.entries[key] = {'model': model, 'checkpoint_version': checkpoint_version, 'size': size}
+            self.memory_size += size
+
+            self.largest_model_size = max(self.largest_model_size, size)
+
+            self.evict(self.maximum_models, self.maximum_memory_size, key)
+
+        self.release_memory()
+
+        return model, False
+
+
+    def evict(self, maximum_models, maximum_memory_size, kept_key=None):
+        """Removes the least recently used models until there are at most
+        maximum_models of them that take at most maximum_memory_size bytes.
+
+        The model of kept_key is never removed.
+        """
+
+        while self.entries and (len(self.entries) > maximum_models or
+                                self.memory_size > maximum_memory_size):
+
+            key = next(iter(self.entries))
+
+            if key == kept_key:
+
+                break
+
+            self.remove(key)
+
+
+    def remove(self, key):
+        """Removes the model of a key, see release_memory().
+
+        The entry drops its model as well, so that the references to
+        the entry held by the callers don't keep the model alive.
+        """
+
+        entry = self.entries.pop(key)
+
+        self.memory_size -= entry['size']
+        self.evictions += 1
+
+        entry['model'] = None
+
+
+    def release_memory(self):
+        """Returns the memory of the removed models to the gpu,
+        pytorch keeps it reserved for itself otherwise."""
+
+        if 'torch' not in sys.modules:
+
+            return
+
+        torch = sys.modules['torch']
+
+        if torch.cuda.is_available():
+
+            # Models with reference cycles are freed only by the collector
+            gc.collect()
+
+            torch.cuda.empty_cache()
+
+
+    def get_stats(self):
+
+        with self.lock:
+
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'number_of_models': len(self.entries),
+                    'memory_size': self.memory_size}
+
+
+# Cache of the worker process of the inference pool, every worker
+# starts with an empty copy of it
+worker_model_cache = ModelCache()
+
+
+def run_cached_inference(inference, load_model, batch_inference, sql_model_instance, input_batch):
+    """Runs the inference of a batch of inputs in a worker of the inference pool.
+
+    Parameters
+    ----------
+    inference, load_model, batch_inference : function
+        Actions of the model class of the experiment, see InferencePool.
+        load_model and batch_inference can be None.
+
+    sql_model_instance : sqlalchemy model instance
+        Detached experiment.
+
+    input_batch : list
+        Inputs of the inference.
+
+    Returns
+    -------
+    results : list
+        Results of the inference of the respective inputs.
+
+    worker_stats : dict
+        Statistics of the cache of the worker, see ModelCache.get_stats(),
+        with the 'pid' of the worker and whether the model was a 'hit'.
+        None if the model class doesn't cache its models.
+    """
+
+    if load_model is None:
+
+        return [inference(sql_model_instance, input_data) for input_data in input_batch], None
+
+    model, is_hit = worker_model_cache.get_model(get_experiment_key(sql_model_instance),
+                                                 get_checkpoint_version(sql_model_instance),
+                                                 lambda: load_model(sql_model_instance))
+
+    if batch_inference is not None:
+
+        results = list(batch_inference(sql_model_instance, input_batch, model))
+
+    else:
+
+        results = [inference(sql_model_instance, input_data, model) for input_data in input_batch]
+
+    worker_stats = worker_model_cache.get_stats()
+    worker_stats['pid'] = os.getpid()
+    worker_stats['hit'] = is_hit
+
+    return results, worker_stats
+
+
+class InferencePool(object):
+    """Runs the inference of the experiments in long-lived processes.
+
+    Unlike the pool of the task manager, the workers are not restarted
+    after each task, so that pytorch, the scripts and the recently used
+    models stay loaded between the requests. Models of the experiments
+    whose model classes have a 'load_model' action are cached by the
+    workers (see ModelCache), the 'inference' action then receives the
+    loaded model as the third argument. Model classes without it run the
+    'inference' action as before.
+
+    Inputs are sent to the workers in batches of up to batch_size, the
+    optional 'batch_inference' action receives the whole batch and the
+    loaded model at once, 'inference' is called for each input otherwise.
+    Batches of different experiments run concurrently on different workers.
+
+    """
+
+    def __init__(self, workers=inference_pool_workers, batch_size=inference_batch_size):
+
+        self.process_pool = pebble.ProcessPool(max_workers=workers)
+
+        self.batch_size = batch_size
+
+        # Maps pid of a worker into the last statistics of its cache
+        self.worker_stats = {}
+
+        self.lock = threading.Lock()
+
+
+    def schedule(self, sql_model_class, sql_model_instance, inputs, timeout=None):
+        """Schedules the inference of an experiment on a list of inputs.
+
+        Parameters
+        ----------
+        sql_model_class : sqlalchemy model class
+            Model class with the 'inference' action.
+
+        sql_model_instance : sqlalchemy model instance
+            Detached experiment.
+
+        inputs : list
+            Inputs of the inference, like images as numpy arrays.
+
+        timeout : float
+            Optional seconds after which the worker running a batch is
+            stopped (and restarted by the pool), so that a hung worker
+            doesn't keep the batch forever.
+
+        Returns
+        -------
+        futures : list
+            Future objects of the batches, see get_results().
+        """
+
+        actions = sql_model_class.actions
+
+        return [self.process_pool.schedule(run_cached_inference,
+                                           args=(actions['inference'],
+                                                 actions.get('load_model'),
+                                                 actions.get('batch_inference'),
+                                                 sql_model_instance,
+                                                 inputs[batch_start:batch_start + self.batch_size]),
+                                           timeout=timeout)
+                for batch_start in range(0, len(inputs), self.batch_size)]
+
+
+    def get_results(self, futures, timeout=None):
+        """Waits for the batches scheduled by schedule().
+
+        Parameters
+        ----------
+        futures : list
+            See schedule().
+
+        timeout : float
+            Optional seconds to wait for all the batches. The batches that
+            are not finished by then are cancelled and
+            concurrent.futures.TimeoutError is raised.
+
+        Returns
+        -------
+        results : list
+            Results of the inference of the respective inputs.
+
+        is_hit : bool
+            Whether the model was already loaded for all the batches,
+            None if the model class doesn't cache its models.
+        """
+
+        results = []
+        hits = []
+
+        deadline = None if timeout is None else time.time() + timeout
+
+        for future in futures:
+
+            try:
+
+                batch_results, worker_stats = future.result(None if deadline is None else max(deadline - time.time(), 0))
+
+            except Exception:
+
+                # The rest of the batches are not needed anymore
+                for scheduled_future in futures:
+
+                    scheduled_future.cancel()
+
+                raise
+
+            results.extend(batch_results)
+
+            if worker_stats is None:
+
+                continue
+
+            hits.append(worker_stats['hit'])
+
+            with self.lock:
+
+                self.worker_stats[worker_stats['pid']] = worker_stats
+
+        return results, (all(hits) if hits else None)
+
+
+    def run(self, sql_model_class, sql_model_instance, input_data):
+        """Runs the inference of an experiment on one input and waits for the result.
+
+        Returns
+        -------
+        result : object
+            Result of the inference.
+
+        is_hit : bool
+            See get_results().
+        """
+
+        results, is_hit = self.get_results(self.schedule(sql_model_class, sql_model_instance, [input_data]))
+
+        return results[0], is_hit
+
+    def get_stats(self):
+        """Returns the statistics of the caches of all the workers summed up."""
+
+        with self.lock:
+
+            worker_stats = list(self.worker_stats.values())
+
+        return dict((name, sum(stats[name] for stats in worker_stats))
+                    for name in ['hits', 'misses', 'evictions', 'number_of_models', 'memory_size'])
+
+
+    def shutdown(self):
+        """Stops the workers, see TaskManager.shutdown()."""
+
+        self.process_pool.stop()
+
+        self.process_pool.join()
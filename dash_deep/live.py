@@ -0,0 +1,207 @@
+from dash_deep.app import plot_points_per_trace, live_plot_cache_size
+from dash_deep.metrics import load_experiment_traces, get_next_trace_steps
+from dash_deep.rollups import load_experiment_traces_at_resolution
+from dash_deep.plot import get_graph_layout_template, get_trace_step_ranges, get_experiment_cache_key
+from dash_deep.smoothing import get_plotted_trace_names
+
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Upper bound of step ranges that are open on the right
+MAX_STEP = 2 ** 62
+
+
+class LiveTraceCache(object):
+    """Keeps the plotted traces of recently displayed experiments in memory.
+
+    The plots page is updated every second. Instead of reloading the
+    traces of all the selected experiments on every update, the cache
+    remembers the last step it has for each trace and fetches only the
+    points that were reported after it, so an update of a running experiment
+    costs O(new points) and an update of a finished one costs a single indexed
+    query. Traces are reloaded from the rollups once the appended points
+    exceed the points budget, so the cached traces stay bounded. Smoothed
+    copies of the traces are cached as well, so that switching the smoothing
+    on the plots page doesn't load anything.
+
+    Entries are evicted in least recently used order. The cache is shared
+    by all the clients and is guarded by a lock, since flask serves
+    callbacks from multiple threads.
+
+    """
+
+    def __init__(self, maximum_size=live_plot_cache_size, number_of_points=plot_points_per_trace):
+
+        self.maximum_size = maximum_size
+        self.number_of_points = number_of_points
+
+        # Maps experiment key (see plot.get_experiment_cache_key()) into a dict with
+        # the step ranges that the traces were loaded for, loaded traces and last steps
+        self.entries = OrderedDict()
+
+        self.lock = threading.Lock()
+
+
+    def get_trace_step_ranges_key(self, sql_model_instance, axis_ranges):
+
+        layout_template = get_graph_layout_template(sql_model_instance.__class__)
+
+        trace_step_ranges = get_trace_step_ranges(layout_template, axis_ranges)
+
+        return trace_step_ranges, json.dumps(sorted(trace_step_ranges.items()))
+
+
+    def load_entry(self, sql_model_instance, trace_step_ranges, trace_step_ranges_key):
+
+        # Read before the traces, so that the points reported while the traces
+        # are loaded are fetched by the next update of the zoomed traces
+        last_steps = dict((trace_name, next_step - 1) for trace_name, next_step
+                          in get_next_trace_steps(sql_model_instance).items())
+
+        traces = load_experiment_traces_at_resolution(sql_model_instance,
+                                                      self.number_of_points,
+                                                      trace_step_ranges,
+                                                      get_plotted_trace_names(sql_model_instance))
+
+        # The last steps of the whole traces are taken from the loaded points
+        # themselves, the points reported after the traces were read
+        # are appended by update() and can't be skipped
+        for trace_name, (steps, values) in traces.items():
+
+            if trace_name not in trace_step_ranges:
+
+                last_steps[trace_name] = int(steps.max())
+
+        return {'trace_step_ranges_key': trace_step_ranges_key,
+                'trace_step_ranges': trace_step_ranges,
+                'traces': traces,
+                'last_steps': last_steps}
+
+
+    def store_entry(self, key, entry):
+
+        self.entries[key] = entry
+
+        while len(self.entries) > self.maximum_size:
+
+            self.entries.popitem(last=False)
+
+
+    def get_entry(self, sql_model_instance, axis_ranges):
+        """Returns the cached entry of an experiment, loads it if the
+        experiment is not cached or was cached for different zoom."""
+
+        key = get_experiment_cache_key(sql_model_instance)
+
+        trace_step_ranges, trace_step_ranges_key = self.get_trace_step_ranges_key(sql_model_instance,
+                                                                                  axis_ranges)
+
+        with self.lock:
+
+            entry = self.entries.pop(key, None)
+
+        if entry is not None and entry['trace_step_ranges_key'] == trace_step_ranges_key:
+
+            with self.lock:
+
+                self.store_entry(key, entry)
+
+            return entry, False
+
+        entry = self.load_entry(sql_model_instance, trace_step_ranges, trace_step_ranges_key)
+
+        with self.lock:
+
+            self.store_entry(key, entry)
+
+        return entry, True
+
+
+    def update(self, sql_model_instance, axis_ranges=None):
+        """Appends the points reported since the last update to the cached traces.
+
+        Parameters
+        ----------
+        sql_model_instance : sqlalchemy model instance
+            Displayed experiment.
+
+        axis_ranges : dict
+            Optional zoomed axis ranges, see plot.get_axis_ranges_from_relayout_data().
+            Zoomed traces show a fixed window, so new points are not
+            appended to them.
+
+        Returns
+        -------
+        last_steps : dict
+            Dict that maps trace name into the last step of the trace.
+        """
+
+        entry, just_loaded = self.get_entry(sql_model_instance, axis_ranges)
+
+        if just_loaded:
+
+            return dict(entry['last_steps'])
+
+        last_steps = dict(entry['last_steps'])
+
+        new_point_ranges = dict((trace_name, (last_steps.get(trace_name, -1) + 1, MAX_STEP))
+                                for trace_name in get_plotted_trace_names(sql_model_instance))
+
+        new_traces = load_experiment_traces(sql_model_instance, new_point_ranges)
+
+        if not new_traces:
+
+            return dict(last_steps)
+
+        traces = dict(entry['traces'])
+
+        for trace_name, (new_steps, new_values) in new_traces.items():
+
+            last_steps[trace_name] = new_steps[-1]
+
+            if trace_name in entry['trace_step_ranges']:
+
+                continue
+
+            steps, values = traces.get(trace_name, ([], []))
+
+            traces[trace_name] = (np.concatenate((steps, new_steps)).astype(np.int64),
+                                  np.concatenate((values, new_values)).astype(np.float64))
+
+        # The appended raw points are downsampled on every update, the trace
+        # is reloaded at a coarser resolution once they don't fit the budget
+        if any(len(steps) > 2 * self.number_of_points for steps, values in traces.values()):
+
+            entry = self.load_entry(sql_model_instance,
+                                    entry['trace_step_ranges'],
+                                    entry['trace_step_ranges_key'])
+        else:
+
+            entry = dict(entry, traces=traces, last_steps=last_steps)
+
+        with self.lock:
+
+            self.store_entry(get_experiment_cache_key(sql_model_instance), entry)
+
+        return dict(entry['last_steps'])
+
+
+    def get_traces(self, sql_model_instance, axis_ranges=None):
+        """Returns the cached traces of an experiment.
+
+        Returns
+        -------
+        traces : dict
+            See rollups.load_experiment_traces_at_resolution().
+        """
+
+        entry, _ = self.get_entry(sql_model_instance, axis_ranges)
+
+        return entry['traces']
+
+
+live_trace_cache = LiveTraceCache()
@@ -1,9 +1,21 @@
 from dash_deep.app import db
 from dash_deep.app import models_save_folder_path
+from dash_deep.app import checkpoints_keep_top_k
 from dash_deep.utils import generate_model_save_file_path
+from dash_deep.metrics import (insert_metric_points,
+                               get_next_trace_steps,
+                               create_version_bump_statement,
+                               BufferedMetricWriter)
+from dash_deep.rollups import (MetricRollupBuilder,
+                               seed_metric_rollup_builder,
+                               metric_rollups_insert_statement)
+from dash_deep.smoothing import TraceSmoother, seed_trace_smoother, create_smoothed_metric_points
+from dash_deep.archive import restore_experiment
+from dash_deep.checkpoints import CheckpointWriter
 
 import os
-from sqlalchemy.orm.attributes import flag_modified
+import time
+import signal
 
 
 
@@ -13,9 +25,23 @@ class Experiment():
     process. It also provides methods to easily append new values to the
     graph and update the current best results.
     
+    In the buffered mode the results are handed over to a background
+    writer thread and the training loop doesn't wait for the database.
+    Buffered results are flushed by finish(), when the experiment is used
+    as a context manager and an exception is raised and when the process
+    is cancelled from the tasks page (SIGTERM).
+    
+    Checkpoints saved with save_checkpoint() are always written from
+    a background thread, finish() waits until they are written.
+    
     """
     
-    def __init__(self, sql_model_instance):
+    def __init__(self, sql_model_instance,
+                 buffered=False,
+                 flush_every_n_points=100,
+                 flush_interval_ms=1000,
+                 keep_top_k_checkpoints=checkpoints_keep_top_k,
+                 higher_score_is_better=True):
         """Initializes the new experiment instance from a populated
         sql alchemy model instance which is being provided to a function
         specified by user in the models.py module. The sql alchemy model
@@ -25,6 +51,24 @@ class Experiment():
         ----------
         sql_model_instance : sql alchemy model instance
             Sql alchemy model instace from models.py module.
+        
+        buffered : bool
+            Whether to write the results from a background thread.
+        
+        flush_every_n_points : int
+            Number of buffered metric points that triggers a write. Only
+            used in the buffered mode.
+        
+        flush_interval_ms : int
+            Maximum time that a buffered result waits before being written.
+            Only used in the buffered mode.
+        
+        keep_top_k_checkpoints : int
+            Number of checkpoints with the best scores that are kept
+            by save_checkpoint() in addition to the latest one.
+        
+        higher_score_is_better : bool
+            Direction of the scores of the checkpoints.
         """
         
         #self.sql_model_instance = sql_model_instance
@@ -40,6 +84,10 @@ class Experiment():
         # Each process usually has its own session and we attach this object to it.
         self.sql_model_instance = self.db.session.merge(sql_model_instance)
         
+        # Values of a resumed archived experiment are moved back
+        # into the database, so that the reporting continues from them
+        restore_experiment(self.sql_model_instance)
+        
         # Generating unique model save path for current experiment
         self.relative_model_file_save_path = generate_model_save_file_path(sql_model_instance)
         
@@ -48,6 +96,138 @@ class Experiment():
         
         self.best_model_file_saved_at_least_once = False
         
+        self.keep_top_k_checkpoints = keep_top_k_checkpoints
+        self.higher_score_is_better = higher_score_is_better
+        
+        # Created by the first save_checkpoint(), when the experiment has an id
+        self.checkpoint_writer = None
+        
+        # Step that the next reported value of each trace will get -- we
+        # continue the numeration in case the experiment already has some values
+        self.trace_next_steps = get_next_trace_steps(self.sql_model_instance)
+        
+        self.metric_rollup_builder = None
+        self.create_metric_rollup_builder()
+        
+        self.trace_smoother = None
+        self.create_trace_smoother()
+        
+        self.metric_writer = None
+        
+        # SIGTERM handler that was installed before the one of
+        # the experiment, see install_cancellation_handler()
+        self.previous_sigterm_handler = None
+        self.cancellation_handler_installed = False
+        
+        if buffered:
+            
+            self.metric_writer = BufferedMetricWriter(flush_every_n_points=flush_every_n_points,
+                                                      flush_interval_ms=flush_interval_ms)
+            
+            self.install_cancellation_handler()
+    
+    
+    def __enter__(self):
+        
+        return self
+    
+    
+    def __exit__(self, exception_type, exception_value, traceback):
+        
+        # Flushing the buffered results even if the script has failed,
+        # the exception itself is propagated further
+        self.finish()
+        
+        return False
+    
+    
+    def install_cancellation_handler(self):
+        """Flushes the buffered results when the process is being terminated.
+        
+        Cancelling a task on the tasks page terminates its process with SIGTERM.
+        The handler only raises SystemExit in the main thread, the buffered
+        results and the pending checkpoints are then flushed by __exit__()
+        (and finish()) on the normal path. Flushing from the handler itself
+        could deadlock, since the signal can arrive while the main thread
+        holds the lock of the queue of a writer. The previous handler is
+        restored by finish().
+        """
+        
+        def raise_system_exit(signal_number, frame):
+            
+            # Terminating the process again shouldn't interrupt the flushing
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            
+            raise SystemExit('The experiment was cancelled')
+        
+        try:
+            self.previous_sigterm_handler = signal.signal(signal.SIGTERM, raise_system_exit)
+            self.cancellation_handler_installed = True
+            
+        except ValueError:
+            
+            # Signal handlers can only be installed from the main thread,
+            # in this case the results are flushed by finish() only
+            pass
+    
+    
+    def restore_cancellation_handler(self):
+        
+        if not self.cancellation_handler_installed:
+            
+            return
+        
+        try:
+            # None means that the previous handler wasn't installed from python
+            signal.signal(signal.SIGTERM, self.previous_sigterm_handler or signal.SIG_DFL)
+            
+        except ValueError:
+            
+            # finish() was called from another thread
+            return
+        
+        self.cancellation_handler_installed = False
+    
+    
+    def create_metric_rollup_builder(self):
+        """Creates the builder of the rollups of the traces.
+        
+        The experiment might not have an id before it is started, in this
+        case the builder is created by start(). If the experiment is resumed,
+        the open buckets are restored from its already reported values.
+        """
+        
+        if self.sql_model_instance.id is None:
+            
+            return
+        
+        self.metric_rollup_builder = MetricRollupBuilder(self.sql_model_instance.__tablename__,
+                                                         self.sql_model_instance.id)
+        
+        if self.trace_next_steps:
+            
+            seed_metric_rollup_builder(self.metric_rollup_builder,
+                                       self.sql_model_instance,
+                                       self.trace_next_steps)
+    
+    
+    def create_trace_smoother(self):
+        """Creates the smoother of the traces (see dash_deep/smoothing.py).
+        
+        Smoothed copies of the traces are written together with the reported
+        values, so that the plots page doesn't smooth the traces on every
+        update. If the experiment is resumed, the smoothing continues from
+        the already reported values.
+        """
+        
+        self.trace_smoother = TraceSmoother()
+        
+        if self.trace_next_steps:
+            
+            seed_trace_smoother(self.trace_smoother,
+                                self.sql_model_instance,
+                                self.trace_next_steps)
+    
     
     def start(self):
         """Starts the experiment.
@@ -59,6 +239,10 @@ class Experiment():
         self.db.session.add(self.sql_model_instance)
         self.db.session.commit()
         
+        self.trace_next_steps = get_next_trace_steps(self.sql_model_instance)
+        self.create_metric_rollup_builder()
+        self.create_trace_smoother()
+        
         
     def add_next_iteration_results(self, *args, **kwargs):
         """Adds new values to populate the graph of the experiment with.
@@ -72,18 +256,92 @@ class Experiment():
             to the traces of the graph of the experiment.
         """
         
-        # Passing all the parameters to the graph object
-        # which upates the internal state of the graph
-        self.sql_model_instance.graphs.add_next_iteration_results(*args, **kwargs)
+        # Each reported value becomes a separate row of the metric points
+        # table, so reporting costs a small insert no matter how many values
+        # the experiment already has.
+        metric_points = self.create_metric_points(**kwargs)
         
-        # Since we pickle this field -- we need to explicitly tell that
-        # the field was updated, otherwise the changes won't be commited
-        flag_modified(self.sql_model_instance, 'graphs')
+        # Rollups of the completed buckets are written together with the
+        # points, so that the plots of long runs never aggregate raw points
+        metric_rollups = []
+        
+        if self.metric_rollup_builder:
+            
+            metric_rollups = self.metric_rollup_builder.add_metric_points(metric_points)
+        
+        if self.metric_writer:
+            
+            self.metric_writer.add_metric_points(metric_points)
+            
+            if metric_rollups:
+                
+                self.metric_writer.insert_rows(metric_rollups_insert_statement, metric_rollups)
+            
+            return
+        
+        insert_metric_points(self.db.session, metric_points)
+        
+        if metric_rollups:
+            
+            self.db.session.execute(metric_rollups_insert_statement, metric_rollups)
+        
+        if metric_points:
+            
+            self.db.session.execute(create_version_bump_statement(self.sql_model_instance.__tablename__,
+                                                                  self.sql_model_instance.id))
         
-        self.db.session.add(self.sql_model_instance)
         self.db.session.commit()
     
     
+    def create_metric_points(self, **kwargs):
+        """Converts reported values into rows of the metric points table
+        and advances the step counters of respective traces. Rows of the
+        smoothed copies of the values are added after each value.
+    
+        Parameters
+        ----------
+        kwargs : Named arguments
+            Named arguments representing new values of the traces.
+        
+        Returns
+        -------
+        metric_points : list of dicts
+            Rows to be inserted into the metric points table.
+        """
+        
+        column_names = self.sql_model_instance.graphs.graph_column_names
+        
+        wall_time = time.time()
+        
+        metric_points = []
+        
+        for trace_name, trace_value_to_append in kwargs.items():
+            
+            if trace_name not in column_names:
+                
+                raise KeyError('Trace {} is not defined in the graph definition'.format(trace_name))
+            
+            step = self.trace_next_steps.get(trace_name, 0)
+            self.trace_next_steps[trace_name] = step + 1
+            
+            # Converting to float explicitly, since users often report
+            # numpy scalars or one element arrays
+            metric_point = {'experiment_table': self.sql_model_instance.__tablename__,
+                            'experiment_id': self.sql_model_instance.id,
+                            'trace_name': trace_name,
+                            'step': step,
+                            'wall_time': wall_time,
+                            'value': float(trace_value_to_append)}
+            
+            metric_points.append(metric_point)
+            
+            # Smoothed copies get the same step, so they are
+            # written, rolled up and pushed together with the value
+            metric_points.extend(create_smoothed_metric_points(self.trace_smoother, metric_point))
+        
+        return metric_points
+    
+    
     def update_best_iteration_results(self, **kwargs):
         """Updates values of the best results of trace
         values so far. Named arguments are equivalent to
@@ -98,16 +356,45 @@ class Experiment():
         
         column_names = self.sql_model_instance.graphs.graph_column_names
         
-        for key, value in kwargs.iteritems():
+        best_values = {}
+        
+        for key, value in kwargs.items():
             
             if key in column_names:
                 
-                setattr(self.sql_model_instance, key, value)
+                best_values[key] = float(value)
+                setattr(self.sql_model_instance, key, best_values[key])
+        
+        if self.metric_writer:
+            
+            # Goes through the same queue as the metric points,
+            # so that the updates are written in the reported order
+            self.metric_writer.update_experiment(self.sql_model_instance.__class__,
+                                                 self.sql_model_instance.id,
+                                                 best_values)
+            
+            return
+        
+        self.bump_version()
         
         self.db.session.add(self.sql_model_instance)
         self.db.session.commit()
     
     
+    def bump_version(self):
+        """Increments the version of the experiment on the next commit.
+        
+        The increment is performed by the database, so that it doesn't
+        overwrite the increments made by the buffered writer.
+        """
+        
+        if self.sql_model_instance.id is None:
+            
+            return
+        
+        self.sql_model_instance.version = self.sql_model_instance.__class__.version + 1
+    
+    
     def get_best_model_file_save_path(self):
         """Returns the path to save the best performing model currently discovered.
         
@@ -140,6 +427,7 @@ class Experiment():
         # update the model with respective path
         
         self.sql_model_instance.model_path = self.relative_model_file_save_path
+        self.bump_version()
         
         self.db.session.add(self.sql_model_instance)
         self.db.session.commit()
@@ -151,6 +439,67 @@ class Experiment():
         return self.absolute_model_file_save_path
         
 
+    def save_checkpoint(self, state_dict, score=None):
+        """Saves a checkpoint of the model without stopping the training.
+        
+        The tensors are copied to the cpu before returning, the copy is
+        written by a background thread into the model store (see
+        dash_deep/model_store.py), where the tensors equal to the ones of
+        other checkpoints are stored once. Only the keep_top_k_checkpoints
+        checkpoints with the best scores and the latest one are kept. Paths,
+        scores and sizes of the kept checkpoints are recorded in the
+        checkpoints column and the model_path column points to the best
+        one, load it with model_store.load_checkpoint().
+        
+        Errors of the background thread are raised by the next call
+        to save_checkpoint() or by finish().
+    
+        Parameters
+        ----------
+        state_dict : dict
+            State dict of the model, can also be a dict that holds the
+            state dicts of the model and of the optimizer.
+        
+        score : float
+            Score of the checkpoint, for example, the validation accuracy.
+        
+        Returns
+        ----------
+        number : int
+            Number of the checkpoint in the checkpoints column.
+        """
+        
+        if self.checkpoint_writer is None:
+            
+            # The experiment should have an id to record the checkpoints
+            if self.sql_model_instance.id is None:
+                
+                self.start()
+            
+            self.checkpoint_writer = CheckpointWriter(self.sql_model_instance,
+                                                      keep_top_k=self.keep_top_k_checkpoints,
+                                                      higher_score_is_better=self.higher_score_is_better)
+        
+        return self.checkpoint_writer.save(state_dict, score)
+    
+    
+    def get_writer_statistics(self):
+        """Returns the counters of the buffered writer.
+        
+        Returns
+        -------
+        statistics : dict or None
+            See BufferedMetricWriter.get_statistics(). None if
+            the experiment is not buffered.
+        """
+        
+        if not self.metric_writer:
+            
+            return None
+        
+        return self.metric_writer.get_statistics()
+    
+
     def finish(self):
         
         # TODO: add additional field to the models -- finished
@@ -158,6 +507,26 @@ class Experiment():
         
         # Should we close the db session?
         
+        try:
+            
+            if self.checkpoint_writer:
+                
+                self.checkpoint_writer.close()
+            
+        finally:
+            
+            try:
+                
+                if self.metric_writer:
+                    
+                    self.metric_writer.close()
+                
+            finally:
+                
+                self.restore_cancellation_handler()
+        
+        self.bump_version()
+        
         self.db.session.add(self.sql_model_instance)
         self.db.session.commit()
         
@@ -0,0 +1,591 @@
+from dash_deep.app import db
+
+import calendar
+import threading
+import time
+from sqlalchemy.orm.attributes import flag_modified
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class MetricPoint(db.Model):
+    """Single reported value of a trace of an experiment.
+
+    Each call to Experiment.add_next_iteration_results() results in one
+    small insert per reported trace into this table instead of rewriting
+    the whole pickled graph of the experiment. Since experiment ids are only
+    unique inside of the table of each experiment type, we also store the name
+    of the experiment table.
+
+    """
+
+    __tablename__ = 'metric_points'
+
+    id = db.Column(db.Integer, primary_key=True)
+    experiment_table = db.Column(db.String(120), nullable=False)
+    experiment_id = db.Column(db.Integer, nullable=False)
+    trace_name = db.Column(db.String(120), nullable=False)
+    step = db.Column(db.Integer, nullable=False)
+    wall_time = db.Column(db.Float, nullable=False)
+    value = db.Column(db.Float, nullable=False)
+
+    # All the reads are performed for a specific trace of a specific experiment
+    # and are ordered by step, so a single composite index covers them all
+    __table_args__ = (db.Index('ix_metric_points_experiment_trace_step',
+                               'experiment_table',
+                               'experiment_id',
+                               'trace_name',
+                               'step'),)
+
+
+metric_points_insert_statement = MetricPoint.__table__.insert()
+
+
+def insert_metric_points(connection, metric_points):
+    """Inserts metric points into the database with a single executemany call.
+
+    The insert is not commited -- it's up to the caller to do it. This way
+    the function can be used both with a session and with a plain engine
+    connection.
+
+    Parameters
+    ----------
+    connection : sqlalchemy session or connection
+        Object that has an .execute() method.
+
+    metric_points : list of dicts
+        List of dicts with keys equal to the columns of MetricPoint table
+        (except for the id).
+    """
+
+    if not metric_points:
+
+        return
+
+    connection.execute(metric_points_insert_statement, metric_points)
+
+
+def create_version_bump_statement(experiment_table, experiment_id):
+    """Creates a statement that increments the version of an experiment.
+
+    Parameters
+    ----------
+    experiment_table : string
+        Name of the table of the experiment.
+
+    experiment_id : int
+        Id of the experiment.
+
+    Returns
+    -------
+    statement : sqlalchemy update statement
+        Statement to execute.
+    """
+
+    table = db.metadata.tables[experiment_table]
+
+    return table.update().where(table.c.id == experiment_id).values(version=table.c.version + 1)
+
+
+def get_experiment_metric_points_query(sql_model_instance):
+    """Creates a query for all the metric points of an experiment.
+
+    Parameters
+    ----------
+    sql_model_instance : sqlalchemy model instance
+        Experiment to get metric points of.
+
+    Returns
+    -------
+    query : sqlalchemy query
+        Query that is filtered by the experiment.
+    """
+
+    return MetricPoint.query.filter(MetricPoint.experiment_table == sql_model_instance.__tablename__,
+                                    MetricPoint.experiment_id == sql_model_instance.id)
+
+
+def get_next_trace_steps(sql_model_instance):
+    """Returns the step that the next reported value of each trace should get.
+
+    Used to continue the numeration of steps in case an experiment
+    is restarted or was migrated from the pickled graph representation.
+
+    Parameters
+    ----------
+    sql_model_instance : sqlalchemy model instance
+        Experiment to get the steps for.
+
+    Returns
+    -------
+    next_trace_steps : dict
+        Dict that maps trace name into the next step. Traces without
+        any points are absent.
+    """
+
+    if sql_model_instance.id is None:
+
+        return {}
+
+    query = db.session.query(MetricPoint.trace_name,
+                             db.func.max(MetricPoint.step))
+
+    query = query.filter(MetricPoint.experiment_table == sql_model_instance.__tablename__,
+                         MetricPoint.experiment_id == sql_model_instance.id)
+
+    query = query.group_by(MetricPoint.trace_name)
+
+    next_trace_steps = dict((trace_name, max_step + 1) for trace_name, max_step in query)
+
+    return next_trace_steps
+
+
+def load_experiment_traces(sql_model_instance, trace_step_ranges=None):
+    """Loads the traces of an experiment from the metric points table.
+
+    Parameters
+    ----------
+    sql_model_instance : sqlalchemy model instance
+        Experiment to load the traces of.
+
+    trace_step_ranges : dict
+        Optional dict that maps trace name into (first step, last step)
+        pair. Only points inside of the range are loaded for these traces.
+
+    Returns
+    -------
+    traces : dict
+        Dict that maps trace name into (steps, values) pair of lists.
+    """
+
+    query = db.session.query(MetricPoint.trace_name,
+                             MetricPoint.step,
+                             MetricPoint.value)
+
+    query = query.filter(MetricPoint.experiment_table == sql_model_instance.__tablename__,
+                         MetricPoint.experiment_id == sql_model_instance.id)
+
+    if trace_step_ranges:
+
+        # Traces with a range are restricted to it, the rest are loaded fully
+        trace_conditions = [MetricPoint.trace_name.notin_(list(trace_step_ranges.keys()))]
+
+        for trace_name, (first_step, last_step) in trace_step_ranges.items():
+
+            trace_conditions.append(db.and_(MetricPoint.trace_name == trace_name,
+                                            MetricPoint.step >= first_step,
+                                            MetricPoint.step <= last_step))
+
+        query = query.filter(db.or_(*trace_conditions))
+
+    query = query.order_by(MetricPoint.trace_name, MetricPoint.step)
+
+    traces = {}
+
+    for trace_name, step, value in query:
+
+        steps, values = traces.setdefault(trace_name, ([], []))
+        steps.append(step)
+        values.append(value)
+
+    return traces
+
+
+def migrate_graphs_to_metric_points(sql_model_class):
+    """Moves values stored in the pickled graphs of experiments into the
+    metric points table.
+
+    Experiments that were recorded before the metric points table existed
+    store all their values inside of the pickled BaseGraph. This function
+    inserts these values into the metric points table and empties the traces of
+    the pickled graph, so that the row doesn't carry them anymore. Experiments
+    that already have metric points are only emptied, so running the migration
+    twice doesn't duplicate the values.
+
+    Parameters
+    ----------
+    sql_model_class : sqlalchemy model class
+        Class of experiments to migrate.
+
+    Returns
+    -------
+    number_of_migrated_experiments : int
+        Number of experiments which had values in their pickled graphs.
+    """
+
+    if not db.engine.has_table(sql_model_class.__tablename__):
+
+        return 0
+
+    number_of_migrated_experiments = 0
+
+    for sql_model_instance in sql_model_class.query.all():
+
+        graphs = sql_model_instance.graphs
+
+        if graphs is None or not graphs.has_values():
+
+            continue
+
+        already_migrated = get_experiment_metric_points_query(sql_model_instance).count() > 0
+
+        if not already_migrated:
+
+            # Pickled graphs don't have the time of reporting, so we
+            # use the creation time of the experiment for all of them
+            wall_time = calendar.timegm(sql_model_instance.created_at.utctimetuple())
+
+            metric_points = []
+
+            for trace_name in graphs.graph_column_names:
+
+                steps, values = graphs.get_trace(trace_name)
+
+                for step, value in zip(steps, values):
+
+                    metric_points.append({'experiment_table': sql_model_instance.__tablename__,
+                                          'experiment_id': sql_model_instance.id,
+                                          'trace_name': trace_name,
+                                          'step': step,
+                                          'wall_time': wall_time,
+                                          'value': float(value)})
+
+            insert_metric_points(db.session, metric_points)
+
+        graphs.clear_traces()
+
+        # Since we pickle this field -- we need to explicitly tell that
+        # the field was updated, otherwise the changes won't be commited
+        flag_modified(sql_model_instance, 'graphs')
+
+        db.session.add(sql_model_instance)
+        db.session.commit()
+
+        number_of_migrated_experiments += 1
+
+    return number_of_migrated_experiments
+
+
+class BufferedMetricWriter(object):
+    """Writes metric points and experiment updates from a background thread.
+
+    Reports are put into an in-process queue and are returned from
+    immediately, so the training loop doesn't wait for the sqlite
+    commit. A single writer thread drains the queue and commits accumulated
+    operations every flush_every_n_points points or every flush_interval_ms
+    milliseconds, whichever comes first. Since there is only one writer thread
+    and one queue, operations are commited in the same order they were reported.
+
+    Errors that happen in the writer thread are raised in the reporting
+    thread on the next call to any method of the writer.
+
+    """
+
+    def __init__(self, flush_every_n_points=100, flush_interval_ms=1000):
+        """Starts the writer thread.
+
+        Parameters
+        ----------
+        flush_every_n_points : int
+            Number of accumulated metric points that triggers a commit.
+
+        flush_interval_ms : int
+            Maximum time in milliseconds that a reported operation can
+            wait in the buffer before being commited.
+        """
+
+        self.flush_every_n_points = flush_every_n_points
+        self.flush_interval = flush_interval_ms / 1000.0
+
+        self.queue = queue.Queue()
+
+        self.error = None
+        self.closed = False
+
+        # Counters that can be inspected with get_statistics()
+        self.max_queue_depth = 0
+        self.number_of_flushes = 0
+        self.number_of_written_points = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+
+        self.thread = threading.Thread(target=self.drain_queue,
+                                       name='dash-deep-metric-writer')
+
+        # The thread should never keep the process alive, we flush
+        # explicitly in close() instead
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def add_metric_points(self, metric_points):
+        """Puts metric points into the queue.
+
+        Parameters
+        ----------
+        metric_points : list of dicts
+            Rows of the metric points table.
+        """
+
+        self.insert_rows(metric_points_insert_statement, metric_points)
+
+
+    def insert_rows(self, insert_statement, rows):
+        """Puts rows of an arbitrary table into the queue.
+
+        Used for the tables that are derived from the metric points,
+        like the metric rollups.
+
+        Parameters
+        ----------
+        insert_statement : sqlalchemy insert statement
+            Statement to execute the rows with.
+
+        rows : list of dicts
+            Rows to insert.
+        """
+
+        self.put(('insert', insert_statement, rows))
+
+
+    def update_experiment(self, sql_model_class, experiment_id, values):
+        """Puts an update of experiment columns into the queue.
+
+        Parameters
+        ----------
+        sql_model_class : sqlalchemy model class
+            Class of the experiment.
+
+        experiment_id : int
+            Id of the experiment.
+
+        values : dict
+            Dict that maps column names into new values.
+        """
+
+        self.put(('update', sql_model_class.__table__, experiment_id, values))
+
+
+    def flush(self):
+        """Blocks until all the operations reported so far are commited."""
+
+        self.put_and_wait('flush')
+
+
+    def close(self):
+        """Commits all the operations reported so far and stops the writer thread.
+
+        It is safe to call it multiple times.
+        """
+
+        if self.closed:
+
+            self.raise_error_if_any()
+
+            return
+
+        self.put_and_wait('stop')
+        self.closed = True
+
+
+    def get_statistics(self):
+        """Returns the counters of the writer.
+
+        Returns
+        -------
+        statistics : dict
+            Current and maximum observed queue depth, number of flushes and
+            written points and flush latencies in milliseconds.
+        """
+
+        number_of_flushes = max(self.number_of_flushes, 1)
+
+        return {'queue_depth': self.queue.qsize(),
+                'max_queue_depth': self.max_queue_depth,
+                'number_of_flushes': self.number_of_flushes,
+                'number_of_written_points': self.number_of_written_points,
+                'last_flush_latency_ms': self.last_flush_latency * 1000,
+                'max_flush_latency_ms': self.max_flush_latency * 1000,
+                'mean_flush_latency_ms': self.total_flush_latency * 1000 / number_of_flushes}
+
+
+    def put(self, operation):
+
+        self.raise_error_if_any()
+
+        if self.closed:
+
+            raise RuntimeError('The metric writer was already closed')
+
+        self.queue.put(operation)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+
+    def put_and_wait(self, command):
+
+        done_event = threading.Event()
+
+        self.put((command, done_event))
+
+        # Waiting with a timeout in a loop, otherwise the main thread
+        # doesn't receive signals in python 2 while waiting
+        while not done_event.wait(0.1):
+
+            if not self.thread.is_alive():
+
+                break
+
+        self.raise_error_if_any()
+
+
+    def raise_error_if_any(self):
+
+        if self.error is not None:
+
+            error, self.error = self.error, None
+
+            raise error
+
+
+    def drain_queue(self):
+        """Main loop of the writer thread."""
+
+        buffered_operations = []
+        number_of_buffered_points = 0
+        flush_deadline = None
+
+        while True:
+
+            if flush_deadline is None:
+
+                timeout = None
+            else:
+
+                timeout = max(flush_deadline - time.time(), 0)
+
+            try:
+
+                operation = self.queue.get(timeout=timeout)
+
+            except queue.Empty:
+
+                operation = ('timeout', None)
+
+            operation_type = operation[0]
+
+            if operation_type in ('insert', 'update'):
+
+                buffered_operations.append(operation)
+
+                if operation_type == 'insert':
+
+                    number_of_buffered_points += len(operation[2])
+
+                if flush_deadline is None:
+
+                    flush_deadline = time.time() + self.flush_interval
+
+                if number_of_buffered_points < self.flush_every_n_points:
+
+                    continue
+
+            self.write_operations(buffered_operations)
+
+            buffered_operations = []
+            number_of_buffered_points = 0
+            flush_deadline = None
+
+            if operation_type in ('flush', 'stop'):
+
+                done_event = operation[1]
+                done_event.set()
+
+            if operation_type == 'stop':
+
+                return
+
+
+    def write_operations(self, operations):
+        """Commits the operations in a single transaction preserving their order."""
+
+        if not operations:
+
+            return
+
+        flush_start_time = time.time()
+
+        try:
+
+            with db.engine.begin() as connection:
+
+                # Consecutive inserts into the same table are coalesced
+                # into a single executemany call
+                insert_statement = None
+                rows = []
+
+                # Experiments which reported values in this flush
+                updated_experiments = set()
+
+                for operation in operations:
+
+                    if operation[0] == 'insert' and operation[1] is metric_points_insert_statement:
+
+                        updated_experiments.update((metric_point['experiment_table'], metric_point['experiment_id'])
+                                                   for metric_point in operation[2])
+
+                    if operation[0] == 'insert' and operation[1] is insert_statement:
+
+                        rows.extend(operation[2])
+
+                        continue
+
+                    # Writing the accumulated rows first to keep the order
+                    if rows:
+
+                        connection.execute(insert_statement, rows)
+
+                    insert_statement = None
+                    rows = []
+
+                    if operation[0] == 'insert':
+
+                        _, insert_statement, rows = operation
+                        rows = list(rows)
+
+                        continue
+
+                    _, table, experiment_id, values = operation
+
+                    connection.execute(table.update().where(table.c.id == experiment_id).values(version=table.c.version + 1,
+                                                                                             **values))
+
+                if rows:
+
+                    connection.execute(insert_statement, rows)
+
+                # Version is incremented once per flush
+                for experiment_table, experiment_id in updated_experiments:
+
+                    connection.execute(create_version_bump_statement(experiment_table, experiment_id))
+
+        except Exception as error:
+
+            # Surfacing the error in the reporting thread, the operations
+            # of the failed flush are dropped
+            self.error = error
+
+            return
+
+        flush_latency = time.time() - flush_start_time
+
+        self.number_of_flushes += 1
+        self.number_of_written_points += sum(len(operation[2]) for operation in operations
+                                             if operation[0] == 'insert' and
+                                             operation[1] is metric_points_insert_statement)
+        self.last_flush_latency = flush_latency
+        self.max_flush_latency = max(self.max_flush_latency, flush_latency)
+        self.total_flush_latency += flush_latency
@@ -1,5 +1,5 @@
 from dash_deep.app import db
-from dash_deep.plot import BaseGraph
+from dash_deep.plot import BaseGraph, BaseGraphType
 from datetime import datetime
 
 # More examples on flask-sqlalchemy mixins:
@@ -11,18 +11,41 @@ from datetime import datetime
 
 class BasicExperimentMixin(object):
     
+    # Experiment tables are filtered and sorted by the hyperparameters
+    # and the scores in the database (see dash_deep/sql.py), so these
+    # columns are indexed
     id = db.Column(db.Integer, primary_key=True)
     gpu_id = db.Column(db.Integer, nullable=False)
-    batch_size = db.Column(db.Integer, nullable=False)
-    learning_rate = db.Column(db.Float, nullable=False)
-    created_at = db.Column(db.DateTime, nullable=False)
+    batch_size = db.Column(db.Integer, nullable=False, index=True)
+    learning_rate = db.Column(db.Float, nullable=False, index=True)
+    created_at = db.Column(db.DateTime, nullable=False, index=True)
     model_path = db.Column(db.String(120), nullable=False)
     
-    training_loss = db.Column(db.Float, nullable=False)
-    training_accuracy = db.Column(db.Float, nullable=False)
-    validation_accuracy = db.Column(db.Float, nullable=False)
+    training_loss = db.Column(db.Float, nullable=False, index=True)
+    training_accuracy = db.Column(db.Float, nullable=False, index=True)
+    validation_accuracy = db.Column(db.Float, nullable=False, index=True)
     
-    graphs = db.Column(db.PickleType())
+    graphs = db.Column(BaseGraphType())
+    
+    # Incremented on every write of the experiment and its reported values,
+    # so that pages can tell that nothing changed without loading the rows.
+    # server_default fills it for the rows that existed before the column.
+    # The index lets sqlite compute the signatures of the tables (see
+    # dash_deep/sql.py) without reading the rows with their graphs.
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0', index=True)
+    
+    # Set when the reported values of the experiment are moved into
+    # the archive (see dash_deep/archive.py)
+    archived_at = db.Column(db.DateTime, nullable=True, index=True)
+    
+    # Tasks with a higher priority are started first, submitted_by is the
+    # user that started the task from the pages (see dash_deep/task.py)
+    priority = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    submitted_by = db.Column(db.String(120), nullable=True)
+    
+    # Json list of the kept checkpoints of the experiment with their
+    # paths, scores and sizes (see dash_deep/checkpoints.py)
+    checkpoints = db.Column(db.Text, nullable=True)
     
     graph_definition = [ 
                            [ ('Losses', ['training_loss']) ],
@@ -32,13 +55,18 @@ class BasicExperimentMixin(object):
     exclude_from_form = ['graphs',
                          'training_loss',
                          'training_accuracy', 'validation_accuracy',
-                         'created_at', 'model_path']
+                         'created_at', 'model_path',
+                         'version', 'archived_at', 'checkpoints',
+                         'submitted_by']
     
     def __init__(self, *args, **kwargs):
         
         super(BasicExperimentMixin, self).__init__(*args, **kwargs)
         
-        self.gpu_id = 0
+        # Negative gpu_id lets the task scheduler pick
+        # the gpu (see dash_deep/task.py)
+        self.gpu_id = -1
+        self.priority = 0
         self.batch_size = 100
         self.learning_rate = 0.0001
         
@@ -49,4 +77,10 @@ class BasicExperimentMixin(object):
         self.training_accuracy = 0.0
         self.validation_accuracy = 0.0
         
-        self.graphs = BaseGraph(self.graph_definition)
\ No newline at end of file
+        self.graphs = BaseGraph(self.graph_definition)
+        
+        self.version = 0
+        
+        self.archived_at = None
+        
+        self.checkpoints = None
\ No newline at end of file
@@ -0,0 +1,557 @@
+from dash_deep.app import (db,
+                           models_save_folder_path,
+                           model_store_chunk_tensors,
+                           model_store_gc_grace_seconds)
+
+import hashlib
+import io
+import json
+import os
+import pickle
+import shutil
+import time
+
+import numpy as np
+
+
+# Objects are stored under '<models folder>/<store folder>/<first two
+# characters of the hash>/<hash><extension>', paths of the objects are
+# recorded in the experiment rows relative to the models folder
+MODEL_STORE_FOLDER_NAME = 'store'
+
+# Extension of the objects that describe the checkpoints stored per tensor
+MANIFEST_EXTENSION = '.manifest'
+
+TENSOR_EXTENSION = '.npy'
+
+# Tensors of a stored manifest are replaced by dicts with this key
+TENSOR_REFERENCE_KEY = 'dash_deep_tensor'
+
+HASH_READ_CHUNK_SIZE = 1 << 20
+
+
+def get_object_relative_path(object_hash, extension):
+
+    return os.path.join(MODEL_STORE_FOLDER_NAME, object_hash[:2], object_hash + extension)
+
+
+def is_store_path(relative_path):
+    """Checks whether a path recorded in an experiment row points into the store."""
+
+    return relative_path.split(os.sep)[0] == MODEL_STORE_FOLDER_NAME
+
+
+def write_object(data, extension):
+    """Writes bytes into the store unless an object with the same hash exists.
+
+    New objects are written under a temporary name, synced and renamed, so
+    the store never has truncated objects. An existing object is touched
+    instead, so that the garbage collection doesn't remove it before the
+    experiment that reuses it records its path (see collect_garbage()).
+
+    Returns
+    -------
+    relative_path : string
+        Path of the object relative to the models folder.
+
+    number_of_written_bytes : int
+        Size of the data or 0 if the object already existed.
+    """
+
+    relative_path = get_object_relative_path(hashlib.sha256(data).hexdigest(), extension)
+
+    absolute_path = os.path.join(models_save_folder_path, relative_path)
+
+    if os.path.exists(absolute_path):
+
+        os.utime(absolute_path, None)
+
+        return relative_path, 0
+
+    absolute_dirname = os.path.dirname(absolute_path)
+
+    if not os.path.exists(absolute_dirname):
+
+        os.makedirs(absolute_dirname)
+
+    # The temporary name is unique per process, since two experiments
+    # can write the same object at the same time
+    temporary_path = '{}.{}.tmp'.format(absolute_path, os.getpid())
+
+    with open(temporary_path, 'wb') as object_file:
+
+        object_file.write(data)
+
+        object_file.flush()
+        os.fsync(object_file.fileno())
+
+    if os.path.exists(absolute_path):
+
+        # Written by another process in the meantime, rename()
+        # can't replace files on windows
+        os.remove(temporary_path)
+
+        return relative_path, 0
+
+    os.rename(temporary_path, absolute_path)
+
+    return relative_path, len(data)
+
+
+def import_file(absolute_file_path, extension):
+    """Copies an existing file into the store.
+
+    Returns
+    -------
+    relative_path : string
+        Path of the object relative to the models folder.
+    """
+
+    file_hash = hashlib.sha256()
+
+    with open(absolute_file_path, 'rb') as source_file:
+
+        for chunk in iter(lambda: source_file.read(HASH_READ_CHUNK_SIZE), b''):
+
+            file_hash.update(chunk)
+
+    relative_path = get_object_relative_path(file_hash.hexdigest(), extension)
+
+    absolute_path = os.path.join(models_save_folder_path, relative_path)
+
+    if os.path.exists(absolute_path):
+
+        os.utime(absolute_path, None)
+
+        return relative_path
+
+    absolute_dirname = os.path.dirname(absolute_path)
+
+    if not os.path.exists(absolute_dirname):
+
+        os.makedirs(absolute_dirname)
+
+    temporary_path = '{}.{}.tmp'.format(absolute_path, os.getpid())
+
+    shutil.copyfile(absolute_file_path, temporary_path)
+
+    if os.path.exists(absolute_path):
+
+        os.remove(temporary_path)
+    else:
+
+        os.rename(temporary_path, absolute_path)
+
+    return relative_path
+
+
+def copy_dict_metadata(source_dict, target_dict):
+    """Copies the _metadata attribute that pytorch sets on the state dicts
+    of modules (versions of the layers) to a copy of the state dict."""
+
+    if hasattr(source_dict, '_metadata'):
+
+        target_dict._metadata = source_dict._metadata
+
+    return target_dict
+
+
+def convert_tensor_to_bytes(tensor):
+    """Serializes a cpu tensor as a .npy file.
+
+    Unlike torch.save(), the result depends only on the values, the type
+    and the shape of the tensor, so equal tensors get the same hash.
+    """
+
+    tensor_file = io.BytesIO()
+
+    np.save(tensor_file, tensor.numpy(), allow_pickle=False)
+
+    return tensor_file.getvalue()
+
+
+def store_state_dict(snapshot, chunk_tensors=model_store_chunk_tensors):
+    """Writes a state dict into the store.
+
+    With chunk_tensors each tensor is stored as a separate object and the
+    checkpoint itself is a small manifest with the references to them, so
+    the tensors that are equal in different checkpoints -- like the layers
+    of a fine-tuned model that were frozen -- are stored once. Otherwise
+    the checkpoint is stored whole with torch.save() and only byte equal
+    checkpoints are deduplicated.
+
+    Parameters
+    ----------
+    snapshot : dict
+        State dict with cpu tensors, see checkpoints.snapshot_state_dict().
+
+    chunk_tensors : bool
+        Whether to store each tensor separately.
+
+    Returns
+    -------
+    relative_path : string
+        Path of the checkpoint relative to the models folder, to
+        be loaded with load_checkpoint().
+
+    size : int
+        Size of the checkpoint in bytes, including its tensor objects.
+
+    number_of_written_bytes : int
+        Number of bytes that were new to the store.
+    """
+
+    # Imported here, so that the dashboard itself doesn't depend on pytorch
+    import torch
+
+    if not chunk_tensors:
+
+        checkpoint_file = io.BytesIO()
+
+        torch.save(snapshot, checkpoint_file)
+
+        relative_path, number_of_written_bytes = write_object(checkpoint_file.getvalue(), '.pth')
+
+        return relative_path, len(checkpoint_file.getvalue()), number_of_written_bytes
+
+    # Total size and the number of new bytes of the tensor objects
+    tensor_sizes = [0, 0]
+
+    def replace_tensors(value):
+
+        if torch.is_tensor(value):
+
+            tensor_bytes = convert_tensor_to_bytes(value)
+
+            relative_path, object_written_bytes = write_object(tensor_bytes, TENSOR_EXTENSION)
+
+            tensor_sizes[0] += len(tensor_bytes)
+            tensor_sizes[1] += object_written_bytes
+
+            return {TENSOR_REFERENCE_KEY: relative_path}
+
+        if isinstance(value, dict):
+
+            return copy_dict_metadata(value, value.__class__((key, replace_tensors(item)) for key, item in value.items()))
+
+        if isinstance(value, (list, tuple)):
+
+            return value.__class__(replace_tensors(item) for item in value)
+
+        return value
+
+    # Protocol 2 is readable by both python 2 and 3
+    manifest = pickle.dumps(replace_tensors(snapshot), protocol=2)
+
+    relative_path, manifest_written_bytes = write_object(manifest, MANIFEST_EXTENSION)
+
+    return relative_path, tensor_sizes[0] + len(manifest), tensor_sizes[1] + manifest_written_bytes
+
+
+def read_manifest(relative_path):
+
+    with open(os.path.join(models_save_folder_path, relative_path), 'rb') as manifest_file:
+
+        return pickle.load(manifest_file)
+
+
+def get_manifest_tensor_paths(manifest):
+    """Returns the paths of the tensor objects referenced by a manifest."""
+
+    if isinstance(manifest, dict):
+
+        if TENSOR_REFERENCE_KEY in manifest:
+
+            return [manifest[TENSOR_REFERENCE_KEY]]
+
+        items = manifest.values()
+
+    elif isinstance(manifest, (list, tuple)):
+
+        items = manifest
+
+    else:
+
+        return []
+
+    tensor_paths = []
+
+    for item in items:
+
+        tensor_paths.extend(get_manifest_tensor_paths(item))
+
+    return tensor_paths
+
+
+def load_checkpoint(relative_path, map_location=None):
+    """Loads a checkpoint saved by an experiment.
+
+    Works for the checkpoints stored per tensor, for the ones stored whole
+    and for the model files saved by the scripts with torch.save() before
+    the store was introduced.
+
+    Parameters
+    ----------
+    relative_path : string
+        Path relative to the models folder, usually the model_path
+        column of an experiment.
+
+    map_location : string
+        Optional device to load the tensors to, like 'cpu'.
+
+    Returns
+    -------
+    state_dict : dict
+        Loaded state dict.
+    """
+
+    import torch
+
+    if not relative_path.endswith(MANIFEST_EXTENSION):
+
+        return torch.load(os.path.join(models_save_folder_path, relative_path), map_location=map_location)
+
+    def load_tensors(value):
+
+        if isinstance(value, dict):
+
+            if TENSOR_REFERENCE_KEY in value:
+
+                tensor = torch.from_numpy(np.load(os.path.join(models_save_folder_path, value[TENSOR_REFERENCE_KEY])))
+
+                return tensor if map_location is None else tensor.to(map_location)
+
+            return copy_dict_metadata(value, value.__class__((key, load_tensors(item)) for key, item in value.items()))
+
+        if isinstance(value, (list, tuple)):
+
+            return value.__class__(load_tensors(item) for item in value)
+
+        return value
+
+    return load_tensors(read_manifest(relative_path))
+
+
+def get_experiment_model_paths(model_path, checkpoints):
+    """Returns the model paths recorded in the columns of an experiment row."""
+
+    model_paths = [checkpoint['path'] for checkpoint in json.loads(checkpoints or '[]')]
+
+    if model_path and model_path not in model_paths:
+
+        model_paths.append(model_path)
+
+    return model_paths
+
+
+def get_object_reference_counts(sql_model_classes):
+    """Counts the references to the objects of the store from the experiment rows.
+
+    Each checkpoint recorded in an experiment row references its object,
+    checkpoints stored per tensor also reference their tensor objects. The
+    counts are computed from the rows every time, so they can't drift from them.
+
+    Returns
+    -------
+    reference_counts : dict
+        Maps relative paths of the referenced objects into the
+        number of references.
+    """
+
+    reference_counts = {}
+
+    manifest_tensor_paths = {}
+
+    for sql_model_class in sql_model_classes:
+
+        if not db.engine.has_table(sql_model_class.__tablename__):
+
+            continue
+
+        query = db.session.query(sql_model_class.model_path, sql_model_class.checkpoints)
+
+        for model_path, checkpoints in query:
+
+            for relative_path in get_experiment_model_paths(model_path, checkpoints):
+
+                if not is_store_path(relative_path):
+
+                    continue
+
+                referenced_paths = [relative_path]
+
+                if relative_path.endswith(MANIFEST_EXTENSION):
+
+                    if relative_path not in manifest_tensor_paths:
+
+                        manifest_is_present = os.path.exists(os.path.join(models_save_folder_path, relative_path))
+
+                        manifest_tensor_paths[relative_path] = (get_manifest_tensor_paths(read_manifest(relative_path))
+                                                                if manifest_is_present else [])
+
+                    referenced_paths.extend(manifest_tensor_paths[relative_path])
+
+                for referenced_path in referenced_paths:
+
+                    reference_counts[referenced_path] = reference_counts.get(referenced_path, 0) + 1
+
+    return reference_counts
+
+
+def generate_object_paths():
+    """Yields the relative paths of all the objects of the store."""
+
+    store_path = os.path.join(models_save_folder_path, MODEL_STORE_FOLDER_NAME)
+
+    if not os.path.exists(store_path):
+
+        return
+
+    for prefix in sorted(os.listdir(store_path)):
+
+        for file_name in sorted(os.listdir(os.path.join(store_path, prefix))):
+
+            if file_name.endswith('.tmp'):
+
+                continue
+
+            yield os.path.join(MODEL_STORE_FOLDER_NAME, prefix, file_name)
+
+
+def collect_garbage(sql_model_classes,
+                    candidate_paths=None,
+                    grace_seconds=model_store_gc_grace_seconds,
+                    dry_run=False):
+    """Removes the objects of the store that no experiment references.
+
+    Objects that were written or reused in the last grace_seconds seconds
+    are kept, since the experiment that wrote them might not have recorded
+    them yet.
+
+    Parameters
+    ----------
+    sql_model_classes : list
+        All the experiment types.
+
+    candidate_paths : list
+        Optional relative paths of the objects to check, all
+        the objects of the store are checked by default. Tensor
+        objects of the candidate manifests are checked as well.
+
+    grace_seconds : float
+        Minimum age of the removed objects.
+
+    dry_run : bool
+        Only report the objects that would be removed.
+
+    Returns
+    -------
+    summary : dict
+        Numbers of objects, referenced objects, removed objects
+        and removed bytes.
+    """
+
+    reference_counts = get_object_reference_counts(sql_model_classes)
+
+    if candidate_paths is None:
+
+        candidate_paths = list(generate_object_paths())
+    else:
+
+        candidate_paths = list(candidate_paths)
+
+        for candidate_path in list(candidate_paths):
+
+            absolute_path = os.path.join(models_save_folder_path, candidate_path)
+
+            if candidate_path.endswith(MANIFEST_EXTENSION) and os.path.exists(absolute_path):
+
+                candidate_paths.extend(get_manifest_tensor_paths(read_manifest(candidate_path)))
+
+    oldest_removed_modification_time = time.time() - grace_seconds
+
+    summary = {'number_of_objects': 0,
+               'number_of_referenced_objects': 0,
+               'number_of_removed_objects': 0,
+               'number_of_removed_bytes': 0}
+
+    for relative_path in sorted(set(candidate_paths)):
+
+        absolute_path = os.path.join(models_save_folder_path, relative_path)
+
+        if not os.path.exists(absolute_path):
+
+            continue
+
+        summary['number_of_objects'] += 1
+
+        if reference_counts.get(relative_path, 0) > 0:
+
+            summary['number_of_referenced_objects'] += 1
+
+            continue
+
+        if os.path.getmtime(absolute_path) > oldest_removed_modification_time:
+
+            continue
+
+        summary['number_of_removed_objects'] += 1
+        summary['number_of_removed_bytes'] += os.path.getsize(absolute_path)
+
+        if not dry_run:
+
+            os.remove(absolute_path)
+
+    return summary
+
+
+def import_experiment_model_files(sql_model_instance):
+    """Moves the model files of an experiment saved outside of the store into it.
+
+    Used for the models saved before the store was introduced. The files
+    are copied into the store whole, the paths in the row are updated and
+    the original files are removed after that.
+
+    Returns
+    -------
+    number_of_imported_files : int
+        Number of moved files.
+    """
+
+    checkpoints = json.loads(sql_model_instance.checkpoints or '[]')
+
+    imported_paths = {}
+
+    for relative_path in get_experiment_model_paths(sql_model_instance.model_path, sql_model_instance.checkpoints):
+
+        absolute_path = os.path.join(models_save_folder_path, relative_path)
+
+        if is_store_path(relative_path) or not os.path.isfile(absolute_path):
+
+            continue
+
+        imported_paths[relative_path] = import_file(absolute_path, os.path.splitext(relative_path)[1])
+
+    if not imported_paths:
+
+        return 0
+
+    for checkpoint in checkpoints:
+
+        checkpoint['path'] = imported_paths.get(checkpoint['path'], checkpoint['path'])
+
+    if checkpoints:
+
+        sql_model_instance.checkpoints = json.dumps(checkpoints)
+
+    sql_model_instance.model_path = imported_paths.get(sql_model_instance.model_path, sql_model_instance.model_path)
+    sql_model_instance.version = sql_model_instance.__class__.version + 1
+
+    db.session.add(sql_model_instance)
+    db.session.commit()
+
+    for relative_path in imported_paths:
+
+        os.remove(os.path.join(models_save_folder_path, relative_path))
+
+    return len(imported_paths)
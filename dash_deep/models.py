@@ -33,6 +33,8 @@ class SimpleBinary(BasicExperimentMixin, db.Model):
 
 from dash_deep.scripts.endovis_binary_segmentation_train import run as endovis_binary_segmentation_train_run
 from dash_deep.scripts.endovis_binary_segmentation_train import inference as endovis_binary_segmentation_inference
+from dash_deep.scripts.endovis_binary_segmentation_train import load_inference_model as endovis_binary_segmentation_load_model
+from dash_deep.scripts.endovis_binary_segmentation_train import batch_inference as endovis_binary_segmentation_batch_inference
 from dash_deep.scripts.endovis_binary_segmentation_train import valset, trainset
 
 class EndovisBinary(BasicExperimentMixin, db.Model):
@@ -41,7 +43,9 @@ class EndovisBinary(BasicExperimentMixin, db.Model):
     output_stride = db.Column(db.Integer, nullable=False)
     
     actions = {'main': endovis_binary_segmentation_train_run,
-               'inference': endovis_binary_segmentation_inference}
+               'inference': endovis_binary_segmentation_inference,
+               'load_model': endovis_binary_segmentation_load_model,
+               'batch_inference': endovis_binary_segmentation_batch_inference}
     
     datasets = {'train': trainset,
                 'valset': valset}
@@ -1,7 +1,37 @@
 from plotly import tools
+from plotly.colors import DEFAULT_PLOTLY_COLORS
 import plotly.plotly as py
 import plotly.graph_objs as go
 from copy import deepcopy
+from collections import OrderedDict
+from sqlalchemy.types import TypeDecorator, LargeBinary
+
+import re
+import sys
+import json
+import base64
+import math
+import threading
+import struct
+import pickle
+from io import BytesIO
+from array import array
+
+import flask
+import numpy as np
+
+from dash_deep.app import (server,
+                          auth,
+                          plot_points_per_trace,
+                          plot_downsampling_method,
+                          plot_trace_encoding,
+                          figure_fragment_cache_size)
+from dash_deep.rollups import load_experiment_traces_at_resolution
+from dash_deep.downsampling import downsample_trace
+from dash_deep.aggregation import aggregate_traces
+from dash_deep.smoothing import (smoothing_methods,
+                                 get_smoothed_trace_name,
+                                 get_smoothing_legend_suffix)
 
 
 def convert_column_name_to_legend_name(column_name):
@@ -50,22 +80,200 @@ def flatten_list(two_dimensional_list):
     return flattened
 
 
-class BaseGraph():
-    """Class that takes care of storing of Plotly's dict representation
-    of a graph with subplots.
+# Header of the raw bytes representation of BaseGraph. It is followed by the
+# version byte, the length of json metadata and the metadata itself. After that
+# steps (int32) and values (float64) of each trace are stored as little-endian
+# raw arrays in the order of graph_column_names. Version 1 also stored the
+# layout of the figure in the metadata, it is ignored when loaded.
+BASE_GRAPH_MAGIC = b'DASHDEEPGRAPH'
+BASE_GRAPH_FORMAT_VERSION = 2
+
+BASE_GRAPH_STEPS_TYPECODE = 'i'
+BASE_GRAPH_VALUES_TYPECODE = 'd'
+
+
+def convert_array_to_bytes(values_array):
+    """Converts a typed array into little-endian raw bytes."""
+    
+    if sys.byteorder == 'big':
+        
+        values_array = array(values_array.typecode, values_array)
+        values_array.byteswap()
+    
+    # .tostring() was renamed to .tobytes() in python 3
+    if hasattr(values_array, 'tobytes'):
+        
+        return values_array.tobytes()
+    
+    return values_array.tostring()
+
+
+def convert_bytes_to_array(typecode, values_bytes):
+    """Converts little-endian raw bytes into a typed array."""
+    
+    values_array = array(typecode)
+    
+    if hasattr(values_array, 'frombytes'):
+        
+        values_array.frombytes(values_bytes)
+    else:
+        
+        values_array.fromstring(values_bytes)
+    
+    if sys.byteorder == 'big':
+        
+        values_array.byteswap()
+    
+    return values_array
+
+
+# Figure layout templates are the same for all the experiments of a model
+# class, so we create them only once per class. See get_graph_layout_template().
+graph_layout_templates = {}
+
+
+def create_graph_layout_template(graph_definition):
+    """Creates plotly's layout of a graph with subplots and assigns
+    subplot axes to each trace.
+    
+    See BaseGraph.__init__() for the description of the graph definition.
+    
+    Parameters
+    ----------
+    graph_definition : list
+        List with the graph definition
+    
+    Returns
+    -------
+    layout_template : dict
+        Dict with 'layout' -- plotly's dict representation of the layout and
+        'trace_axes' -- dict that maps trace name into (xaxis, yaxis) pair.
+    """
+    
+    # Inferring the number the size of
+    # our figure with subplots
+    rows = len(graph_definition)
+    cols = len(graph_definition[0])
+    
+    # Flattening our 2D array representing subplots
+    # in order to correctly provide subplots' titles
+    graph_definition_flattened = flatten_list(graph_definition)
+    subplot_titles = [graph[0] for graph in graph_definition_flattened]
+    
+    # Actually creating the plot with subplots
+    figure_obj = tools.make_subplots(rows=rows, cols=cols,
+                                     subplot_titles=subplot_titles)
+    
+    graph_column_names = []
+    
+    for current_row in xrange(rows):
+        
+        for current_col in xrange(cols):
+            
+            # Each subplot can have a list of traces -- for example
+            # Loss subplot usually contains validation and train loss
+            current_subplot_traces_names = graph_definition[current_row][current_col][1]
+            
+            for sublot_trace_name in current_subplot_traces_names:
+                
+                current_trace = go.Scatter(x=[], y=[])
+                
+                # +1 because in plot.ly's subplots are numerated starting from 1 and not 0
+                figure_obj.append_trace(current_trace, current_row + 1, current_col + 1)
+                
+                graph_column_names.append(sublot_trace_name)
+    
+    # Plotly's Figure objects are not serializable, therefore we
+    # convert them into ordered dict and only keep the layout and
+    # the subplot axes each trace was assigned to
+    figure_dict = figure_obj.get_ordered()
+    
+    trace_axes = {}
+    
+    for trace_name, trace in zip(graph_column_names, figure_dict['data']):
+        
+        trace_axes[trace_name] = (trace['xaxis'], trace['yaxis'])
+    
+    layout_template = {'layout': figure_dict['layout'],
+                       'trace_axes': trace_axes}
+    
+    return layout_template
+
+
+def get_graph_layout_template(sql_model_class):
+    """Returns the cached layout template of a model class.
+    
+    The template is created from the graph_definition of the class on
+    the first call and is reused afterwards. The returned template should
+    not be modified.
+    
+    Parameters
+    ----------
+    sql_model_class : sqlalchemy model class
+        Class with the graph_definition attribute.
+    
+    Returns
+    -------
+    layout_template : dict
+        See create_graph_layout_template().
+    """
+    
+    if sql_model_class not in graph_layout_templates:
+        
+        graph_layout_templates[sql_model_class] = create_graph_layout_template(sql_model_class.graph_definition)
+    
+    return graph_layout_templates[sql_model_class]
+
+
+class LegacyBaseGraph:
+    """Placeholder class that pickled BaseGraph objects of old experiments
+    are loaded into. See BaseGraph.from_legacy_graph().
+    
+    """
+    
+    pass
+
+
+class LegacyBaseGraphUnpickler(pickle.Unpickler):
+    """Unpickler that loads old pickled BaseGraph objects as LegacyBaseGraph.
+    
+    Old BaseGraph objects stored the whole plotly figure in their
+    __dict__ which can't be loaded into the current BaseGraph with __slots__.
+    
+    """
+    
+    def find_class(self, module, name):
+        
+        if module == __name__ and name == 'BaseGraph':
+            
+            return LegacyBaseGraph
+        
+        return pickle.Unpickler.find_class(self, module, name)
+
+
+class BaseGraph(object):
+    """Class that takes care of storing of the traces of a graph with subplots.
     
     The class accepts the graph definition with subplots titles and 
-    traces legend names that each subplot contains. We store the dict
-    representation because original plotly's representation of a graph
-    is not serializable and therefore we can't store it in a pickle format.
+    traces legend names that each subplot contains. Steps and values of each
+    trace are stored in typed arrays which take 4 and 8 bytes per point instead
+    of boxed python numbers. The layout of the figure is the same for all
+    experiments of a model class, so it is not stored here -- see
+    get_graph_layout_template(). Plotly's dict representation of the graph
+    is created only when it has to be rendered, see get_figure().
+    
+    The graph is stored in the database in a compact raw bytes format, see
+    to_bytes() and from_bytes().
     
     """
     
+    __slots__ = ['graph_column_names',
+                 'trace_steps',
+                 'trace_values']
+    
     def __init__(self, graph_definition):
-        """Accepts the graph definition dict, creates plotly's graph object
-        from it and converts it into a dict representation which is being stored
-        internally. Instances of this classes are serializable and can be stored
-        in a pickle column type in sqlalchemy.
+        """Accepts the graph definition dict and creates empty traces
+        for each trace that it defines.
         
         About the graph definition rules:
         
@@ -96,65 +304,13 @@ class BaseGraph():
 
         """
         
-        self.subplot_trace_iteration_counters = {}
-        
-        # Inferring the number the size of
-        # our figure with subplots
-        rows = len(graph_definition)
-        cols = len(graph_definition[0])
-        
-        self.rows = rows
-        self.cols = cols
-        
         self.graph_column_names = []
-        self.graph_column_name_trace_mapping = {}
-        
-        # Flattening our 2D array representing subplots
-        # in order to correctly provide subplots' titles
-        graph_definition_flattened = flatten_list(graph_definition)
-        self.subplot_titles = [graph[0] for graph in graph_definition_flattened]
-
-        # Actually creating the plot with subplots
-        figure_obj = tools.make_subplots(rows=rows, cols=cols,
-                                         subplot_titles=self.subplot_titles)
-
-        for current_row in xrange(rows):
-
-            for current_col in xrange(cols):
-                
-                # Each subplot can have a list of traces -- for example
-                # Loss subplot usually contains validation and train loss
-                current_subplot_traces_names = graph_definition[current_row][current_col][1]
-                
-                # Creating trace instances
-                for sublot_trace_name in current_subplot_traces_names:
-                                        
-                    # Converting the column name into actual title
-                    # like from validation_loss to Validation loss
-                    legend_name = convert_column_name_to_legend_name(sublot_trace_name)
-
-                    current_trace = go.Scatter(
-                                            x=[],
-                                            y=[],
-                                            name=legend_name)
-                    
-                    # +1 because in plot.ly's subplots are numerated starting from 1 and not 0
-                    figure_obj.append_trace(current_trace, current_row + 1, current_col + 1)
-                    
-                    self.graph_column_names.append(sublot_trace_name)
-        
-        # Plotly's Figure objects are not serializable,
-        # therefore we convert them into ordered dict and serilize
-        # later to store in the pickle format inside of our db.
-        self.figure_obj = figure_obj.get_ordered()
         
-        # Creating a mapping from trace name to its location in the dict representation
-        # of plot.ly's Figure object
-        for graph_name, trace in zip(self.graph_column_names, self.figure_obj['data']):
-            
-            self.subplot_trace_iteration_counters[graph_name] = 0
-            self.graph_column_name_trace_mapping[graph_name] = trace
+        for subplot_title, subplot_traces_names in flatten_list(graph_definition):
             
+            self.graph_column_names.extend(subplot_traces_names)
+        
+        self.clear_traces()
     
     
     def add_next_iteration_results(self, **kwargs):
@@ -182,76 +338,1233 @@ class BaseGraph():
         """
                 
         # Appending the next step values
-        for trace_name, trace_value_to_append in kwargs.iteritems():
+        for trace_name, trace_value_to_append in kwargs.items():
             
-            current_trace_iteration_counter = self.subplot_trace_iteration_counters[trace_name]
-            self.graph_column_name_trace_mapping[trace_name]['x'].append(current_trace_iteration_counter)
-            self.subplot_trace_iteration_counters[trace_name] += 1
+            steps = self.trace_steps[trace_name]
+            
+            steps.append(len(steps))
+            self.trace_values[trace_name].append(float(trace_value_to_append))
+
+
+    def get_trace(self, trace_name):
+        """Returns the steps and values of a trace.
+
+        Parameters
+        ----------
+        trace_name : string
+            Name of the trace as provided in the graph definition.
+
+        Returns
+        -------
+        steps, values : array.array
+            Steps and respective values of the trace.
+        """
+
+        return self.trace_steps[trace_name], self.trace_values[trace_name]
+
+
+    def set_trace(self, trace_name, steps, values):
+        """Replaces the steps and values of a trace.
+
+        Used to populate the graph with values that were loaded
+        from the metric points table.
+
+        Parameters
+        ----------
+        trace_name : string
+            Name of the trace as provided in the graph definition.
+
+        steps : iterable of ints
+            Steps of the trace.
+
+        values : iterable of floats
+            Values of the trace.
+        """
+
+        if trace_name not in self.trace_steps:
             
-            self.graph_column_name_trace_mapping[trace_name]['y'].append(trace_value_to_append)
+            raise KeyError('Trace {} is not defined in the graph definition'.format(trace_name))
+
+        self.trace_steps[trace_name] = array(BASE_GRAPH_STEPS_TYPECODE, steps)
+        self.trace_values[trace_name] = array(BASE_GRAPH_VALUES_TYPECODE, values)
+
+
+    def has_values(self):
+        """Checks whether at least one trace of the graph has values."""
+
+        return any(len(self.trace_steps[trace_name]) > 0
+                   for trace_name in self.graph_column_names)
+
+
+    def clear_traces(self):
+        """Removes all the values from the traces of the graph."""
+
+        self.trace_steps = {}
+        self.trace_values = {}
 
+        for trace_name in self.graph_column_names:
+
+            self.trace_steps[trace_name] = array(BASE_GRAPH_STEPS_TYPECODE)
+            self.trace_values[trace_name] = array(BASE_GRAPH_VALUES_TYPECODE)
+    
+    
+    def get_figure(self, layout_template, traces=None):
+        """Creates plotly's dict representation of the graph.
         
+        The typed arrays are converted into lists here, right before
+        the figure is passed to dash.
         
-def create_model_plot_with_unique_legends(sql_model_instance):
-    """Extracts the plot object form sql model instance and adds unique
-    id onto its legends.
+        Parameters
+        ----------
+        layout_template : dict
+            Layout template of the model class, see get_graph_layout_template().
+        
+        traces : dict
+            Optional dict that maps trace name into (steps, values) pair
+            that should be displayed instead of the stored ones.
+        
+        Returns
+        -------
+        figure : dict
+            Dict representing the plotly's figure.
+        """
+        
+        return {'data': self.get_figure_data(layout_template, traces),
+                'layout': deepcopy(layout_template['layout'])}
     
-    Extracts the figure object that can be passed to dash.Graph object
-    and displayed. Adds a unique ID (which is acquired from sql model instance
-    database ID) to its legends. This is useful when the figure needs to be
-    combined with figures of other sql model instances, otherwise it is impossible
-    to differentiate between objects in the figure.
+    
+    def get_figure_data(self, layout_template, traces=None):
+        """Creates plotly's dict representation of the traces of the graph.
+        
+        Same as get_figure() but without the layout. Traces that are
+        absent in the layout template are skipped.
+        
+        Returns
+        -------
+        data : list of dicts
+            List of plotly's scatter traces.
+        """
+        
+        if traces is None:
+            
+            traces = {}
+        
+        data = []
+        
+        for trace_name in self.graph_column_names:
+            
+            if trace_name not in layout_template['trace_axes']:
+                
+                continue
+            
+            xaxis, yaxis = layout_template['trace_axes'][trace_name]
+            
+            steps, values = traces.get(trace_name, self.get_trace(trace_name))
+            
+            # Converting the column name into actual title
+            # like from validation_loss to Validation loss
+            data.append({'type': 'scatter',
+                         'x': list(steps),
+                         'y': list(values),
+                         'name': convert_column_name_to_legend_name(trace_name),
+                         'xaxis': xaxis,
+                         'yaxis': yaxis})
+        
+        return data
+    
+    
+    def to_bytes(self):
+        """Serializes the graph into the raw bytes format.
+        
+        Returns
+        -------
+        graph_bytes : bytes
+            Raw bytes representation of the graph.
+        """
+        
+        metadata = {'graph_column_names': self.graph_column_names,
+                    'trace_lengths': [len(self.trace_steps[trace_name])
+                                      for trace_name in self.graph_column_names]}
+        
+        metadata_bytes = json.dumps(metadata).encode('utf-8')
+        
+        chunks = [BASE_GRAPH_MAGIC,
+                  struct.pack('<BI', BASE_GRAPH_FORMAT_VERSION, len(metadata_bytes)),
+                  metadata_bytes]
+        
+        for trace_name in self.graph_column_names:
+            
+            chunks.append(convert_array_to_bytes(self.trace_steps[trace_name]))
+            chunks.append(convert_array_to_bytes(self.trace_values[trace_name]))
+        
+        return b''.join(chunks)
+    
+    
+    @classmethod
+    def from_bytes(cls, graph_bytes):
+        """Deserializes the graph from the raw bytes format.
+        
+        Graphs of old experiments which were pickled are also supported.
+        
+        Parameters
+        ----------
+        graph_bytes : bytes
+            Raw bytes created by to_bytes() or a pickled BaseGraph.
+        
+        Returns
+        -------
+        graph : BaseGraph
+            Deserialized graph.
+        """
+        
+        graph_bytes = bytes(graph_bytes)
+        
+        if not graph_bytes.startswith(BASE_GRAPH_MAGIC):
+            
+            legacy_graph = LegacyBaseGraphUnpickler(BytesIO(graph_bytes)).load()
+            
+            return cls.from_legacy_graph(legacy_graph)
+        
+        offset = len(BASE_GRAPH_MAGIC)
+        
+        version, metadata_length = struct.unpack_from('<BI', graph_bytes, offset)
+        offset += struct.calcsize('<BI')
+        
+        if version > BASE_GRAPH_FORMAT_VERSION:
+            
+            raise ValueError('Unsupported graph format version {}'.format(version))
+        
+        metadata = json.loads(graph_bytes[offset:offset + metadata_length].decode('utf-8'))
+        offset += metadata_length
+        
+        graph = cls.__new__(cls)
+        
+        graph.graph_column_names = metadata['graph_column_names']
+        graph.trace_steps = {}
+        graph.trace_values = {}
+        
+        steps_itemsize = array(BASE_GRAPH_STEPS_TYPECODE).itemsize
+        values_itemsize = array(BASE_GRAPH_VALUES_TYPECODE).itemsize
+        
+        for trace_name, trace_length in zip(graph.graph_column_names, metadata['trace_lengths']):
+            
+            steps_end = offset + trace_length * steps_itemsize
+            values_end = steps_end + trace_length * values_itemsize
+            
+            graph.trace_steps[trace_name] = convert_bytes_to_array(BASE_GRAPH_STEPS_TYPECODE,
+                                                                   graph_bytes[offset:steps_end])
+            
+            graph.trace_values[trace_name] = convert_bytes_to_array(BASE_GRAPH_VALUES_TYPECODE,
+                                                                    graph_bytes[steps_end:values_end])
+            
+            offset = values_end
+        
+        return graph
+    
+    
+    @classmethod
+    def from_legacy_graph(cls, legacy_graph):
+        """Converts an old pickled BaseGraph into the current representation.
+        
+        Parameters
+        ----------
+        legacy_graph : LegacyBaseGraph
+            Unpickled old BaseGraph object.
+        
+        Returns
+        -------
+        graph : BaseGraph
+            Converted graph.
+        """
+        
+        legacy_state = legacy_graph.__dict__
+        legacy_figure = legacy_state['figure_obj']
+        
+        graph = cls.__new__(cls)
+        
+        graph.graph_column_names = list(legacy_state['graph_column_names'])
+        
+        graph.clear_traces()
+        
+        for trace_name, trace in zip(graph.graph_column_names, legacy_figure['data']):
+            
+            graph.set_trace(trace_name, trace['x'], trace['y'])
+        
+        return graph
+    
+    
+    def __getstate__(self):
+        
+        return self.to_bytes()
+    
+    
+    def __setstate__(self, state):
+        
+        graph = BaseGraph.from_bytes(state)
+        
+        for attribute_name in BaseGraph.__slots__:
+            
+            setattr(self, attribute_name, getattr(graph, attribute_name))
+
+
+class BaseGraphType(TypeDecorator):
+    """Sqlalchemy column type that stores BaseGraph in the raw bytes format.
+    
+    Rows of old experiments which contain pickled graphs are loaded
+    too. Same as with the PickleType, in-place changes of the graph are
+    not tracked -- call flag_modified() before commiting them.
+    
+    """
+    
+    impl = LargeBinary
+    
+    def process_bind_param(self, value, dialect):
+        
+        if value is None:
+            
+            return None
+        
+        return value.to_bytes()
+    
+    
+    def process_result_value(self, value, dialect):
+        
+        if value is None:
+            
+            return None
+        
+        return BaseGraph.from_bytes(value)
+
+        
+        
+def get_layout_axis_name(axis_name):
+    """Converts any plotly's name of an axis into the name used in the layout.
+    
+    Plotly refers to the same axis as 'x1', 'xaxis1' or 'xaxis' in traces,
+    figure layout and relayout events. For example, 'x1' -> 'xaxis' and
+    'y2' -> 'yaxis2'.
     
     Parameters
     ----------
-    sql_model_instance : instance of sqlalchemy model
-        Instance of sqlalchemy model.
+    axis_name : string
+        Name of an axis.
     
     Returns
     -------
-    model_plot : dict
-        Dict representing the plotly's figure.
-        Can be passed to dash's graph object.
+    layout_axis_name : string
+        Normalized name of the axis.
     """
     
-    model_plot = deepcopy(sql_model_instance.graphs.figure_obj)
+    axis_letter = axis_name[0]
+    axis_number = axis_name[1:].replace('axis', '')
     
-    for trace in model_plot['data']:
+    if axis_number == '1':
+        
+        axis_number = ''
     
-        trace['name'] = trace['name'] + " (Experiment ID: {})".format(sql_model_instance.id)
-                          
-    return model_plot
+    return axis_letter + 'axis' + axis_number
 
-                          
-def create_mutual_plot(sql_model_instances):
-    """Creates a mutual figure for multiple sql model instances of the same type.
-    
-    Extracts figures from each sql models instance and adds ID number of
-    the model to legends of each figure. This way curves of of different
-    sql model instances can be differentiated.
+
+def get_axis_ranges_from_relayout_data(relayout_data):
+    """Extracts ranges of zoomed axes from the relayoutData of dash's graph.
     
     Parameters
     ----------
-    sql_model_instances : list
-        List of instances of sqlalchemy model
+    relayout_data : dict
+        relayoutData property of dash's graph object. For example,
+        {'xaxis.range[0]': 10.5, 'xaxis.range[1]': 20.1}.
     
     Returns
     -------
-    mutual_figure : dict
-        Dict representing the plotly's figure.
-        Can be passed to dash's graph object.
+    axis_ranges : dict
+        Dict that maps normalized axis name (see get_layout_axis_name()) into
+        [start, end] list. Axes that were reset to autorange are absent.
     """
     
-    mutual_figure = {'data':[], 'layout': []}
+    axis_ranges = {}
+    
+    if not relayout_data:
+        
+        return axis_ranges
     
-    if sql_model_instances:
+    for key, value in relayout_data.items():
         
-        mutual_figure = create_model_plot_with_unique_legends(sql_model_instances[0])
+        match = re.match(r'^([xy]axis\d*)\.range(?:\[(\d)\])?$', key)
+        
+        if not match:
+            
+            continue
+        
+        axis_name = get_layout_axis_name(match.group(1))
+        
+        if match.group(2) is None:
+            
+            axis_ranges[axis_name] = list(value)
+            
+            continue
+        
+        axis_range = axis_ranges.setdefault(axis_name, [None, None])
+        axis_range[int(match.group(2))] = value
     
-    for sql_model_instance in sql_model_instances[1:]:
+    # Leaving only complete ranges
+    return dict((axis_name, axis_range) for axis_name, axis_range in axis_ranges.items()
+                if None not in axis_range)
+
+
+def apply_axis_ranges_to_layout(layout, axis_ranges):
+    """Fixes the ranges of zoomed axes in the layout, so that the zoom
+    is preserved when the figure is updated.
+    
+    Parameters
+    ----------
+    layout : dict
+        Plotly's dict representation of the layout, modified in place.
+    
+    axis_ranges : dict
+        See get_axis_ranges_from_relayout_data().
+    """
+    
+    for layout_key in layout:
+        
+        if not re.match(r'^[xy]axis\d*$', layout_key):
+            
+            continue
+        
+        axis_range = axis_ranges.get(get_layout_axis_name(layout_key))
+        
+        if axis_range:
+            
+            layout[layout_key]['range'] = axis_range
+            layout[layout_key]['autorange'] = False
+
+
+def create_model_plot_with_unique_legends(sql_model_instance, axis_ranges=None):
+    """Extracts the plot object form sql model instance and adds unique
+    id onto its legends.
+    
+    Extracts the figure object that can be passed to dash.Graph object
+    and displayed. Adds a unique ID (which is acquired from sql model instance
+    database ID) to its legends. This is useful when the figure needs to be
+    combined with figures of other sql model instances, otherwise it is impossible
+    to differentiate between objects in the figure.
+    
+    Parameters
+    ----------
+    sql_model_instance : instance of sqlalchemy model
+        Instance of sqlalchemy model.
+    
+    axis_ranges : dict
+        Optional ranges of zoomed axes, see create_model_traces_with_unique_legends().
+    
+    Returns
+    -------
+    model_plot : dict
+        Dict representing the plotly's figure.
+        Can be passed to dash's graph object.
+    """
+    
+    layout_template = get_graph_layout_template(sql_model_instance.__class__)
+    
+    model_plot = {'data': create_model_traces_with_unique_legends(sql_model_instance, axis_ranges),
+                  'layout': deepcopy(layout_template['layout'])}
+    
+    apply_axis_ranges_to_layout(model_plot['layout'], axis_ranges or {})
+                          
+    return model_plot
+
+
+def get_trace_step_ranges(layout_template, axis_ranges):
+    """Converts zoomed ranges of x axes into step ranges of respective traces.
+    
+    Parameters
+    ----------
+    layout_template : dict
+        See get_graph_layout_template().
+    
+    axis_ranges : dict
+        Dict that maps normalized axis names into [start, end]
+        ranges, see get_axis_ranges_from_relayout_data().
+    
+    Returns
+    -------
+    trace_step_ranges : dict
+        Dict that maps trace name into (first step, last step) pair.
+        Traces on not zoomed axes are absent. Smoothed copies of the
+        traces get the ranges of their traces.
+    """
+    
+    trace_step_ranges = {}
+    
+    for trace_name, (xaxis, yaxis) in layout_template['trace_axes'].items():
+        
+        axis_range = (axis_ranges or {}).get(get_layout_axis_name(xaxis))
+        
+        if axis_range:
+            
+            step_range = (int(math.floor(min(axis_range))), int(math.ceil(max(axis_range))))
+            
+            # Smoothed copies are displayed on the axes of their traces
+            for smoothed_trace_name in [trace_name] + [get_smoothed_trace_name(trace_name, smoothing_method)
+                                                       for smoothing_method in smoothing_methods]:
+                
+                trace_step_ranges[smoothed_trace_name] = step_range
+    
+    return trace_step_ranges
+
+
+# Key that marks a packed array in the figure, see encode_trace_array()
+TRACE_ARRAY_ENCODING_KEY = 'dash_deep_base64'
+
+# Largest step that fits into the packed int32 array
+MAX_INT32 = 2**31 - 1
+
+
+def encode_trace_array(values, dtype):
+    """Packs an array into base64 encoded little-endian raw bytes.
+
+    Parameters
+    ----------
+    values : list or numpy.ndarray
+        Values to pack.
+
+    dtype : string
+        'int32', 'float32' or 'float64'.
+
+    Returns
+    -------
+    encoded_array : dict
+        Dict with the dtype and the base64 encoded bytes, decoded by
+        dash_deep/static/trace_encoding.js.
+    """
+
+    values_bytes = np.ascontiguousarray(values, dtype=np.dtype(dtype).newbyteorder('<')).tobytes()
+
+    return {TRACE_ARRAY_ENCODING_KEY: base64.b64encode(values_bytes).decode('ascii'),
+            'dtype': dtype}
+
+
+def encode_trace_arrays(model_traces):
+    """Packs the x and y arrays of plotly's traces.
+
+    Steps are packed as int32 if they are all integers that fit into it,
+    as float64 otherwise. Values are packed as float32.
+
+    Parameters
+    ----------
+    model_traces : list of dicts
+        List of plotly's scatter traces.
+
+    Returns
+    -------
+    encoded_traces : list of dicts
+        Copies of the traces with packed arrays.
+    """
+
+    encoded_traces = []
+
+    for trace in model_traces:
+
+        steps = np.asarray(trace['x'])
+
+        steps_dtype = 'float64'
+
+        if steps.dtype.kind in 'iu' and (steps.size == 0 or (steps.min() >= 0 and steps.max() <= MAX_INT32)):
+
+            steps_dtype = 'int32'
+
+        encoded_trace = dict(trace)
+
+        encoded_trace['x'] = encode_trace_array(steps, steps_dtype)
+        encoded_trace['y'] = encode_trace_array(trace['y'], 'float32')
+
+        encoded_traces.append(encoded_trace)
+
+    return encoded_traces
+
+
+def create_model_traces_with_unique_legends(sql_model_instance,
+                                            axis_ranges=None,
+                                            traces=None,
+                                            trace_encoding=None,
+                                            smoothing=None):
+    """Extracts the traces of sql model instance and adds unique id onto
+    their legends.
+    
+    Same as create_model_plot_with_unique_legends() but without the layout,
+    so that traces of multiple experiments can be combined with one layout.
+    Traces longer than plot_points_per_trace are read from the rollups table
+    at a suitable resolution and downsampled. If the x axis of a trace is
+    zoomed, only the visible window is loaded, so the window is displayed
+    at full resolution whenever it fits into the points budget.
+    
+    Parameters
+    ----------
+    sql_model_instance : instance of sqlalchemy model
+        Instance of sqlalchemy model.
+    
+    axis_ranges : dict
+        Optional dict that maps normalized axis names into [start, end]
+        ranges, see get_axis_ranges_from_relayout_data().
+    
+    traces : dict
+        Optional already loaded traces of the experiment, see
+        rollups.load_experiment_traces_at_resolution(). Loaded
+        from the database if not specified.
+    
+    trace_encoding : string
+        'json' or 'base64', see plot_trace_encoding in dash_deep/app.py.
+        The configured one is used by default.
+    
+    smoothing : string
+        Optional smoothing method, see dash_deep/smoothing.py. The smoothed
+        copies of the traces are added and the traces are made transparent.
+        Traces without a smoothed copy are displayed as they are.
+    
+    Returns
+    -------
+    model_traces : list of dicts
+        List of plotly's scatter traces.
+    """
+    
+    layout_template = get_graph_layout_template(sql_model_instance.__class__)
+    graphs = sql_model_instance.graphs
+    
+    # Values are stored in the metric points table, the stored graph only
+    # carries the trace names. Experiments that were not migrated yet still
+    # have their values in the stored graph, so we keep them if
+    # the metric points table has nothing for a trace.
+    if traces is None:
+        
+        trace_names = list(graphs.graph_column_names)
+        
+        if smoothing:
+            
+            trace_names.extend(get_smoothed_trace_name(trace_name, smoothing)
+                               for trace_name in graphs.graph_column_names)
+        
+        traces = load_experiment_traces_at_resolution(sql_model_instance,
+                                                      plot_points_per_trace,
+                                                      get_trace_step_ranges(layout_template, axis_ranges),
+                                                      trace_names)
+    
+    downsampled_traces = {}
+    
+    for trace_name in graphs.graph_column_names:
+        
+        steps, values = traces.get(trace_name, graphs.get_trace(trace_name))
+        
+        downsampled_traces[trace_name] = downsample_trace(steps,
+                                                          values,
+                                                          plot_points_per_trace,
+                                                          plot_downsampling_method)
+    
+    model_traces = graphs.get_figure_data(layout_template, downsampled_traces)
+    
+    if smoothing:
+        
+        smoothed_traces = create_smoothed_traces(graphs, layout_template, traces, smoothing)
+        
+        # Noisy traces stay visible behind their smoothed copies
+        if smoothed_traces:
+            
+            for trace in model_traces:
+                
+                trace['opacity'] = 0.3
+        
+        model_traces.extend(smoothed_traces)
+    
+    for trace in model_traces:
+    
+        trace['name'] = trace['name'] + " (Experiment ID: {})".format(sql_model_instance.id)
+    
+    if (trace_encoding or plot_trace_encoding) == 'base64':
+        
+        model_traces = encode_trace_arrays(model_traces)
+    
+    return model_traces
+
+
+
+def create_smoothed_traces(graphs, layout_template, traces, smoothing):
+    """Creates plotly's traces of the smoothed copies of the traces of an experiment.
+    
+    Parameters
+    ----------
+    graphs : BaseGraph
+        Graph of the experiment.
+    
+    layout_template : dict
+        See get_graph_layout_template().
+    
+    traces : dict
+        Loaded traces of the experiment including the smoothed copies.
+    
+    smoothing : string
+        Smoothing method, see dash_deep/smoothing.py.
+    
+    Returns
+    -------
+    smoothed_traces : list of dicts
+        List of plotly's scatter traces.
+    """
+    
+    smoothed_traces = []
+    
+    for trace_name in graphs.graph_column_names:
+        
+        smoothed_trace_name = get_smoothed_trace_name(trace_name, smoothing)
+        
+        if trace_name not in layout_template['trace_axes'] or smoothed_trace_name not in traces:
+            
+            continue
+        
+        steps, values = traces[smoothed_trace_name]
+        
+        steps, values = downsample_trace(steps, values, plot_points_per_trace, plot_downsampling_method)
+        
+        xaxis, yaxis = layout_template['trace_axes'][trace_name]
+        
+        smoothed_traces.append({'type': 'scatter',
+                                'x': list(steps),
+                                'y': list(values),
+                                'name': '{} {}'.format(convert_column_name_to_legend_name(trace_name),
+                                                       get_smoothing_legend_suffix(smoothing)),
+                                'xaxis': xaxis,
+                                'yaxis': yaxis})
+    
+    return smoothed_traces
+
+
+def get_hyperparameter_column_names(sql_model_class):
+    """Returns the names of the columns that are chosen before an experiment is run.
+    
+    These are the columns of the input form (see sql.generate_script_wtform_class_instance())
+    except for the gpu and the priority, which don't affect the results.
+    """
+    
+    excluded_column_names = set(sql_model_class.exclude_from_form) | set(['id', 'gpu_id', 'priority'])
+    
+    return [column.name for column in sql_model_class.__table__.columns
+            if column.name not in excluded_column_names]
+
+
+def group_experiments_by_hyperparameters(sql_model_instances):
+    """Groups the experiments that differ only by the random seed.
+    
+    Parameters
+    ----------
+    sql_model_instances : list
+        List of instances of sqlalchemy model of the same type.
+    
+    Returns
+    -------
+    groups : list
+        List of (hyperparameters, sql model instances) pairs where
+        hyperparameters is a list of (column name, value) pairs. Groups
+        are ordered by the smallest id of their experiments.
+    """
+    
+    if not sql_model_instances:
+        
+        return []
+    
+    column_names = get_hyperparameter_column_names(sql_model_instances[0].__class__)
+    
+    groups = OrderedDict()
+    
+    for sql_model_instance in sorted(sql_model_instances, key=lambda sql_model_instance: sql_model_instance.id):
+        
+        hyperparameters = tuple((column_name, getattr(sql_model_instance, column_name)) for column_name in column_names)
+        
+        groups.setdefault(hyperparameters, []).append(sql_model_instance)
+    
+    return [(list(hyperparameters), group_instances) for hyperparameters, group_instances in groups.items()]
+
+
+def convert_color_to_rgba(color, opacity):
+    """Converts 'rgb(r, g, b)' color into 'rgba(r, g, b, opacity)'."""
+    
+    return 'rgba' + color[color.index('('):-1] + ', {})'.format(opacity)
+
+
+def create_group_traces(sql_model_instances,
+                        hyperparameters,
+                        color,
+                        axis_ranges=None,
+                        live_trace_cache=None,
+                        trace_encoding=None,
+                        smoothing=None):
+    """Creates the traces of per-step statistics of a group of experiments.
+    
+    Each trace of the experiments is displayed as a band between the minimum
+    and the maximum, a darker band of the standard deviation around the mean
+    and the line of the mean. The traces are aligned and aggregated with
+    aggregation.aggregate_traces(). All the traces of a trace name share
+    the legend group, so they are hidden together.
+    
+    Parameters
+    ----------
+    sql_model_instances : list
+        Experiments of the group.
+    
+    hyperparameters : list
+        (column name, value) pairs shared by the group, displayed in the legend.
+    
+    color : string
+        'rgb(r, g, b)' color of the group.
+    
+    axis_ranges : dict
+        See create_model_traces_with_unique_legends().
+    
+    live_trace_cache : live.LiveTraceCache
+        Optional cache to take the traces from instead of the database.
+    
+    trace_encoding : string
+        See create_model_traces_with_unique_legends().
+    
+    smoothing : string
+        Optional smoothing method, the statistics of the smoothed copies of
+        the traces are displayed instead, see dash_deep/smoothing.py.
+    
+    Returns
+    -------
+    group_traces : list of dicts
+        List of plotly's scatter traces.
+    """
+    
+    layout_template = get_graph_layout_template(sql_model_instances[0].__class__)
+    trace_step_ranges = get_trace_step_ranges(layout_template, axis_ranges)
+    
+    experiments_traces = []
+    
+    for sql_model_instance in sql_model_instances:
+        
+        if live_trace_cache is not None:
+            
+            experiments_traces.append(live_trace_cache.get_traces(sql_model_instance, axis_ranges))
+        else:
+            
+            trace_names = list(sql_model_instance.graphs.graph_column_names)
+            
+            if smoothing:
+                
+                trace_names.extend(get_smoothed_trace_name(trace_name, smoothing)
+                                   for trace_name in sql_model_instance.graphs.graph_column_names)
+            
+            experiments_traces.append(load_experiment_traces_at_resolution(sql_model_instance,
+                                                                           plot_points_per_trace,
+                                                                           trace_step_ranges,
+                                                                           trace_names))
+    
+    group_name = ', '.join('{}={}'.format(column_name, value) for column_name, value in hyperparameters)
+    
+    group_traces = []
+    
+    for trace_name in sql_model_instances[0].graphs.graph_column_names:
+        
+        if trace_name not in layout_template['trace_axes']:
+            
+            continue
+        
+        source_trace_name = trace_name
+        
+        if smoothing:
+            
+            source_trace_name = get_smoothed_trace_name(trace_name, smoothing)
+        
+        group_traces_of_trace = []
+        
+        for experiment_traces in experiments_traces:
+            
+            # Experiments without the smoothed copy contribute their trace
+            for experiment_trace_name in (source_trace_name, trace_name):
+                
+                if experiment_trace_name in experiment_traces:
+                    
+                    group_traces_of_trace.append(experiment_traces[experiment_trace_name])
+                    break
+        
+        statistics = aggregate_traces(group_traces_of_trace, plot_points_per_trace)
+        
+        if statistics is None:
+            
+            continue
+        
+        xaxis, yaxis = layout_template['trace_axes'][trace_name]
+        
+        legend_name = '{} (Group: {}; {} experiments)'.format(convert_column_name_to_legend_name(trace_name),
+                                                              group_name,
+                                                              len(sql_model_instances))
+        
+        if smoothing:
+            
+            legend_name = '{} {}'.format(legend_name, get_smoothing_legend_suffix(smoothing))
+        
+        steps = statistics['steps'].tolist()
+        
+        # The fill of a band goes from its second edge to the previous trace
+        band_edges = [('max', statistics['max'], None, 0.1),
+                      ('min', statistics['min'], 'tonexty', 0.1),
+                      ('mean + std', statistics['mean'] + statistics['std'], None, 0.25),
+                      ('mean - std', statistics['mean'] - statistics['std'], 'tonexty', 0.25)]
+        
+        for edge_name, values, fill, opacity in band_edges:
+            
+            trace = {'type': 'scatter',
+                     'mode': 'lines',
+                     'x': steps,
+                     'y': values.tolist(),
+                     'name': '{} {}'.format(legend_name, edge_name),
+                     'legendgroup': legend_name,
+                     'showlegend': False,
+                     'line': {'width': 0, 'color': color},
+                     'xaxis': xaxis,
+                     'yaxis': yaxis}
+            
+            if fill:
+                
+                trace['fill'] = fill
+                trace['fillcolor'] = convert_color_to_rgba(color, opacity)
+            
+            group_traces.append(trace)
+        
+        group_traces.append({'type': 'scatter',
+                             'mode': 'lines',
+                             'x': steps,
+                             'y': statistics['mean'].tolist(),
+                             'name': legend_name,
+                             'legendgroup': legend_name,
+                             'line': {'color': color},
+                             'xaxis': xaxis,
+                             'yaxis': yaxis})
+    
+    if (trace_encoding or plot_trace_encoding) == 'base64':
+        
+        group_traces = encode_trace_arrays(group_traces)
+    
+    return group_traces
+
+
+def get_experiment_cache_key(sql_model_instance):
+    """Returns the key of an experiment in the in-memory caches of its traces.
+
+    SQLite reuses the ids of deleted rows, so the creation time is a part
+    of the key and an experiment that took the id of a deleted one doesn't
+    receive the cached traces of the deleted experiment.
+    """
+
+    return (sql_model_instance.__tablename__,
+            sql_model_instance.id,
+            sql_model_instance.created_at)
+
+                          
+class FigureFragmentCache(object):
+    """Keeps the legend-tagged traces of recently plotted experiments.
+
+    Traces of an experiment are fully determined by its version and the
+    zoomed ranges, so they are cached under these keys and a comparison
+    of multiple experiments is assembled by joining the cached lists.
+    Finished experiments don't change their version, so their traces are
+    built only once. Cached traces are shared by all the figures and
+    should not be modified.
+
+    Entries are evicted in least recently used order.
+
+    """
+
+    def __init__(self, maximum_size=figure_fragment_cache_size):
+
+        self.maximum_size = maximum_size
+
+        self.fragments = OrderedDict()
+
+        self.lock = threading.Lock()
+
+        self.number_of_hits = 0
+        self.number_of_misses = 0
+
+
+    def get_model_traces(self,
+                         sql_model_instance,
+                         version,
+                         axis_ranges=None,
+                         live_trace_cache=None,
+                         trace_encoding=None,
+                         smoothing=None):
+        """Returns the cached traces of an experiment or creates them.
+
+        Parameters
+        ----------
+        sql_model_instance : instance of sqlalchemy model
+            Instance of sqlalchemy model.
+
+        version : int
+            Version of the experiment that was read before its traces,
+            so that the traces are never older than the version they
+            are cached under.
+
+        axis_ranges : dict
+            See create_model_traces_with_unique_legends().
+
+        live_trace_cache : live.LiveTraceCache
+            Optional cache to take the traces from instead of the database.
+
+        trace_encoding, smoothing : string
+            See create_model_traces_with_unique_legends().
+
+        Returns
+        -------
+        model_traces : list of dicts
+            List of plotly's scatter traces.
+        """
+
+        trace_encoding = trace_encoding or plot_trace_encoding
+
+        key = (get_experiment_cache_key(sql_model_instance),
+               version,
+               json.dumps(sorted((axis_ranges or {}).items())),
+               trace_encoding,
+               smoothing)
+
+        def create_fragment():
+
+            traces = None
+
+            if live_trace_cache is not None:
+
+                traces = live_trace_cache.get_traces(sql_model_instance, axis_ranges)
+
+            return create_model_traces_with_unique_legends(sql_model_instance,
+                                                           axis_ranges,
+                                                           traces,
+                                                           trace_encoding,
+                                                           smoothing)
+
+        return self.get_fragment(key, create_fragment)
+
+
+    def get_group_traces(self,
+                         sql_model_instances,
+                         versions,
+                         hyperparameters,
+                         color,
+                         axis_ranges=None,
+                         live_trace_cache=None,
+                         trace_encoding=None,
+                         smoothing=None):
+        """Returns the cached statistics traces of a group of experiments or creates them.
+
+        The traces are cached under the versions of all the experiments
+        of the group, so they are recomputed only if one of them changed.
+
+        Parameters
+        ----------
+        versions : list of ints
+            Versions of the experiments, see get_model_traces().
+
+        For the rest of the parameters see create_group_traces().
+
+        Returns
+        -------
+        group_traces : list of dicts
+            List of plotly's scatter traces.
+        """
+
+        trace_encoding = trace_encoding or plot_trace_encoding
+
+        key = ('group',
+               sql_model_instances[0].__tablename__,
+               tuple(zip([(sql_model_instance.id, sql_model_instance.created_at)
+                          for sql_model_instance in sql_model_instances], versions)),
+               json.dumps(sorted((axis_ranges or {}).items())),
+               trace_encoding,
+               smoothing,
+               color)
+
+        return self.get_fragment(key, lambda: create_group_traces(sql_model_instances,
+                                                                  hyperparameters,
+                                                                  color,
+                                                                  axis_ranges,
+                                                                  live_trace_cache,
+                                                                  trace_encoding,
+                                                                  smoothing))
+
+
+    def get_fragment(self, key, create_fragment):
+        """Returns the cached fragment or creates it with create_fragment()."""
+
+        with self.lock:
+
+            fragment = self.fragments.pop(key, None)
+
+            if fragment is not None:
+
+                self.fragments[key] = fragment
+                self.number_of_hits += 1
+
+                return fragment
+
+        fragment = create_fragment()
+
+        with self.lock:
+
+            self.number_of_misses += 1
+
+            self.fragments[key] = fragment
+
+            while len(self.fragments) > self.maximum_size:
+
+                self.fragments.popitem(last=False)
+
+        return fragment
+
+
+    def clear(self):
+        """Drops all the cached traces."""
+
+        with self.lock:
+
+            self.fragments.clear()
+
+
+    def get_statistics(self):
+        """Returns the counters of the cache.
+
+        Returns
+        -------
+        statistics : dict
+            Number of cached fragments, fragments returned
+            from the cache (hits) and fragments created.
+        """
+
+        with self.lock:
+
+            return {'number_of_fragments': len(self.fragments),
+                    'number_of_hits': self.number_of_hits,
+                    'number_of_misses': self.number_of_misses}
+
+
+figure_fragment_cache = FigureFragmentCache()
+
+
+def figure_cache_stats_view():
+    """Returns the statistics of the figure fragment cache as json."""
+
+    return flask.jsonify(figure_fragment_cache.get_statistics())
+
+
+# Views registered after the dash auth object was created are not
+# protected automatically
+server.add_url_rule('/figures/stats', 'figure_cache_stats', auth.auth_wrapper(figure_cache_stats_view))
+
+
+def create_mutual_plot(sql_model_instances,
+                       relayout_data=None,
+                       live_trace_cache=None,
+                       experiment_versions=None,
+                       trace_encoding=None,
+                       group_by_hyperparameters=False,
+                       smoothing=None):
+    """Creates a mutual figure for multiple sql model instances of the same type.
+    
+    Extracts traces from each sql models instance and adds ID number of
+    the model to legends of each trace. This way curves of of different
+    sql model instances can be differentiated. The layout is shared by
+    all the instances of a model class and is added only once. Traces of
+    each experiment are taken from the figure fragment cache, so the figure
+    is assembled by joining the lists of traces of the experiments.
+    
+    Parameters
+    ----------
+    sql_model_instances : list
+        List of instances of sqlalchemy model
+    
+    relayout_data : dict
+        Optional relayoutData of dash's graph. Zoomed windows are reloaded
+        at full resolution and the zoom is preserved in the returned figure.
+    
+    live_trace_cache : live.LiveTraceCache
+        Optional cache to take the traces from instead of the database.
+    
+    experiment_versions : dict
+        Optional dict that maps experiment id into the version of the
+        experiment that was read before its traces were loaded into the
+        live trace cache. Versions of the instances are used by default.
+    
+    trace_encoding : string
+        See create_model_traces_with_unique_legends().
+    
+    group_by_hyperparameters : bool
+        Whether to display experiments that share all the hyperparameters
+        as bands of their per-step statistics, see create_group_traces().
+        Experiments without a pair are displayed as they are.
+    
+    smoothing : string
+        Optional smoothing method, see create_model_traces_with_unique_legends()
+        and create_group_traces().
+    
+    Returns
+    -------
+    mutual_figure : dict
+        Dict representing the plotly's figure.
+        Can be passed to dash's graph object.
+    """
+    
+    mutual_figure = {'data':[], 'layout': []}
+    
+    if not sql_model_instances:
+        
+        return mutual_figure
+    
+    axis_ranges = get_axis_ranges_from_relayout_data(relayout_data)
+    
+    layout_template = get_graph_layout_template(sql_model_instances[0].__class__)
+    
+    # The template is shared, it is copied only if it has to be modified
+    mutual_figure['layout'] = layout_template['layout']
+    
+    if axis_ranges:
+        
+        mutual_figure['layout'] = deepcopy(layout_template['layout'])
+        
+        apply_axis_ranges_to_layout(mutual_figure['layout'], axis_ranges)
+    
+    def get_version(sql_model_instance):
+        
+        return (experiment_versions or {}).get(sql_model_instance.id, sql_model_instance.version)
+    
+    if group_by_hyperparameters:
+        
+        groups = group_experiments_by_hyperparameters(sql_model_instances)
+    else:
+        
+        groups = [(None, [sql_model_instance]) for sql_model_instance in sql_model_instances]
+    
+    number_of_groups = 0
+    
+    for hyperparameters, group_instances in groups:
+        
+        if len(group_instances) == 1:
+            
+            mutual_figure['data'].extend(figure_fragment_cache.get_model_traces(group_instances[0],
+                                                                                get_version(group_instances[0]),
+                                                                                axis_ranges,
+                                                                                live_trace_cache,
+                                                                                trace_encoding,
+                                                                                smoothing))
+            continue
         
-        current_model_plot_with_unique_legends = create_model_plot_with_unique_legends(sql_model_instance)
+        color = DEFAULT_PLOTLY_COLORS[number_of_groups % len(DEFAULT_PLOTLY_COLORS)]
+        number_of_groups += 1
         
-        mutual_figure['data'] = mutual_figure['data'] + current_model_plot_with_unique_legends['data']
+        mutual_figure['data'].extend(figure_fragment_cache.get_group_traces(group_instances,
+                                                                            [get_version(group_instance)
+                                                                             for group_instance in group_instances],
+                                                                            hyperparameters,
+                                                                            color,
+                                                                            axis_ranges,
+                                                                            live_trace_cache,
+                                                                            trace_encoding,
+                                                                            smoothing))
     
-    return mutual_figure
\ No newline at end of file
+    return mutual_figure
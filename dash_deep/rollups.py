@@ -0,0 +1,524 @@
+from dash_deep.app import db
+from dash_deep.metrics import MetricPoint, get_next_trace_steps
+
+import numpy as np
+
+
+# Bucket of level L covers 2 ** L consecutive steps. Level 0 is
+# represented by the raw metric points table itself.
+MAX_ROLLUP_LEVEL = 16
+
+
+class MetricRollup(db.Model):
+    """Aggregated values of a power-of-two bucket of steps of a trace.
+
+    Rollups form a pyramid above the metric points table: bucket number b of
+    level L aggregates the points with steps in [b * 2 ** L, (b + 1) * 2 ** L).
+    Only complete buckets are stored -- a bucket is written once a point of
+    a later bucket is reported, the points of the open buckets are read from
+    the metric points table directly. This way the rows never change after
+    being written and can be safely written more than once.
+
+    """
+
+    __tablename__ = 'metric_rollups'
+
+    id = db.Column(db.Integer, primary_key=True)
+    experiment_table = db.Column(db.String(120), nullable=False)
+    experiment_id = db.Column(db.Integer, nullable=False)
+    trace_name = db.Column(db.String(120), nullable=False)
+    level = db.Column(db.Integer, nullable=False)
+    bucket = db.Column(db.Integer, nullable=False)
+    minimum = db.Column(db.Float, nullable=False)
+    maximum = db.Column(db.Float, nullable=False)
+    mean = db.Column(db.Float, nullable=False)
+    last = db.Column(db.Float, nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (db.Index('ix_metric_rollups_experiment_trace_level_bucket',
+                               'experiment_table',
+                               'experiment_id',
+                               'trace_name',
+                               'level',
+                               'bucket',
+                               unique=True),)
+
+
+# Rollups can be written both by the experiment process and by the lazy
+# rebuild in the server process, replacing makes these writes idempotent
+metric_rollups_insert_statement = MetricRollup.__table__.insert().prefix_with('OR REPLACE')
+
+
+class MetricRollupBuilder(object):
+    """Maintains the open buckets of all the levels of the traces of an
+    experiment and emits rollup rows once buckets are complete.
+
+    Each reported point updates the open bucket of every level, so it costs
+    MAX_ROLLUP_LEVEL small updates and, on average, less than one rollup row.
+
+    """
+
+    def __init__(self, experiment_table, experiment_id):
+
+        self.experiment_table = experiment_table
+        self.experiment_id = experiment_id
+
+        # Maps trace name into a list with the open bucket of each level,
+        # bucket is represented as [bucket, minimum, maximum, total, last, count]
+        self.open_buckets = {}
+
+
+    def add_metric_points(self, metric_points):
+        """Adds reported points to the open buckets.
+
+        Parameters
+        ----------
+        metric_points : list of dicts
+            Rows of the metric points table with increasing steps for each trace.
+
+        Returns
+        -------
+        metric_rollups : list of dicts
+            Rows of the rollups table for the buckets that were completed.
+        """
+
+        metric_rollups = []
+
+        for metric_point in metric_points:
+
+            self.add_point(metric_point['trace_name'],
+                           metric_point['step'],
+                           metric_point['value'],
+                           metric_rollups)
+
+        return metric_rollups
+
+
+    def add_point(self, trace_name, step, value, metric_rollups):
+
+        trace_open_buckets = self.open_buckets.setdefault(trace_name, [None] * (MAX_ROLLUP_LEVEL + 1))
+
+        for level in range(1, MAX_ROLLUP_LEVEL + 1):
+
+            bucket = step >> level
+            open_bucket = trace_open_buckets[level]
+
+            if open_bucket is not None and open_bucket[0] == bucket:
+
+                open_bucket[1] = min(open_bucket[1], value)
+                open_bucket[2] = max(open_bucket[2], value)
+                open_bucket[3] += value
+                open_bucket[4] = value
+                open_bucket[5] += 1
+
+                continue
+
+            if open_bucket is not None and metric_rollups is not None:
+
+                metric_rollups.append(self.create_metric_rollup(trace_name, level, open_bucket))
+
+            trace_open_buckets[level] = [bucket, value, value, value, value, 1]
+
+
+    def seed(self, trace_name, steps, values):
+        """Restores the open buckets of a trace from already stored points.
+
+        The points should start at a boundary of a bucket of the highest level
+        and the rollups of the buckets that they complete should already be
+        written, see rebuild_experiment_rollups().
+        """
+
+        for step, value in zip(steps, values):
+
+            self.add_point(trace_name, step, value, None)
+
+
+    def create_metric_rollup(self, trace_name, level, open_bucket):
+
+        bucket, minimum, maximum, total, last, count = open_bucket
+
+        return {'experiment_table': self.experiment_table,
+                'experiment_id': self.experiment_id,
+                'trace_name': trace_name,
+                'level': level,
+                'bucket': bucket,
+                'minimum': minimum,
+                'maximum': maximum,
+                'mean': total / count,
+                'last': last,
+                'count': count}
+
+
+def compute_trace_rollups(experiment_table, experiment_id, trace_name, steps, values):
+    """Computes rollup rows of all the complete buckets of a trace at once.
+
+    Parameters
+    ----------
+    steps : numpy.ndarray
+        Increasing steps of the trace.
+
+    values : numpy.ndarray
+        Respective values.
+
+    Returns
+    -------
+    metric_rollups : list of dicts
+        Rows of the rollups table.
+    """
+
+    metric_rollups = []
+
+    if len(steps) == 0:
+
+        return metric_rollups
+
+    for level in range(1, MAX_ROLLUP_LEVEL + 1):
+
+        point_buckets = steps >> level
+
+        # Steps are sorted, so the points of a bucket are contiguous
+        buckets, bucket_starts, counts = np.unique(point_buckets, return_index=True, return_counts=True)
+
+        # The last bucket is still open
+        number_of_complete_buckets = len(buckets) - 1
+
+        if number_of_complete_buckets == 0:
+
+            break
+
+        # reduceat() reduces the last bucket up to the end of the array
+        complete_values = values[:bucket_starts[number_of_complete_buckets]]
+
+        buckets = buckets[:number_of_complete_buckets]
+        bucket_starts = bucket_starts[:number_of_complete_buckets]
+        counts = counts[:number_of_complete_buckets]
+
+        minimums = np.minimum.reduceat(complete_values, bucket_starts)
+        maximums = np.maximum.reduceat(complete_values, bucket_starts)
+        means = np.add.reduceat(complete_values, bucket_starts) / counts
+        lasts = values[bucket_starts + counts - 1]
+
+        for bucket, minimum, maximum, mean, last, count in zip(buckets.tolist(),
+                                                               minimums.tolist(),
+                                                               maximums.tolist(),
+                                                               means.tolist(),
+                                                               lasts.tolist(),
+                                                               counts.tolist()):
+
+            metric_rollups.append({'experiment_table': experiment_table,
+                                   'experiment_id': experiment_id,
+                                   'trace_name': trace_name,
+                                   'level': level,
+                                   'bucket': bucket,
+                                   'minimum': minimum,
+                                   'maximum': maximum,
+                                   'mean': mean,
+                                   'last': last,
+                                   'count': count})
+
+    return metric_rollups
+
+
+def load_trace_points(sql_model_instance, trace_name, first_step=None, last_step=None):
+    """Loads steps and values of a trace as numpy arrays."""
+
+    query = db.session.query(MetricPoint.step, MetricPoint.value)
+
+    query = query.filter(MetricPoint.experiment_table == sql_model_instance.__tablename__,
+                         MetricPoint.experiment_id == sql_model_instance.id,
+                         MetricPoint.trace_name == trace_name)
+
+    if first_step is not None:
+
+        query = query.filter(MetricPoint.step >= first_step)
+
+    if last_step is not None:
+
+        query = query.filter(MetricPoint.step <= last_step)
+
+    points = query.order_by(MetricPoint.step).all()
+
+    steps = np.array([step for step, value in points], dtype=np.int64)
+    values = np.array([value for step, value in points], dtype=np.float64)
+
+    return steps, values
+
+
+def rebuild_experiment_rollups(sql_model_instance):
+    """Recomputes the rollups of all the traces of an experiment from its points.
+
+    Used for experiments recorded before the rollups were introduced
+    and for experiments that are being resumed. The traces are taken from
+    the metric points, so the smoothed traces get their rollups too.
+
+    Parameters
+    ----------
+    sql_model_instance : sqlalchemy model instance
+        Experiment to rebuild the rollups of.
+    """
+
+    for trace_name in get_next_trace_steps(sql_model_instance):
+
+        steps, values = load_trace_points(sql_model_instance, trace_name)
+
+        metric_rollups = compute_trace_rollups(sql_model_instance.__tablename__,
+                                               sql_model_instance.id,
+                                               trace_name,
+                                               steps,
+                                               values)
+
+        if metric_rollups:
+
+            db.session.execute(metric_rollups_insert_statement, metric_rollups)
+
+    db.session.commit()
+
+
+def seed_metric_rollup_builder(metric_rollup_builder, sql_model_instance, trace_next_steps):
+    """Restores the open buckets of a resumed experiment.
+
+    The rollups are rebuilt first, then the points of the open bucket of the
+    highest level are replayed through the builder.
+
+    Parameters
+    ----------
+    metric_rollup_builder : MetricRollupBuilder
+        Builder of the resumed experiment.
+
+    sql_model_instance : sqlalchemy model instance
+        Resumed experiment.
+
+    trace_next_steps : dict
+        See metrics.get_next_trace_steps().
+    """
+
+    rebuild_experiment_rollups(sql_model_instance)
+
+    for trace_name, next_step in trace_next_steps.items():
+
+        first_step = ((next_step - 1) >> MAX_ROLLUP_LEVEL) << MAX_ROLLUP_LEVEL
+
+        steps, values = load_trace_points(sql_model_instance, trace_name, first_step=first_step)
+
+        metric_rollup_builder.seed(trace_name, steps.tolist(), values.tolist())
+
+
+def get_last_trace_step(sql_model_instance, trace_name):
+    """Returns the last step of a trace or None if it has no points.
+
+    A separate query per trace lets sqlite answer it with a single
+    lookup in the index of the metric points table.
+    """
+
+    query = db.session.query(db.func.max(MetricPoint.step))
+
+    query = query.filter(MetricPoint.experiment_table == sql_model_instance.__tablename__,
+                         MetricPoint.experiment_id == sql_model_instance.id,
+                         MetricPoint.trace_name == trace_name)
+
+    return query.scalar()
+
+
+def ensure_experiment_rollups(sql_model_instance):
+    """Lazily builds the rollups of an experiment recorded before they existed."""
+
+    query = MetricRollup.query.filter(MetricRollup.experiment_table == sql_model_instance.__tablename__,
+                                      MetricRollup.experiment_id == sql_model_instance.id)
+
+    if db.session.query(query.exists()).scalar():
+
+        return
+
+    # Experiments with less than two points at each trace don't have
+    # a single complete bucket, nothing to rebuild
+    last_steps = [get_last_trace_step(sql_model_instance, trace_name)
+                  for trace_name in sql_model_instance.graphs.graph_column_names]
+
+    if all(last_step is None or last_step < 2 for last_step in last_steps):
+
+        return
+
+    rebuild_experiment_rollups(sql_model_instance)
+
+
+def get_stored_rollup_level(sql_model_instance, trace_name):
+    """Returns the lowest rollup level stored for a trace or 0 if it has no rollups.
+
+    Archived experiments keep the rollups of a single level only
+    (see dash_deep/archive.py).
+    """
+
+    query = db.session.query(db.func.min(MetricRollup.level))
+
+    query = query.filter(MetricRollup.experiment_table == sql_model_instance.__tablename__,
+                         MetricRollup.experiment_id == sql_model_instance.id,
+                         MetricRollup.trace_name == trace_name)
+
+    return query.scalar() or 0
+
+
+def get_rollup_level(number_of_steps, number_of_points):
+    """Picks the lowest level which has at most number_of_points / 2 buckets in
+    the specified number of steps -- each bucket is displayed with two points.
+
+    Returns 0 if the raw points fit into the budget.
+    """
+
+    level = 0
+
+    while level < MAX_ROLLUP_LEVEL and (number_of_steps >> level) * 2 > number_of_points:
+
+        level += 1
+
+    return level
+
+
+def load_trace_at_resolution(sql_model_instance, trace_name, number_of_points, step_range=None):
+    """Loads a trace with approximately number_of_points points.
+
+    If the trace (or its window) has more steps than the budget allows, the
+    complete buckets of the suitable rollup level are loaded and displayed as
+    their minimum and maximum values, the steps after the last complete bucket
+    are loaded from the metric points table. The amount of loaded rows
+    doesn't depend on the length of the trace.
+
+    Archived experiments keep only the points and the rollups needed for a
+    single level in the database, other levels are computed from the archive
+    file (see dash_deep/archive.py).
+
+    Parameters
+    ----------
+    sql_model_instance : sqlalchemy model instance
+        Experiment to load the trace of.
+
+    trace_name : string
+        Name of the trace.
+
+    number_of_points : int
+        Desired number of points.
+
+    step_range : tuple
+        Optional (first step, last step) window.
+
+    Returns
+    -------
+    steps, values : numpy.ndarray
+        Steps and values of the trace.
+    """
+
+    last_step = get_last_trace_step(sql_model_instance, trace_name)
+
+    if last_step is None:
+
+        return np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+
+    first_step = 0
+
+    if step_range:
+
+        first_step = max(step_range[0], 0)
+        last_step = min(step_range[1], last_step)
+
+    level = get_rollup_level(last_step - first_step + 1, number_of_points)
+
+    if sql_model_instance.archived_at is not None:
+
+        stored_level = get_stored_rollup_level(sql_model_instance, trace_name)
+
+        if level != stored_level:
+
+            # Imported here, since the archive depends on this module
+            from dash_deep.archive import load_archived_trace_at_level
+
+            archived_trace = load_archived_trace_at_level(sql_model_instance, trace_name, level, first_step, last_step)
+
+            if archived_trace is not None:
+
+                return archived_trace
+
+            # The archive file is not available, the stored level
+            # is displayed instead of not displaying anything
+            level = stored_level
+
+    if level == 0:
+
+        return load_trace_points(sql_model_instance, trace_name, first_step, last_step)
+
+    query = db.session.query(MetricRollup.bucket, MetricRollup.minimum, MetricRollup.maximum)
+
+    query = query.filter(MetricRollup.experiment_table == sql_model_instance.__tablename__,
+                         MetricRollup.experiment_id == sql_model_instance.id,
+                         MetricRollup.trace_name == trace_name,
+                         MetricRollup.level == level,
+                         MetricRollup.bucket >= first_step >> level,
+                         MetricRollup.bucket <= last_step >> level)
+
+    rollups = query.order_by(MetricRollup.bucket).all()
+
+    tail_first_step = first_step
+
+    if rollups:
+
+        tail_first_step = (rollups[-1][0] + 1) << level
+
+    tail_steps, tail_values = load_trace_points(sql_model_instance, trace_name, tail_first_step, last_step)
+
+    bucket_width = 1 << level
+
+    # Each bucket is displayed as a vertical segment between its minimum
+    # and maximum in the middle of the bucket
+    bucket_middles = np.array([bucket for bucket, minimum, maximum in rollups], dtype=np.int64) * bucket_width + bucket_width // 2
+
+    rollup_steps = np.repeat(bucket_middles, 2)
+    rollup_values = np.array([[minimum, maximum] for bucket, minimum, maximum in rollups],
+                             dtype=np.float64).reshape(-1)
+
+    steps = np.concatenate((rollup_steps, tail_steps))
+    values = np.concatenate((rollup_values, tail_values))
+
+    return steps, values
+
+
+def load_experiment_traces_at_resolution(sql_model_instance, number_of_points, trace_step_ranges=None, trace_names=None):
+    """Loads all the traces of an experiment with approximately number_of_points
+    points each, see load_trace_at_resolution().
+
+    Parameters
+    ----------
+    sql_model_instance : sqlalchemy model instance
+        Experiment to load the traces of.
+
+    number_of_points : int
+        Desired number of points of each trace.
+
+    trace_step_ranges : dict
+        Optional dict that maps trace name into (first step, last step) window.
+
+    trace_names : list
+        Names of the traces to load, the traces of the graph by default.
+
+    Returns
+    -------
+    traces : dict
+        Dict that maps trace name into (steps, values) pair. Traces
+        without any points are absent.
+    """
+
+    ensure_experiment_rollups(sql_model_instance)
+
+    traces = {}
+
+    for trace_name in trace_names or sql_model_instance.graphs.graph_column_names:
+
+        step_range = (trace_step_ranges or {}).get(trace_name)
+
+        steps, values = load_trace_at_resolution(sql_model_instance,
+                                                 trace_name,
+                                                 number_of_points,
+                                                 step_range)
+
+        if len(steps):
+
+            traces[trace_name] = (steps, values)
+
+    return traces
@@ -1,5 +1,5 @@
-from dash_deep.app import models_save_folder_path
 from dash_deep.logging import Experiment
+from dash_deep.model_store import load_checkpoint
 from time import sleep
 
 import sys, os
@@ -99,15 +99,28 @@ def run(sql_db_model):
         32 is the worst.
     """
     
+    # Results are written from a background thread, so the training loop
+    # doesn't wait for the database. Leaving the with block flushes them
+    # even if the training has failed.
+    with Experiment(sql_db_model, buffered=True) as experiment:
+        
+        return train(sql_db_model, experiment)
+
+
+def train(sql_db_model, experiment):
+    """Training loop of run() that reports its results to the experiment."""
     
     batch_size = sql_db_model.batch_size
     learning_rate = sql_db_model.learning_rate
     output_stride = sql_db_model.output_stride
     gpu_id = sql_db_model.gpu_id
     
-    os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu_id)
-    
-    experiment = Experiment(sql_db_model)
+    # Tasks started from the pages get the gpu assigned by the scheduler
+    # (see dash_deep/task.py), the gpu_id is only used when the script
+    # is run directly
+    if 'CUDA_VISIBLE_DEVICES' not in os.environ and gpu_id >= 0:
+        
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu_id)
     
     number_of_classes = 2
 
@@ -343,12 +356,12 @@ def run(sql_db_model):
         experiment.add_next_iteration_results(training_accuracy=current_train_validation_score,
                                               validation_accuracy=current_validation_score)
 
-        # Save the model if it has a better MIoU score.
+        # Checkpoints are written in the background, the ones with
+        # the best MIoU scores and the latest one are kept
+        experiment.save_checkpoint(fcn.state_dict(), score=current_validation_score)
+        
         if current_validation_score > best_validation_score:
             
-            model_save_path = experiment.get_best_model_file_save_path()
-            torch.save(fcn.state_dict(), model_save_path)
-            #torch.save(fcn.state_dict(), 'resnet_18_8s_best.pth')
             best_validation_score = current_validation_score
             experiment.update_best_iteration_results(validation_accuracy=current_validation_score)
     
@@ -359,10 +372,32 @@ def run(sql_db_model):
     return 'success'
 
 
-def inference(sql_db_model, input_image_np):
+def load_inference_model(sql_db_model):
+    """Loads the best checkpoint of an experiment for the inference.
+    
+    Called by the workers of the inference pool, which keep
+    the loaded models (see dash_deep/inference.py).
+    """
     
-    relative_model_path = sql_db_model.model_path
-    full_model_path = os.path.join(models_save_folder_path, relative_model_path)
+    fcn = resnet_dilated.Resnet18_8s(num_classes=2)
+    
+    fcn.load_state_dict(load_checkpoint(sql_db_model.model_path))
+    fcn.cuda()
+    fcn.eval()
+    
+    return fcn
+
+
+def batch_inference(sql_db_model, input_images_np, fcn=None):
+    """Segments a batch of images in one forward pass.
+    
+    The images are center cropped to the same size, so they can
+    be stacked into one tensor.
+    """
+    
+    if fcn is None:
+        
+        fcn = load_inference_model(sql_db_model)
     
     valid_transform = transforms.Compose(
                 [
@@ -373,27 +408,27 @@ def inference(sql_db_model, input_image_np):
                 ])
     
     
-    img = valid_transform(input_image_np)
-
-    img = img.unsqueeze(0)
+    imgs = torch.stack([valid_transform(input_image_np) for input_image_np in input_images_np])
         
-    img = img.cuda()
-    
-    fcn = resnet_dilated.Resnet18_8s(num_classes=2)
+    imgs = imgs.cuda()
     
-    fcn.load_state_dict(torch.load(full_model_path))
-    fcn.cuda()
-    fcn.eval()
-    
-    res = fcn(img)
+    # The activations of the batch are not needed for the gradients
+    with torch.no_grad():
+        
+        res = fcn(imgs)
     
-    # (h, w)
-    _, res = res.squeeze(0).max(0)
+    # (n, h, w)
+    _, res = res.max(1)
     
     # Temporarly multiplying by 100 for contrast
-    res_np = res.cpu().detach().numpy().copy().astype(np.uint8) * 100
+    res_np = res.cpu().numpy().astype(np.uint8) * 100
+    
+    return list(res_np)
+
+
+def inference(sql_db_model, input_image_np, fcn=None):
     
-    return res_np
+    return batch_inference(sql_db_model, [input_image_np], fcn)[0]
 
 
 valset = Endovis_Instrument_2017(root='/home/daniil/.pytorch-segmentation-detection/datasets/endovis_2017',
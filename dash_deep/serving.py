@@ -0,0 +1,570 @@
+from dash_deep.app import (server,
+                           auth,
+                           db,
+                           scripts_db_models,
+                           inference_pool,
+                           inference_server_max_batch_size,
+                           inference_server_max_wait_ms,
+                           inference_server_max_queue_size,
+                           inference_server_timeout_s,
+                           inference_server_idle_timeout_s)
+
+import flask
+import numpy as np
+from PIL import Image
+
+import base64
+import functools
+import threading
+import time
+from concurrent.futures import TimeoutError
+from io import BytesIO
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class MicroBatchTimeoutError(RuntimeError):
+    """Raised by MicroBatchRequest.wait() if the result is not ready in time."""
+
+
+class MicroBatchRequest(object):
+    """Single input waiting in a MicroBatcher for its result."""
+
+    def __init__(self, input_data):
+
+        self.input_data = input_data
+
+        self.submitted_at = time.time()
+
+        self.result = None
+        self.error = None
+
+        # Number of requests in the batch that computed the result
+        self.batch_size = None
+
+        self.done_event = threading.Event()
+
+
+    def wait(self, timeout=None):
+        """Waits for the result and returns it, raises the error of the batch if it failed.
+
+        Raises
+        ------
+        MicroBatchTimeoutError
+            If the result wasn't ready in timeout seconds.
+        """
+
+        if not self.done_event.wait(timeout):
+
+            raise MicroBatchTimeoutError('The request was not processed in {} seconds'.format(timeout))
+
+        if self.error is not None:
+
+            raise self.error
+
+        return self.result
+
+
+class MicroBatcher(object):
+    """Coalesces concurrent single-input requests into batches.
+
+    A background thread takes the first waiting request and then waits up to
+    max_wait_ms for more of them, until there are max_batch_size requests.
+    The batch is processed by one call of run_batch() and each request
+    receives its own result. While a batch runs, the new requests wait in
+    the queue and form the next batch, so under load the batches grow
+    without waiting for the timeout. max_wait_ms trades the latency of a
+    single request for the throughput under load, max_batch_size bounds
+    the memory of one forward pass.
+
+    At most max_queue_size requests can wait, submit() raises queue.Full
+    after that instead of letting the latency grow without bound.
+
+    The thread runs until stop() is called.
+
+    """
+
+    def __init__(self,
+                 run_batch,
+                 max_batch_size=inference_server_max_batch_size,
+                 max_wait_ms=inference_server_max_wait_ms,
+                 max_queue_size=inference_server_max_queue_size):
+        """Starts the batching thread.
+
+        Parameters
+        ----------
+        run_batch : function
+            Function that receives a list of inputs and
+            returns the list of the respective results.
+
+        max_batch_size : int
+            Maximum number of inputs in one batch.
+
+        max_wait_ms : float
+            Time that the first request of a batch waits for more requests.
+
+        max_queue_size : int
+            Maximum number of waiting requests.
+        """
+
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+
+        self.queue = queue.Queue(maxsize=max_queue_size)
+
+        self.number_of_batches = 0
+        self.number_of_requests = 0
+
+        self.last_submitted_at = time.time()
+
+        # Whether a batch is being processed
+        self.busy = False
+
+        self.thread = threading.Thread(target=self.process_queue, name='dash-deep-micro-batcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def submit(self, input_data):
+        """Puts an input into the queue.
+
+        Returns
+        -------
+        request : MicroBatchRequest
+            Request to wait for the result with.
+
+        Raises
+        ------
+        queue.Full
+            If max_queue_size requests are already waiting.
+        """
+
+        request = MicroBatchRequest(input_data)
+
+        self.queue.put(request, block=False)
+
+        self.last_submitted_at = request.submitted_at
+
+        return request
+
+
+    def is_idle(self, idle_timeout):
+        """Returns whether no request was submitted for idle_timeout seconds and none is waiting or running."""
+
+        return (not self.busy and self.queue.empty() and
+                time.time() - self.last_submitted_at > idle_timeout)
+
+
+    def stop(self):
+        """Stops the batching thread once the requests submitted before are processed.
+
+        No requests should be submitted after it.
+        """
+
+        self.queue.put(None)
+
+
+    def collect_batch(self):
+        """Waits for the first request and collects the batch that it starts.
+
+        Returns None once the batcher is stopped, see stop().
+        """
+
+        first_request = self.queue.get()
+
+        if first_request is None:
+
+            return None
+
+        batch = [first_request]
+
+        deadline = time.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+
+            remaining_time = deadline - time.time()
+
+            try:
+
+                # Requests that are already waiting are taken
+                # even if the waiting time is over
+                if remaining_time > 0:
+
+                    request = self.queue.get(timeout=remaining_time)
+
+                else:
+
+                    request = self.queue.get(block=False)
+
+            except queue.Empty:
+
+                break
+
+            if request is None:
+
+                # The batcher was stopped right after the last requests, they
+                # are processed and the next collect_batch() returns None
+                self.queue.put(None)
+
+                break
+
+            batch.append(request)
+
+        return batch
+
+
+    def process_queue(self):
+        """Main loop of the batching thread."""
+
+        while True:
+
+            batch = self.collect_batch()
+
+            if batch is None:
+
+                return
+
+            self.busy = True
+
+            self.number_of_batches += 1
+            self.number_of_requests += len(batch)
+
+            try:
+
+                self.run_requests(batch)
+
+            except Exception as error:
+
+                # Retrying a batch that timed out one request at a time
+                # would keep the following requests waiting even longer
+                if len(batch) == 1 or isinstance(error, TimeoutError):
+
+                    for request in batch:
+
+                        request.error = error
+
+                else:
+
+                    # A single bad input fails the whole batch, so the requests
+                    # are retried one by one and only the bad ones fail
+                    for request in batch:
+
+                        try:
+
+                            self.run_requests([request])
+
+                        except Exception as request_error:
+
+                            request.error = request_error
+
+            for request in batch:
+
+                request.done_event.set()
+
+            self.busy = False
+
+
+    def run_requests(self, batch):
+        """Runs a batch of requests and stores their results."""
+
+        results = self.run_batch([request.input_data for request in batch])
+
+        if len(results) != len(batch):
+
+            raise RuntimeError('{} results were returned for {} inputs'.format(len(results), len(batch)))
+
+        for request, result in zip(batch, results):
+
+            request.result = result
+            request.batch_size = len(batch)
+
+
+    def get_request_timeout(self, batch_timeout):
+        """Returns the seconds that a request may wait for its result.
+
+        A request waits in the queue behind the running batch and up to
+        max_wait_ms for its own batch. If its batch fails, the requests of
+        the batch are retried one by one, each of them can take batch_timeout.
+
+        Parameters
+        ----------
+        batch_timeout : float
+            Seconds that a single run of run_batch() may take.
+        """
+
+        return self.max_wait + batch_timeout * (2 + self.max_batch_size)
+
+
+    def get_stats(self):
+
+        return {'number_of_batches': self.number_of_batches,
+                'number_of_requests': self.number_of_requests,
+                'mean_batch_size': float(self.number_of_requests) / max(self.number_of_batches, 1),
+                'queue_size': self.queue.qsize()}
+
+
+class InferenceServer(object):
+    """Keeps a MicroBatcher for each experiment that receives inference requests.
+
+    The batches are run by the workers of the inference pool (see
+    dash_deep/inference.py), so the models stay loaded between the
+    requests and the batches of different experiments run concurrently.
+
+    Batchers of the experiments that received no requests for idle_timeout
+    seconds are stopped, so that the number of threads doesn't grow with
+    the number of experiments ever queried.
+
+    """
+
+    def __init__(self, idle_timeout=inference_server_idle_timeout_s):
+
+        self.idle_timeout = idle_timeout
+
+        # Maps (table name, experiment id) into its batcher
+        self.batchers = {}
+
+        # Maps (table name, experiment id) into the model class and the last
+        # loaded row of the experiment, which the next batch uses
+        self.experiments = {}
+
+        self.lock = threading.Lock()
+
+
+    def submit(self, sql_model_class, sql_model_instance, input_data):
+        """Puts an input for an experiment into the queue of its batcher.
+
+        Returns
+        -------
+        request : MicroBatchRequest
+            See MicroBatcher.submit().
+
+        request_timeout : float
+            Seconds to wait for the result of the request, see MicroBatcher.get_request_timeout().
+        """
+
+        key = (sql_model_instance.__tablename__, sql_model_instance.id)
+
+        with self.lock:
+
+            self.stop_idle_batchers(key)
+
+            self.experiments[key] = (sql_model_class, sql_model_instance)
+
+            if key not in self.batchers:
+
+                self.batchers[key] = MicroBatcher(functools.partial(self.run_experiment_batch, key))
+
+            batcher = self.batchers[key]
+
+            # Submitted under the lock, so that the batcher isn't stopped meanwhile
+            request = batcher.submit(input_data)
+
+        return request, batcher.get_request_timeout(inference_server_timeout_s)
+
+
+    def stop_idle_batchers(self, kept_key=None):
+        """Stops and removes the idle batchers except the one of kept_key, should be called under the lock."""
+
+        for key, batcher in list(self.batchers.items()):
+
+            if key != kept_key and batcher.is_idle(self.idle_timeout):
+
+                batcher.stop()
+
+                del self.batchers[key]
+                del self.experiments[key]
+
+
+    def run_experiment_batch(self, key, inputs):
+
+        with self.lock:
+
+            sql_model_class, sql_model_instance = self.experiments[key]
+
+        # The inference pool splits the batch if it is larger than
+        # inference_batch_size, it should be at least max_batch_size.
+        # A hung or killed worker fails the batch after the timeout instead
+        # of blocking the batcher of the experiment forever.
+        futures = inference_pool.schedule(sql_model_class, sql_model_instance, inputs, timeout=inference_server_timeout_s)
+
+        results, is_hit = inference_pool.get_results(futures, timeout=inference_server_timeout_s)
+
+        return results
+
+
+    def get_stats(self):
+
+        with self.lock:
+
+            return dict(('{}/{}'.format(*key), batcher.get_stats()) for key, batcher in self.batchers.items())
+
+
+inference_server = InferenceServer()
+
+
+def read_rgb_image(image_file):
+    """Reads an image file into an rgb numpy array.
+
+    Grayscale, palette and rgba images are converted, so that
+    the requests coalesced into one batch have the same channels.
+
+    Raises
+    ------
+    ValueError
+        If the file is not an image.
+    """
+
+    try:
+
+        return np.array(Image.open(image_file).convert('RGB'))
+
+    except Exception as error:
+
+        # PIL raises different errors for different broken files
+        raise ValueError('The image can not be read: {}'.format(error))
+
+
+def decode_image(image_string):
+    """Decodes a base64 encoded image, with or without the data url prefix.
+
+    Raises
+    ------
+    ValueError
+        If the string is not a base64 encoded image.
+    """
+
+    if not isinstance(image_string, (type(u''), type(b''))):
+
+        raise ValueError('The image should be a base64 encoded string')
+
+    if ',' in image_string:
+
+        image_string = image_string.split(',', 1)[1]
+
+    try:
+
+        image_bytes = base64.b64decode(image_string)
+
+    except (TypeError, ValueError) as error:
+
+        raise ValueError('The image is not base64 encoded: {}'.format(error))
+
+    return read_rgb_image(BytesIO(image_bytes))
+
+
+def encode_result(result):
+    """Converts a result of the inference into json.
+
+    uint8 arrays, like the segmentations of the endovis script, are
+    encoded as png images in data urls, other arrays as nested lists.
+    """
+
+    if isinstance(result, np.ndarray):
+
+        if result.dtype == np.uint8 and result.ndim in (2, 3):
+
+            buffer = BytesIO()
+
+            Image.fromarray(result).save(buffer, format='PNG')
+
+            return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+        return result.tolist()
+
+    return result
+
+
+def inference_view(table_name, experiment_id):
+    """Runs the inference of an experiment on a single image.
+
+    The image is sent either as a file field named 'image' of a multipart
+    form or as a json object {"image": "<base64 encoded image>"}. Concurrent
+    requests to the same experiment are processed in batches.
+
+    Returns a json object with the 'result', the 'batch_size' it was computed
+    in and the 'latency_ms' of the request. Responds with 503 if too many
+    requests are waiting and with 504 if the inference timed out.
+    """
+
+    sql_model_classes = [sql_model_class for sql_model_class in scripts_db_models
+                         if sql_model_class.__tablename__ == table_name]
+
+    if not sql_model_classes:
+
+        flask.abort(404)
+
+    sql_model_class = sql_model_classes[0]
+
+    # Inference doesn't need the graphs, so they are not loaded
+    sql_model_instance = sql_model_class.query.options(db.defer('graphs')).get(experiment_id)
+
+    if sql_model_instance is None:
+
+        flask.abort(404)
+
+    db.session.expunge(sql_model_instance)
+
+    request_json = flask.request.get_json(silent=True)
+
+    try:
+
+        if 'image' in flask.request.files:
+
+            input_image_np = read_rgb_image(flask.request.files['image'])
+
+        elif isinstance(request_json, dict) and 'image' in request_json:
+
+            input_image_np = decode_image(request_json['image'])
+
+        else:
+
+            return flask.jsonify(error='No image in the request'), 400
+
+    except ValueError as error:
+
+        return flask.jsonify(error=str(error)), 400
+
+    try:
+
+        request, request_timeout = inference_server.submit(sql_model_class, sql_model_instance, input_image_np)
+
+    except queue.Full:
+
+        return flask.jsonify(error='Too many requests are waiting'), 503
+
+    try:
+
+        result = request.wait(request_timeout)
+
+    except (MicroBatchTimeoutError, TimeoutError) as error:
+
+        return flask.jsonify(error=str(error) or 'The inference timed out'), 504
+
+    except Exception as error:
+
+        return flask.jsonify(error=str(error)), 500
+
+    return flask.jsonify(result=encode_result(result),
+                         batch_size=request.batch_size,
+                         latency_ms=(time.time() - request.submitted_at) * 1000)
+
+
+def inference_stats_view():
+    """Returns the statistics of the batchers and of the loaded models cache as json."""
+
+    return flask.jsonify(batchers=inference_server.get_stats(),
+                         model_cache=inference_pool.get_stats())
+
+
+# Views registered after the dash auth object was created are not
+# protected automatically
+server.add_url_rule('/inference/<table_name>/<int:experiment_id>',
+                    'inference',
+                    auth.auth_wrapper(inference_view),
+                    methods=['POST'])
+
+server.add_url_rule('/inference/stats', 'inference_stats', auth.auth_wrapper(inference_stats_view))
@@ -0,0 +1,354 @@
+from dash_deep.app import db, trace_smoothing_ema_weight, trace_smoothing_window_size
+from dash_deep.metrics import MetricPoint, insert_metric_points, get_next_trace_steps
+from dash_deep.rollups import MetricRollup, load_trace_points, compute_trace_rollups, metric_rollups_insert_statement
+
+import math
+from collections import deque, OrderedDict
+
+
+# Smoothed copy of a trace is stored as a separate trace named
+# '<trace name><separator><smoothing method><smoothing parameter>'
+SMOOTHED_TRACE_SEPARATOR = ':'
+
+
+def get_smoothing_methods():
+    """Returns the enabled smoothing methods, see trace_smoothing_* in dash_deep/app.py."""
+
+    smoothing_methods = []
+
+    if trace_smoothing_ema_weight is not None:
+
+        smoothing_methods.append('ema')
+
+    if trace_smoothing_window_size:
+
+        smoothing_methods.append('mean')
+
+    return smoothing_methods
+
+
+smoothing_methods = get_smoothing_methods()
+
+
+def get_smoothing_parameter(smoothing_method):
+    """Returns the configured parameter of a smoothing method."""
+
+    if smoothing_method == 'ema':
+
+        return trace_smoothing_ema_weight
+
+    return trace_smoothing_window_size
+
+
+def get_smoothed_trace_name(trace_name, smoothing_method):
+    """Returns the name of the smoothed copy of a trace, like 'loss:ema0.9' or 'loss:mean20'.
+
+    The parameter of the smoothing is a part of the name, so that the copies
+    smoothed before the parameter was changed in dash_deep/app.py are not
+    plotted with the new parameter in the legend and a resumed experiment
+    doesn't continue them with the new parameter.
+    """
+
+    return '{}{}{}{}'.format(trace_name,
+                             SMOOTHED_TRACE_SEPARATOR,
+                             smoothing_method,
+                             get_smoothing_parameter(smoothing_method))
+
+
+def get_plotted_trace_names(sql_model_instance):
+    """Returns the names of the traces of an experiment and of their smoothed copies."""
+
+    trace_names = list(sql_model_instance.graphs.graph_column_names)
+
+    for trace_name in sql_model_instance.graphs.graph_column_names:
+
+        trace_names.extend(get_smoothed_trace_name(trace_name, smoothing_method)
+                           for smoothing_method in smoothing_methods)
+
+    return trace_names
+
+
+def get_smoothing_legend_suffix(smoothing_method):
+    """Returns the text added to the legends of smoothed traces."""
+
+    if smoothing_method == 'ema':
+
+        return '(EMA {})'.format(get_smoothing_parameter(smoothing_method))
+
+    return '(mean of {})'.format(get_smoothing_parameter(smoothing_method))
+
+
+class TraceSmoother(object):
+    """Smooths reported values of traces one value at a time.
+
+    The exponential moving average is debiased the same way as in
+    tensorboard, so the first values are not pulled towards zero. The
+    windowed mean keeps the last window_size values and their sum. Each
+    value costs O(1) no matter how long the trace is.
+
+    """
+
+    def __init__(self, ema_weight=trace_smoothing_ema_weight, window_size=trace_smoothing_window_size):
+
+        self.ema_weight = ema_weight
+        self.window_size = window_size
+
+        # Maps trace name into the state of its smoothing
+        self.states = {}
+
+
+    def get_state(self, trace_name):
+
+        if trace_name not in self.states:
+
+            self.states[trace_name] = {'count': 0,
+                                       'ema': 0.0,
+                                       'window': deque(),
+                                       'window_sum': 0.0}
+
+        return self.states[trace_name]
+
+
+    def add_value(self, trace_name, value):
+        """Adds the next value of a trace.
+
+        Returns
+        -------
+        smoothed_values : OrderedDict
+            Maps smoothing method into the smoothed value at the step of
+            the added value. Empty if the value is not finite, such values
+            are skipped so that they don't spoil the following ones.
+        """
+
+        smoothed_values = OrderedDict()
+
+        if math.isnan(value) or math.isinf(value):
+
+            return smoothed_values
+
+        state = self.get_state(trace_name)
+
+        state['count'] += 1
+
+        if self.ema_weight is not None:
+
+            state['ema'] = self.ema_weight * state['ema'] + (1 - self.ema_weight) * value
+
+            smoothed_values['ema'] = state['ema'] / (1 - self.ema_weight ** state['count'])
+
+        if self.window_size:
+
+            window = state['window']
+
+            window.append(value)
+            state['window_sum'] += value
+
+            if len(window) > self.window_size:
+
+                state['window_sum'] -= window.popleft()
+
+            # Recomputing the sum once in a while, so that the rounding
+            # errors of the running sum don't accumulate
+            if state['count'] % self.window_size == 0:
+
+                state['window_sum'] = math.fsum(window)
+
+            smoothed_values['mean'] = state['window_sum'] / len(window)
+
+        return smoothed_values
+
+
+    def seed(self, trace_name, count, ema, window_values):
+        """Restores the state of a trace of a resumed experiment.
+
+        Parameters
+        ----------
+        count : int
+            Number of values that were smoothed.
+
+        ema : float
+            Last debiased exponential moving average.
+
+        window_values : list
+            Last window_size values.
+        """
+
+        state = self.get_state(trace_name)
+
+        state['count'] = count
+
+        if self.ema_weight is not None and ema is not None:
+
+            state['ema'] = ema * (1 - self.ema_weight ** count)
+
+        if self.window_size:
+
+            state['window'] = deque(window_values[-self.window_size:])
+            state['window_sum'] = math.fsum(state['window'])
+
+
+def create_smoothed_metric_points(trace_smoother, metric_point):
+    """Creates the rows of the smoothed copies of a reported metric point."""
+
+    smoothed_values = trace_smoother.add_value(metric_point['trace_name'], metric_point['value'])
+
+    return [dict(metric_point,
+                 trace_name=get_smoothed_trace_name(metric_point['trace_name'], smoothing_method),
+                 value=smoothed_value)
+            for smoothing_method, smoothed_value in smoothed_values.items()]
+
+
+def seed_trace_smoother(trace_smoother, sql_model_instance, trace_next_steps):
+    """Restores the smoothing of the traces of a resumed experiment.
+
+    The state is taken from the last stored smoothed values and the last
+    window of reported values. Traces whose smoothed copies are missing
+    or lag behind are replayed from the beginning.
+
+    Parameters
+    ----------
+    trace_smoother : TraceSmoother
+        Smoother of the resumed experiment.
+
+    sql_model_instance : sqlalchemy model instance
+        Resumed experiment.
+
+    trace_next_steps : dict
+        See metrics.get_next_trace_steps().
+    """
+
+    for trace_name in sql_model_instance.graphs.graph_column_names:
+
+        next_step = trace_next_steps.get(trace_name)
+
+        if next_step is None:
+
+            continue
+
+        smoothed_copies_are_complete = all(trace_next_steps.get(get_smoothed_trace_name(trace_name, smoothing_method)) == next_step
+                                           for smoothing_method in smoothing_methods)
+
+        if not smoothed_copies_are_complete or 'ema' not in smoothing_methods:
+
+            steps, values = load_trace_points(sql_model_instance, trace_name)
+
+            for value in values.tolist():
+
+                trace_smoother.add_value(trace_name, value)
+
+            continue
+
+        # Non finite values are not counted by the smoother, the
+        # difference only affects the debiasing of the first values
+        ema_steps, ema_values = load_trace_points(sql_model_instance,
+                                                  get_smoothed_trace_name(trace_name, 'ema'),
+                                                  first_step=next_step - 1)
+
+        steps, values = load_trace_points(sql_model_instance,
+                                          trace_name,
+                                          first_step=max(next_step - (trace_smoother.window_size or 0), 0))
+
+        trace_smoother.seed(trace_name, next_step, float(ema_values[-1]), values.tolist())
+
+
+def rebuild_experiment_smoothed_traces(sql_model_instance):
+    """Writes the missing or incomplete smoothed copies of the traces of an experiment.
+
+    Used for experiments recorded before the smoothing was introduced,
+    before a smoothing method was enabled or before its parameter was
+    changed. The copies smoothed with other parameters are deleted.
+    Archived experiments are skipped, since most of their values are
+    not in the database.
+
+    Returns
+    -------
+    rebuilt_trace_names : list
+        Names of the rebuilt smoothed traces.
+    """
+
+    if sql_model_instance.archived_at is not None:
+
+        return []
+
+    trace_next_steps = get_next_trace_steps(sql_model_instance)
+
+    current_trace_names = get_plotted_trace_names(sql_model_instance)
+
+    stale_trace_names = [trace_name for trace_name in trace_next_steps
+                         if SMOOTHED_TRACE_SEPARATOR in trace_name and trace_name not in current_trace_names]
+
+    if stale_trace_names:
+
+        for metric_table in (MetricPoint, MetricRollup):
+
+            metric_table.query.filter(metric_table.experiment_table == sql_model_instance.__tablename__,
+                                      metric_table.experiment_id == sql_model_instance.id,
+                                      metric_table.trace_name.in_(stale_trace_names)).delete(synchronize_session=False)
+
+    rebuilt_trace_names = []
+
+    for trace_name in sql_model_instance.graphs.graph_column_names:
+
+        next_step = trace_next_steps.get(trace_name)
+
+        if next_step is None:
+
+            continue
+
+        incomplete_trace_names = [get_smoothed_trace_name(trace_name, smoothing_method)
+                                  for smoothing_method in smoothing_methods
+                                  if trace_next_steps.get(get_smoothed_trace_name(trace_name, smoothing_method)) != next_step]
+
+        if not incomplete_trace_names:
+
+            continue
+
+        MetricPoint.query.filter(MetricPoint.experiment_table == sql_model_instance.__tablename__,
+                                 MetricPoint.experiment_id == sql_model_instance.id,
+                                 MetricPoint.trace_name.in_(incomplete_trace_names)).delete(synchronize_session=False)
+
+        query = db.session.query(MetricPoint.step, MetricPoint.wall_time, MetricPoint.value)
+
+        query = query.filter(MetricPoint.experiment_table == sql_model_instance.__tablename__,
+                             MetricPoint.experiment_id == sql_model_instance.id,
+                             MetricPoint.trace_name == trace_name)
+
+        trace_smoother = TraceSmoother()
+
+        smoothed_metric_points = []
+
+        for step, wall_time, value in query.order_by(MetricPoint.step):
+
+            metric_point = {'experiment_table': sql_model_instance.__tablename__,
+                            'experiment_id': sql_model_instance.id,
+                            'trace_name': trace_name,
+                            'step': step,
+                            'wall_time': wall_time,
+                            'value': value}
+
+            smoothed_metric_points.extend(smoothed_metric_point
+                                          for smoothed_metric_point in create_smoothed_metric_points(trace_smoother,
+                                                                                                    metric_point)
+                                          if smoothed_metric_point['trace_name'] in incomplete_trace_names)
+
+        insert_metric_points(db.session, smoothed_metric_points)
+
+        for smoothed_trace_name in incomplete_trace_names:
+
+            steps, values = load_trace_points(sql_model_instance, smoothed_trace_name)
+
+            metric_rollups = compute_trace_rollups(sql_model_instance.__tablename__,
+                                                   sql_model_instance.id,
+                                                   smoothed_trace_name,
+                                                   steps,
+                                                   values)
+
+            if metric_rollups:
+
+                db.session.execute(metric_rollups_insert_statement, metric_rollups)
+
+        rebuilt_trace_names.extend(incomplete_trace_names)
+
+    db.session.commit()
+
+    return rebuilt_trace_names
@@ -1,6 +1,10 @@
 import random
+import datetime
+import operator
 from collections import OrderedDict
+from sqlalchemy import inspect
 from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy.schema import CreateColumn
 
 import dash_deep.models
 from dash_deep.app import db
@@ -49,13 +53,165 @@ def generate_script_wtform_class_instance(script_db_model):
     return script_wtform_class_instance
 
 
-def generate_table_contents_from_sql_model_class(sql_model_class):
-    """Extracts all records that are currently stored in the database
+# Comparison operators of the table filter, the longer ones go
+# first, so that '>=' is not taken for '>' or '='
+table_filter_operators = [('>=', operator.ge),
+                          ('<=', operator.le),
+                          ('!=', operator.ne),
+                          ('=', operator.eq),
+                          ('>', operator.gt),
+                          ('<', operator.lt)]
+
+table_filter_datetime_formats = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']
+
+
+def get_table_columns(sql_model_class):
+    """Returns the columns of the table of the specified class that are
+    displayed in Dash's datatable -- all of them except for the graphs.
+    
+    Parameters
+    ----------
+    sql_model_class : sqlalchemy model class
+        sqlalchemy model class
+    
+    Returns
+    -------
+    columns : list
+        List of sqlalchemy columns.
+    """
+    
+    return [column for column in sql_model_class.__table__.columns if column.name != 'graphs']
+
+
+def convert_table_filter_value(column, value_string):
+    
+    python_type = column.type.python_type
+    
+    if python_type is datetime.datetime:
+        
+        for datetime_format in table_filter_datetime_formats:
+            
+            try:
+                return datetime.datetime.strptime(value_string, datetime_format)
+            
+            except ValueError:
+                pass
+        
+        raise ValueError('Wrong date {}, expected format is YYYY-MM-DD HH:MM:SS'.format(value_string))
+    
+    try:
+        return python_type(value_string)
+    
+    except ValueError:
+        
+        raise ValueError('Wrong value {} for column {}'.format(value_string, column.name))
+
+
+def parse_table_filter(sql_model_class, filter_string):
+    """Converts a filter typed by user into sqlalchemy conditions.
+    
+    Filter is a comma separated list of comparisons of columns with values,
+    for example: "batch_size>=10, learning_rate=0.001". The conditions are
+    evaluated by the database, so that only the matching records are loaded.
+    
+    Parameters
+    ----------
+    sql_model_class : sqlalchemy model class
+        sqlalchemy model class
+    
+    filter_string : string
+        Filter typed by user.
+    
+    Returns
+    -------
+    conditions : list
+        List of sqlalchemy conditions.
+    
+    Raises
+    ------
+    ValueError
+        If the filter can't be parsed.
+    """
+    
+    columns = dict((column.name, column) for column in get_table_columns(sql_model_class))
+    
+    conditions = []
+    
+    for condition_string in (filter_string or '').split(','):
+        
+        condition_string = condition_string.strip()
+        
+        if not condition_string:
+            
+            continue
+        
+        for operator_string, operator_function in table_filter_operators:
+            
+            if operator_string in condition_string:
+                
+                break
+        else:
+            
+            raise ValueError('Condition {} has no comparison operator'.format(condition_string))
+        
+        column_name, value_string = [part.strip() for part in condition_string.split(operator_string, 1)]
+        
+        if column_name not in columns:
+            
+            raise ValueError('Unknown column {}'.format(column_name))
+        
+        column = columns[column_name]
+        
+        conditions.append(operator_function(column, convert_table_filter_value(column, value_string)))
+    
+    return conditions
+
+
+def create_table_page_query(sql_model_class,
+                            columns,
+                            conditions=(),
+                            sort_column_name='id',
+                            descending=False,
+                            page=0,
+                            page_size=None):
+    """Creates a query of the specified columns of a page of records.
+    
+    See generate_table_contents_from_sql_model_class() for the parameters.
+    Records with equal values of the sort column are ordered by id, so that
+    pages don't overlap.
+    """
+    
+    query = db.session.query(*columns).filter(*conditions)
+    
+    sort_column = sql_model_class.__table__.c[sort_column_name]
+    
+    if descending:
+        
+        query = query.order_by(sort_column.desc(), sql_model_class.id.desc())
+    else:
+        
+        query = query.order_by(sort_column, sql_model_class.id)
+    
+    if page_size is not None:
+        
+        query = query.offset(page * page_size).limit(page_size)
+    
+    return query
+
+
+def generate_table_contents_from_sql_model_class(sql_model_class,
+                                                 conditions=(),
+                                                 sort_column_name='id',
+                                                 descending=False,
+                                                 page=0,
+                                                 page_size=None):
+    """Extracts records that are currently stored in the database
     of the specified class and prepares them to be passed to Dash's datatable.
 
-    Fetches all the records from the database, removes the graph field and
+    Fetches the records from the database without the graph field and
     converts these records into list of dicts which is accepted by Dash's
-    data table object. Has a special return value in case we don't have
+    data table object. Filtering, sorting and pagination are performed
+    by the database. Has a special return value in case we don't have
     any records of the specified class in our database -- this is specific
     to Dash's data table.
     
@@ -64,6 +220,21 @@ def generate_table_contents_from_sql_model_class(sql_model_class):
     sql_model_class : sqlalchemy model class
         sqlalchemy model class
     
+    conditions : list
+        Conditions that records should satisfy, see parse_table_filter().
+    
+    sort_column_name : string
+        Name of the column to sort by.
+    
+    descending : bool
+        Whether to sort in descending order.
+    
+    page : int
+        Zero-based number of the page to return.
+    
+    page_size : int
+        Number of records on a page. All the records are returned if None.
+    
     Returns
     -------
     rows : list
@@ -78,28 +249,145 @@ def generate_table_contents_from_sql_model_class(sql_model_class):
     if not db.engine.has_table(sql_model_class.__tablename__):
         
         return empty_return_value
-
-    experiments = sql_model_class.query.all()
     
-    if not experiments:
+    # Querying the columns instead of the model instances, so that
+    # the graphs column is never loaded and unpickled
+    columns = get_table_columns(sql_model_class)
+    
+    query = create_table_page_query(sql_model_class,
+                                    columns,
+                                    conditions,
+                                    sort_column_name,
+                                    descending,
+                                    page,
+                                    page_size)
+    
+    rows = [OrderedDict((column.name, value) for column, value in zip(columns, experiment))
+            for experiment in query]
+    
+    if not rows:
         
         return empty_return_value
 
-    # TODO: update the sql query to fetch
-    # all field except the graphs'
-    rows = []
+    return rows
 
-    for experiment in experiments:
 
-        rows.append( get_column_names_and_values_from_sql_model_instance(experiment) )
+def get_table_signature(sql_model_class, conditions=()):
+    """Returns a cheap summary of the records of the specified class that
+    changes whenever any of them is added, deleted or updated.
 
-    # Removing the graph field from our model since
-    # we want to only put numerical values in our table
-    for row in rows:
+    Uses the version column that is incremented on every write of an
+    experiment, so no record has to be loaded to tell that the table
+    didn't change.
+    
+    Parameters
+    ----------
+    sql_model_class : sqlalchemy model class
+        sqlalchemy model class
+    
+    conditions : list
+        Conditions that records should satisfy, see parse_table_filter().
+    
+    Returns
+    -------
+    signature : list or None
+        Number of records, sum and maximum of their ids and the
+        sum of their versions. None if the table doesn't exist.
+    """
+    
+    if not db.engine.has_table(sql_model_class.__tablename__):
+        
+        return None
+    
+    query = db.session.query(db.func.count(sql_model_class.id),
+                             db.func.max(sql_model_class.id),
+                             db.func.sum(sql_model_class.id),
+                             db.func.sum(sql_model_class.version))
+    
+    return list(query.filter(*conditions).one())
 
-        del row['graphs']
 
-    return rows
+def add_missing_indexes(sql_model_class):
+    """Creates the indexes that were introduced after the table of the
+    specified class was created.
+    
+    Parameters
+    ----------
+    sql_model_class : sqlalchemy model class
+        sqlalchemy model class
+    
+    Returns
+    -------
+    added_index_names : list
+        Names of the created indexes.
+    """
+    
+    table = sql_model_class.__table__
+    
+    if not db.engine.has_table(table.name):
+        
+        return []
+    
+    existing_index_names = set(index['name'] for index in inspect(db.engine).get_indexes(table.name))
+    
+    added_index_names = []
+    
+    for index in table.indexes:
+        
+        if index.name in existing_index_names:
+            
+            continue
+        
+        index.create(db.engine)
+        
+        added_index_names.append(index.name)
+    
+    return added_index_names
+
+
+def add_missing_columns(sql_model_class):
+    """Adds the columns that were introduced after the table of the
+    specified class was created.
+
+    db.create_all() only creates missing tables, so the columns added to
+    the models later have to be added to the existing tables explicitly.
+    New columns should either be nullable or have a server default.
+    
+    Parameters
+    ----------
+    sql_model_class : sqlalchemy model class
+        sqlalchemy model class
+    
+    Returns
+    -------
+    added_column_names : list
+        Names of the added columns.
+    """
+    
+    table = sql_model_class.__table__
+    
+    if not db.engine.has_table(table.name):
+        
+        return []
+    
+    existing_column_names = set(column['name'] for column in inspect(db.engine).get_columns(table.name))
+    
+    added_column_names = []
+    
+    for column in table.columns:
+        
+        if column.name in existing_column_names:
+            
+            continue
+        
+        column_definition = CreateColumn(column).compile(dialect=db.engine.dialect)
+        
+        db.engine.execute('ALTER TABLE {} ADD COLUMN {}'.format(table.name, column_definition))
+        
+        added_column_names.append(column.name)
+    
+    return added_column_names
+
 
 def get_column_names_and_values_from_sql_model_instance(sql_model_instance):
     """Extracts column names and associated values from and sqlalchemy model
@@ -190,17 +478,17 @@ def create_dummy_endovis_record():
     dummy_model_instance.learning_rate = random.choice(learning_rate_choices)
     dummy_model_instance.output_stride = random.choice(output_stride_choices)
 
-    dummy_model_instance.graphs.training_accuracy_history['x'] = range(100)
-    dummy_model_instance.graphs.training_accuracy_history['y'] = generate_radnom_decreasing_or_increasing_list(100, 1.05)
-
-    dummy_model_instance.graphs.validation_accuracy_history['x'] = range(100)
-    dummy_model_instance.graphs.validation_accuracy_history['y'] = generate_radnom_decreasing_or_increasing_list(100, 1.05)
-
-    dummy_model_instance.graphs.validation_loss_history['x'] = range(100)
-    dummy_model_instance.graphs.validation_loss_history['y'] = generate_radnom_decreasing_or_increasing_list(100, 0.9)
-
-    dummy_model_instance.graphs.training_loss_history['x'] = range(100)
-    dummy_model_instance.graphs.training_loss_history['y'] = generate_radnom_decreasing_or_increasing_list(100, 0.9)
+    trace_name_factor_pairs = [('training_loss', 0.9),
+                               ('training_accuracy', 1.05),
+                               ('validation_accuracy', 1.05)]
+    
+    # The values are put into the pickled graph and are moved
+    # into the metric points table by migrate_graphs_to_metric_points()
+    # once the records are commited and have their ids.
+    for trace_name, factor in trace_name_factor_pairs:
+        
+        trace_values = generate_radnom_decreasing_or_increasing_list(100, factor)
+        dummy_model_instance.graphs.set_trace(trace_name, range(100), trace_values)
     
     # Not really necessary, but if you load a model and
     # update graph field, you need to call this function 
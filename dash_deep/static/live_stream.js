@@ -0,0 +1,264 @@
+/*
+ * Client side of the live metrics stream (see dash_deep/stream.py).
+ *
+ * Pages declare what they want to receive with hidden divs of class
+ * 'dash-deep-stream-config' that contain a json config:
+ *
+ *   {"channel": "metrics", "graph_id": ..., "experiment_table": ...,
+ *    "experiments": [[experiment id, {trace name: last step}], ...],
+ *    "legend_names": {trace name: legend name}, "points_per_trace": ...}
+ *   {"channel": "tasks", "refresh_button_id": ...}
+ *   {"channel": "gpu", "container_id": ...}
+ *
+ * The configs are rendered by dash callbacks, so we check them periodically
+ * and reopen the event source whenever they change. New metric points are
+ * appended to the traces of the graph with Plotly.extendTraces(), task state
+ * changes click the refresh button of the tasks table and gpu state replaces
+ * the contents of the container.
+ */
+(function () {
+
+    var CONFIG_CHECK_INTERVAL_MS = 500;
+
+    var eventSource = null;
+    var configsText = null;
+    var configs = [];
+
+    // Maps "experiment table/experiment id/trace name" into the last
+    // step that the graph has, used to skip points that were already plotted
+    var lastSteps = {};
+
+    function getTraceKey(experimentTable, experimentId, traceName) {
+
+        return experimentTable + '/' + experimentId + '/' + traceName;
+    }
+
+    function readConfigs() {
+
+        var elements = document.getElementsByClassName('dash-deep-stream-config');
+        var texts = [];
+
+        for (var i = 0; i < elements.length; i++) {
+
+            if (elements[i].textContent) {
+
+                texts.push(elements[i].textContent);
+            }
+        }
+
+        return texts;
+    }
+
+    function openEventSource() {
+
+        if (eventSource !== null) {
+
+            eventSource.close();
+            eventSource = null;
+        }
+
+        if (configs.length === 0 || typeof EventSource === 'undefined') {
+
+            return;
+        }
+
+        var channels = [];
+        var experiments = [];
+
+        lastSteps = {};
+
+        configs.forEach(function (config) {
+
+            if (channels.indexOf(config.channel) === -1) {
+
+                channels.push(config.channel);
+            }
+
+            if (config.channel !== 'metrics') {
+
+                return;
+            }
+
+            config.experiments.forEach(function (experiment) {
+
+                var experimentId = experiment[0];
+                var experimentLastSteps = experiment[1];
+
+                experiments.push([config.experiment_table, experimentId, experimentLastSteps]);
+
+                Object.keys(experimentLastSteps).forEach(function (traceName) {
+
+                    lastSteps[getTraceKey(config.experiment_table, experimentId, traceName)] = experimentLastSteps[traceName];
+                });
+            });
+        });
+
+        var url = '/metrics/stream?channels=' + encodeURIComponent(channels.join(',')) +
+                  '&experiments=' + encodeURIComponent(JSON.stringify(experiments));
+
+        eventSource = new EventSource(url);
+
+        eventSource.addEventListener('metrics', function (event) {
+
+            appendMetricPoints(JSON.parse(event.data));
+        });
+
+        eventSource.addEventListener('tasks', function () {
+
+            configs.forEach(function (config) {
+
+                var button = config.channel === 'tasks' && document.getElementById(config.refresh_button_id);
+
+                if (button) {
+
+                    button.click();
+                }
+            });
+        });
+
+        eventSource.addEventListener('gpu', function (event) {
+
+            var gpuState = JSON.parse(event.data);
+
+            configs.forEach(function (config) {
+
+                var container = config.channel === 'gpu' && document.getElementById(config.container_id);
+
+                if (container) {
+
+                    container.textContent = gpuState;
+                }
+            });
+        });
+    }
+
+    function thinTrace(graph, traceIndex) {
+
+        // Halving the trace once it doesn't fit the points budget, the next
+        // full redraw loads it from the rollups again. Every four points are
+        // replaced by their minimum and maximum in the order of the steps,
+        // so the spikes kept by the min/max downsampling are not dropped
+        var trace = graph.data[traceIndex];
+
+        var x = [];
+        var y = [];
+
+        for (var i = 0; i < trace.x.length; i += 4) {
+
+            var end = Math.min(i + 4, trace.x.length);
+            var minIndex = i;
+            var maxIndex = i;
+
+            for (var j = i + 1; j < end; j++) {
+
+                if (trace.y[j] < trace.y[minIndex]) {
+
+                    minIndex = j;
+                }
+
+                if (trace.y[j] > trace.y[maxIndex]) {
+
+                    maxIndex = j;
+                }
+            }
+
+            var first = Math.min(minIndex, maxIndex);
+            var last = Math.max(minIndex, maxIndex);
+
+            x.push(trace.x[first]);
+            y.push(trace.y[first]);
+
+            if (last !== first) {
+
+                x.push(trace.x[last]);
+                y.push(trace.y[last]);
+            }
+        }
+
+        Plotly.restyle(graph, {x: [x], y: [y]}, [traceIndex]);
+    }
+
+    function appendMetricPoints(data) {
+
+        configs.forEach(function (config) {
+
+            if (config.channel !== 'metrics' || config.experiment_table !== data.experiment_table) {
+
+                return;
+            }
+
+            var graph = document.getElementById(config.graph_id);
+
+            if (!graph || !graph.data) {
+
+                return;
+            }
+
+            Object.keys(data.traces).forEach(function (traceName) {
+
+                var traceKey = getTraceKey(data.experiment_table, data.experiment_id, traceName);
+                var lastStep = lastSteps.hasOwnProperty(traceKey) ? lastSteps[traceKey] : -1;
+
+                var steps = data.traces[traceName].steps;
+                var values = data.traces[traceName].values;
+
+                var newSteps = [];
+                var newValues = [];
+
+                for (var i = 0; i < steps.length; i++) {
+
+                    if (steps[i] > lastStep) {
+
+                        newSteps.push(steps[i]);
+                        newValues.push(values[i]);
+                    }
+                }
+
+                if (newSteps.length === 0) {
+
+                    return;
+                }
+
+                lastSteps[traceKey] = newSteps[newSteps.length - 1];
+
+                // Legends of the traces are created by
+                // create_model_traces_with_unique_legends() in dash_deep/plot.py
+                var legendName = (config.legend_names || {})[traceName] || traceName;
+                var legend = legendName + ' (Experiment ID: ' + data.experiment_id + ')';
+
+                for (var traceIndex = 0; traceIndex < graph.data.length; traceIndex++) {
+
+                    if (graph.data[traceIndex].name === legend) {
+
+                        Plotly.extendTraces(graph, {x: [newSteps], y: [newValues]}, [traceIndex]);
+
+                        if (graph.data[traceIndex].x.length > 2 * config.points_per_trace) {
+
+                            thinTrace(graph, traceIndex);
+                        }
+
+                        break;
+                    }
+                }
+            });
+        });
+    }
+
+    setInterval(function () {
+
+        var texts = readConfigs();
+        var newConfigsText = texts.join('\n');
+
+        if (newConfigsText === configsText) {
+
+            return;
+        }
+
+        configsText = newConfigsText;
+        configs = texts.map(function (text) { return JSON.parse(text); });
+
+        openEventSource();
+
+    }, CONFIG_CHECK_INTERVAL_MS);
+
+})();
@@ -0,0 +1,119 @@
+/*
+ * Decodes the packed trace arrays of the figures (see encode_trace_array()
+ * in dash_deep/plot.py).
+ *
+ * With plot_trace_encoding = 'base64' the x and y arrays of the traces
+ * are sent as {"dash_deep_base64": ..., "dtype": "int32|float32|float64"}
+ * objects. The figures are passed by dash's graph component to plotly as
+ * they are, so we wrap the plotly functions that receive the figure data
+ * and unpack the arrays into plain arrays right before plotting. The
+ * figure stored by dash keeps the packed arrays.
+ */
+(function () {
+
+    var ENCODING_KEY = 'dash_deep_base64';
+
+    var DTYPES = {
+        'int32': {size: 4, read: function (view, offset) { return view.getInt32(offset, true); }},
+        'float32': {size: 4, read: function (view, offset) { return view.getFloat32(offset, true); }},
+        'float64': {size: 8, read: function (view, offset) { return view.getFloat64(offset, true); }}
+    };
+
+    function isEncodedArray(value) {
+
+        return value !== null && typeof value === 'object' && value.hasOwnProperty(ENCODING_KEY);
+    }
+
+    function decodeArray(encodedArray) {
+
+        var dtype = DTYPES[encodedArray.dtype];
+        var binary = atob(encodedArray[ENCODING_KEY]);
+
+        var bytes = new Uint8Array(binary.length);
+
+        for (var i = 0; i < binary.length; i++) {
+
+            bytes[i] = binary.charCodeAt(i);
+        }
+
+        // DataView reads little-endian values on any platform
+        var view = new DataView(bytes.buffer);
+        var length = bytes.length / dtype.size;
+
+        // Plain arrays, since the live stream extends the traces in place
+        var values = new Array(length);
+
+        for (var j = 0; j < length; j++) {
+
+            values[j] = dtype.read(view, j * dtype.size);
+        }
+
+        return values;
+    }
+
+    function decodeData(data) {
+
+        if (!Array.isArray(data)) {
+
+            return data;
+        }
+
+        return data.map(function (trace) {
+
+            if (!trace || !(isEncodedArray(trace.x) || isEncodedArray(trace.y))) {
+
+                return trace;
+            }
+
+            var decodedTrace = {};
+
+            Object.keys(trace).forEach(function (key) {
+
+                decodedTrace[key] = isEncodedArray(trace[key]) ? decodeArray(trace[key]) : trace[key];
+            });
+
+            return decodedTrace;
+        });
+    }
+
+    function wrapPlotlyFunction(name) {
+
+        var plotlyFunction = window.Plotly[name];
+
+        if (typeof plotlyFunction !== 'function') {
+
+            return;
+        }
+
+        window.Plotly[name] = function (graph, data) {
+
+            var args = Array.prototype.slice.call(arguments);
+
+            // Accepting both (graph, data, layout, config)
+            // and (graph, {data: ..., layout: ...}) forms
+            if (Array.isArray(data)) {
+
+                args[1] = decodeData(data);
+
+            } else if (data && Array.isArray(data.data)) {
+
+                var figure = {};
+
+                Object.keys(data).forEach(function (key) { figure[key] = data[key]; });
+
+                figure.data = decodeData(data.data);
+                args[1] = figure;
+            }
+
+            return plotlyFunction.apply(this, args);
+        };
+    }
+
+    if (typeof window.Plotly === 'undefined') {
+
+        return;
+    }
+
+    ['newPlot', 'plot', 'react'].forEach(wrapPlotlyFunction);
+
+})();
@@ -0,0 +1,468 @@
+from dash_deep.app import (server,
+                           auth,
+                           db,
+                           task_manager,
+                           stream_poll_interval_ms,
+                           stream_keepalive_interval_s,
+                           stream_subscriber_queue_size)
+from dash_deep.metrics import MetricPoint
+from dash_deep.future import generate_table_from_future_objects
+
+import flask
+
+import json
+import subprocess
+import threading
+import time
+import traceback
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+# Maximum number of metric points read by a single poll, the
+# rest are read by the following polls without waiting
+MAX_POINTS_PER_POLL = 10000
+
+
+class MetricStreamSubscriber(object):
+    """Open page that receives events of the metric stream.
+
+    Attributes
+    ----------
+    channels : set
+        Subset of 'metrics', 'tasks' and 'gpu'.
+
+    experiments : set
+        Set of (experiment table, experiment id) pairs which
+        metric points should be delivered.
+    """
+
+    def __init__(self, channels, experiments, queue_size):
+
+        self.channels = channels
+        self.experiments = experiments
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.closed = False
+
+
+    def put(self, event):
+
+        if self.closed:
+
+            return
+
+        try:
+
+            self.queue.put_nowait(event)
+
+        except queue.Full:
+
+            # The page can't keep up -- disconnecting it, the browser
+            # reconnects and requests the missed points again
+            self.closed = True
+
+            try:
+
+                while True:
+
+                    self.queue.get_nowait()
+
+            except queue.Empty:
+
+                self.queue.put_nowait(None)
+
+
+class MetricStream(object):
+    """Pushes new metric points, task states and gpu state to the open pages.
+
+    A single thread polls the metric points table for the rows with ids
+    greater than the last seen one (a primary key lookup) and the in-memory
+    states of the tasks, and puts the changes into the queues of the
+    subscribers. The cost of polling doesn't depend on the number of
+    open pages, and a poll that finds nothing costs a single indexed query.
+    The thread runs only while there are subscribers.
+
+    """
+
+    def __init__(self, poll_interval_ms=stream_poll_interval_ms, queue_size=stream_subscriber_queue_size):
+
+        self.poll_interval = poll_interval_ms / 1000.0
+        self.queue_size = queue_size
+
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+        self.last_metric_point_id = None
+        self.task_rows = None
+        self.gpu_state = None
+
+
+    def subscribe(self, channels, experiments=()):
+        """Creates a subscriber and starts the polling thread if needed.
+
+        Parameters
+        ----------
+        channels : iterable
+            Channels to receive events of, see MetricStreamSubscriber.
+
+        experiments : iterable
+            (experiment table, experiment id) pairs.
+
+        Returns
+        -------
+        subscriber : MetricStreamSubscriber
+            Subscriber which queue receives the events.
+        """
+
+        subscriber = MetricStreamSubscriber(set(channels), set(experiments), self.queue_size)
+
+        with self.lock:
+
+            self.subscribers.add(subscriber)
+
+            if self.last_metric_point_id is None:
+
+                # Pages load the history themselves, so the stream starts
+                # from now. It's initialized before the page loads the points
+                # it missed, so no point falls in between.
+                self.last_metric_point_id = get_last_metric_point_id()
+
+            if self.thread is None or not self.thread.is_alive():
+
+                self.thread = threading.Thread(target=self.poll, name='dash-deep-metric-stream')
+                self.thread.daemon = True
+                self.thread.start()
+
+        return subscriber
+
+
+    def unsubscribe(self, subscriber):
+
+        with self.lock:
+
+            self.subscribers.discard(subscriber)
+
+
+    def get_subscribers(self, channel):
+
+        with self.lock:
+
+            return [subscriber for subscriber in self.subscribers
+                    if channel in subscriber.channels and not subscriber.closed]
+
+
+    def poll(self):
+        """Main loop of the polling thread."""
+
+        while True:
+
+            with self.lock:
+
+                if not self.subscribers:
+
+                    # Next subscriber starts a new thread and the stream
+                    # starts from the points reported by then
+                    self.thread = None
+                    self.last_metric_point_id = None
+
+                    return
+
+            poll_start_time = time.time()
+
+            try:
+
+                more_points_pending = self.poll_metric_points()
+                self.poll_tasks()
+                self.poll_gpu()
+
+            except Exception:
+
+                # The stream is a convenience, a failed poll is retried
+                # on the next iteration instead of killing the thread
+                print('Metric stream poll failed:\n{}'.format(traceback.format_exc()))
+
+                more_points_pending = False
+
+            if not more_points_pending:
+
+                time.sleep(max(self.poll_interval - (time.time() - poll_start_time), 0))
+
+
+    def poll_metric_points(self):
+        """Pushes the metric points inserted since the previous poll.
+
+        Returns
+        -------
+        more_points_pending : bool
+            True if the poll was limited by MAX_POINTS_PER_POLL.
+        """
+
+        table = MetricPoint.__table__
+
+        with db.engine.connect() as connection:
+
+            query = db.select([table.c.id,
+                               table.c.experiment_table,
+                               table.c.experiment_id,
+                               table.c.trace_name,
+                               table.c.step,
+                               table.c.value])
+
+            query = query.where(table.c.id > self.last_metric_point_id)
+            query = query.order_by(table.c.id).limit(MAX_POINTS_PER_POLL)
+
+            metric_points = connection.execute(query).fetchall()
+
+        if not metric_points:
+
+            return False
+
+        self.last_metric_point_id = metric_points[-1][0]
+
+        experiment_traces = {}
+
+        for _, experiment_table, experiment_id, trace_name, step, value in metric_points:
+
+            traces = experiment_traces.setdefault((experiment_table, experiment_id), {})
+            trace = traces.setdefault(trace_name, {'steps': [], 'values': []})
+
+            trace['steps'].append(step)
+            trace['values'].append(value)
+
+        for subscriber in self.get_subscribers('metrics'):
+
+            for experiment, traces in experiment_traces.items():
+
+                if experiment in subscriber.experiments:
+
+                    subscriber.put(create_metric_points_event(experiment, traces))
+
+        return len(metric_points) == MAX_POINTS_PER_POLL
+
+
+    def poll_tasks(self):
+        """Pushes the states of the tasks if any of them changed."""
+
+        task_rows = generate_table_from_future_objects(task_manager.tasks_list,
+                                                       task_manager.get_queue_estimates())
+
+        if task_rows == self.task_rows:
+
+            return
+
+        self.task_rows = task_rows
+
+        for subscriber in self.get_subscribers('tasks'):
+
+            subscriber.put(('tasks', task_rows))
+
+
+    def poll_gpu(self):
+        """Pushes the output of gpustat if any page shows it and it changed."""
+
+        subscribers = self.get_subscribers('gpu')
+
+        if not subscribers:
+
+            return
+
+        gpu_state = get_gpu_state()
+
+        if gpu_state == self.gpu_state:
+
+            return
+
+        self.gpu_state = gpu_state
+
+        for subscriber in subscribers:
+
+            subscriber.put(('gpu', gpu_state))
+
+
+def get_last_metric_point_id():
+
+    table = MetricPoint.__table__
+
+    with db.engine.connect() as connection:
+
+        last_metric_point_id = connection.execute(db.select([db.func.max(table.c.id)])).scalar()
+
+    return last_metric_point_id or 0
+
+
+def create_metric_points_event(experiment, traces):
+
+    experiment_table, experiment_id = experiment
+
+    return ('metrics', {'experiment_table': experiment_table,
+                        'experiment_id': experiment_id,
+                        'traces': traces})
+
+
+def get_gpu_state():
+    """Returns the output of gpustat as a string."""
+
+    try:
+
+        gpu_state = subprocess.check_output(['gpustat'])
+
+    except (OSError, subprocess.CalledProcessError) as error:
+
+        return 'gpustat failed: {}'.format(error)
+
+    return gpu_state.decode('utf-8', 'replace')
+
+
+def load_missed_metric_points(experiment_table, experiment_id, last_steps):
+    """Loads the points of an experiment reported after the specified steps.
+
+    Pages load their figures before subscribing, the points reported in
+    between are sent to them right after subscription.
+
+    Parameters
+    ----------
+    last_steps : dict
+        Dict that maps trace name into the last step that the page has.
+
+    Returns
+    -------
+    traces : dict
+        Dict that maps trace name into dict with steps and values lists.
+    """
+
+    table = MetricPoint.__table__
+
+    query = db.select([table.c.trace_name, table.c.step, table.c.value])
+
+    query = query.where(db.and_(table.c.experiment_table == experiment_table,
+                                table.c.experiment_id == experiment_id))
+
+    if last_steps:
+
+        trace_conditions = [table.c.trace_name.notin_(list(last_steps.keys()))]
+
+        for trace_name, last_step in last_steps.items():
+
+            trace_conditions.append(db.and_(table.c.trace_name == trace_name,
+                                            table.c.step > last_step))
+
+        query = query.where(db.or_(*trace_conditions))
+
+    query = query.order_by(table.c.trace_name, table.c.step)
+
+    traces = {}
+
+    with db.engine.connect() as connection:
+
+        for trace_name, step, value in connection.execute(query):
+
+            trace = traces.setdefault(trace_name, {'steps': [], 'values': []})
+
+            trace['steps'].append(step)
+            trace['values'].append(value)
+
+    return traces
+
+
+def format_event(event_type, data):
+
+    return 'event: {}\ndata: {}\n\n'.format(event_type, json.dumps(data))
+
+
+def generate_events(subscriber, initial_events):
+    """Generates the body of an event stream response.
+
+    Keep-alive comments are sent when there are no events, so that
+    closed connections are detected and the subscriber is removed.
+    """
+
+    try:
+
+        for event_type, data in initial_events:
+
+            yield format_event(event_type, data)
+
+        while True:
+
+            try:
+
+                event = subscriber.queue.get(timeout=stream_keepalive_interval_s)
+
+            except queue.Empty:
+
+                yield ': keep-alive\n\n'
+
+                continue
+
+            if event is None:
+
+                return
+
+            event_type, data = event
+
+            yield format_event(event_type, data)
+
+    finally:
+
+        metric_stream.unsubscribe(subscriber)
+
+
+def stream_view():
+    """Server-sent events endpoint of the metric stream.
+
+    Query parameters
+    ----------------
+    channels : comma separated subset of 'metrics', 'tasks' and 'gpu'.
+
+    experiments : json list of [experiment table, experiment id, last steps]
+        where last steps is a dict that maps trace name into the last
+        step that the page already has.
+    """
+
+    channels = [channel for channel in flask.request.args.get('channels', '').split(',') if channel]
+
+    experiments = json.loads(flask.request.args.get('experiments', '[]'))
+
+    subscriber = metric_stream.subscribe(channels,
+                                         [(experiment_table, experiment_id)
+                                          for experiment_table, experiment_id, last_steps in experiments])
+
+    # Points that were reported after the page had loaded the figure and
+    # before it subscribed. Since subscription happens first, some of them
+    # can also be delivered by the stream -- pages ignore the steps they have.
+    initial_events = []
+
+    for experiment_table, experiment_id, last_steps in experiments:
+
+        traces = load_missed_metric_points(experiment_table, experiment_id, last_steps)
+
+        if traces:
+
+            initial_events.append(create_metric_points_event((experiment_table, experiment_id), traces))
+
+    if 'tasks' in subscriber.channels:
+
+        initial_events.append(('tasks', generate_table_from_future_objects(task_manager.tasks_list,
+                                                                           task_manager.get_queue_estimates())))
+
+    if 'gpu' in subscriber.channels:
+
+        initial_events.append(('gpu', get_gpu_state()))
+
+    response = flask.Response(generate_events(subscriber, initial_events),
+                              mimetype='text/event-stream')
+
+    response.headers['Cache-Control'] = 'no-cache'
+
+    return response
+
+
+metric_stream = MetricStream()
+
+# Views registered after the dash auth object was created are not
+# protected automatically
+server.add_url_rule('/metrics/stream', 'metrics_stream', auth.auth_wrapper(stream_view))
@@ -0,0 +1,215 @@
+from dash_deep.app import server, auth, db, experiments_table_cache_size
+from dash_deep.sql import (get_table_columns,
+                           create_table_page_query,
+                           generate_table_contents_from_sql_model_class)
+
+import flask
+
+import json
+import threading
+from collections import OrderedDict
+
+
+class ExperimentTableCache(object):
+    """Keeps the rendered pages of experiment tables in memory.
+
+    All the open results and inference pages of all the clients share
+    the cache. A cached page is returned if the signature of the matching
+    experiments (see sql.get_table_signature()) didn't change since it was
+    cached. Otherwise only the ids and versions of the records of the page
+    are queried and only the records that were added or updated since are
+    loaded, the rest are taken from the cached page.
+
+    Experiments are written from the processes of the task manager, so
+    the signature is the only way to notice their writes. Writes that happen
+    in the server process, like scheduling a task, invalidate the pages of
+    the class directly with invalidate().
+
+    Pages are evicted in least recently used order.
+
+    """
+
+    def __init__(self, maximum_size=experiments_table_cache_size):
+
+        self.maximum_size = maximum_size
+
+        # Maps (table name, query json) into a dict with the
+        # signature and the rows of a page
+        self.pages = OrderedDict()
+
+        self.lock = threading.Lock()
+
+        self.number_of_hits = 0
+        self.number_of_patches = 0
+        self.number_of_misses = 0
+
+
+    def get_rows(self,
+                 sql_model_class,
+                 signature,
+                 filter_string,
+                 conditions,
+                 sort_column_name,
+                 descending,
+                 page,
+                 page_size):
+        """Returns the rows of a page of an experiment table.
+
+        Parameters
+        ----------
+        sql_model_class : sqlalchemy model class
+            sqlalchemy model class
+
+        signature : list
+            Current signature of the matching records, see sql.get_table_signature().
+
+        filter_string : string
+            Filter that the conditions were parsed from, used as a key.
+
+        For the rest of the parameters see
+        sql.generate_table_contents_from_sql_model_class().
+
+        Returns
+        -------
+        rows : list
+            List of dicts representing database records.
+        """
+
+        key = (sql_model_class.__tablename__,
+               json.dumps([filter_string, sort_column_name, descending, page, page_size]))
+
+        with self.lock:
+
+            cached_page = self.pages.pop(key, None)
+
+            if cached_page is not None and cached_page['signature'] == signature:
+
+                self.pages[key] = cached_page
+                self.number_of_hits += 1
+
+                return cached_page['rows']
+
+        if cached_page is None:
+
+            rows = generate_table_contents_from_sql_model_class(sql_model_class,
+                                                                conditions,
+                                                                sort_column_name,
+                                                                descending,
+                                                                page,
+                                                                page_size)
+
+            with self.lock:
+
+                self.number_of_misses += 1
+        else:
+
+            rows = self.patch_rows(sql_model_class,
+                                   cached_page['rows'],
+                                   conditions,
+                                   sort_column_name,
+                                   descending,
+                                   page,
+                                   page_size)
+
+            with self.lock:
+
+                self.number_of_patches += 1
+
+        with self.lock:
+
+            self.pages[key] = {'signature': signature, 'rows': rows}
+
+            while len(self.pages) > self.maximum_size:
+
+                self.pages.popitem(last=False)
+
+        return rows
+
+
+    def patch_rows(self,
+                   sql_model_class,
+                   cached_rows,
+                   conditions,
+                   sort_column_name,
+                   descending,
+                   page,
+                   page_size):
+        """Reloads only the records of a page that were added or updated."""
+
+        page_versions = create_table_page_query(sql_model_class,
+                                                [sql_model_class.id, sql_model_class.version],
+                                                conditions,
+                                                sort_column_name,
+                                                descending,
+                                                page,
+                                                page_size).all()
+
+        if not page_versions:
+
+            # Dash's data table needs to receive this exact value
+            # in case when we want an empty table
+            return [{}]
+
+        cached_rows_by_id = dict((row['id'], row) for row in cached_rows if 'id' in row)
+
+        updated_ids = [experiment_id for experiment_id, version in page_versions
+                       if experiment_id not in cached_rows_by_id or
+                       cached_rows_by_id[experiment_id]['version'] != version]
+
+        if updated_ids:
+
+            columns = get_table_columns(sql_model_class)
+
+            query = db.session.query(*columns).filter(sql_model_class.id.in_(updated_ids))
+
+            for experiment in query:
+
+                row = OrderedDict((column.name, value) for column, value in zip(columns, experiment))
+
+                cached_rows_by_id[row['id']] = row
+
+        return [cached_rows_by_id[experiment_id] for experiment_id, version in page_versions]
+
+
+    def invalidate(self, sql_model_class):
+        """Drops all the cached pages of the specified class."""
+
+        with self.lock:
+
+            for key in list(self.pages.keys()):
+
+                if key[0] == sql_model_class.__tablename__:
+
+                    del self.pages[key]
+
+
+    def get_statistics(self):
+        """Returns the counters of the cache.
+
+        Returns
+        -------
+        statistics : dict
+            Number of cached pages, pages returned as they were (hits),
+            pages patched with the updated records and pages loaded fully.
+        """
+
+        with self.lock:
+
+            return {'number_of_pages': len(self.pages),
+                    'number_of_hits': self.number_of_hits,
+                    'number_of_patches': self.number_of_patches,
+                    'number_of_misses': self.number_of_misses}
+
+
+experiment_table_cache = ExperimentTableCache()
+
+
+def table_cache_stats_view():
+    """Returns the statistics of the experiment table cache as json."""
+
+    return flask.jsonify(experiment_table_cache.get_statistics())
+
+
+# Views registered after the dash auth object was created are not
+# protected automatically
+server.add_url_rule('/tables/stats', 'table_cache_stats', auth.auth_wrapper(table_cache_stats_view))
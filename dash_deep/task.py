@@ -1,6 +1,16 @@
 import pebble
 import psutil
 
+import flask
+
+import heapq
+import os
+import signal
+import threading
+import time
+import traceback
+from collections import deque
+
 # Monkey-patching pebble to make its children non-daemonic
 # We need this in order to allow children to spawn processes too
 # Children should be able to spawn processes too because data loading
@@ -74,11 +84,296 @@ import pebble.pool.process
 pebble.pool.process.launch_process = launch_process_patched
 pebble.pool.process.stop_process = stop_process_patched
 
-from dash_deep.app import db
+from dash_deep.app import (db,
+                           scheduler_jobs_per_device,
+                           scheduler_min_free_memory_mb,
+                           scheduler_cpu_jobs,
+                           scheduler_poll_interval_s,
+                           scheduler_user_weights,
+                           scheduler_model_weights,
+                           scheduler_fair_share_half_life_s,
+                           scheduler_fair_share_min_charge_s)
+
+
+# Number of the last durations of the finished tasks of each
+# model class that are used to estimate the waiting times
+TASK_DURATION_HISTORY_SIZE = 20
+
+
+def get_request_user_name():
+    """Returns the basic auth name of the user of the current request or None."""
+    
+    try:
+        
+        return flask.request.authorization.username
+    
+    except (RuntimeError, AttributeError):
+        
+        # Outside of a request or without authorization
+        return None
+
+
+def format_waiting_time(seconds):
+    """Formats an estimated waiting time for the tasks page.
+    
+    The estimates are rounded up to whole minutes, so that the
+    rows of the tasks don't change on every poll of the stream.
+    """
+    
+    if seconds is None:
+        
+        return 'unknown'
+    
+    return '~{} min'.format(int(-(-seconds // 60)))
+
+
+class DeviceProbe(object):
+    """Reports the gpus of the machine and their memory with gpustat.
+    
+    The scheduler only calls get_devices(), so any object with this method
+    can be used instead, see FakeDeviceProbe.
+    
+    """
+    
+    def get_devices(self):
+        """Returns the gpus of the machine.
+        
+        Returns
+        -------
+        devices : list of dicts
+            'index', 'memory_total' and 'memory_used' (in megabytes)
+            of each gpu. Empty if there are no gpus or gpustat failed.
+        """
+        
+        # Imported here, so that machines without nvidia drivers can
+        # still start the server and run the tasks on the cpu
+        try:
+            import gpustat
+            
+            gpu_stats = gpustat.GPUStatCollection.new_query()
+            
+        except Exception:
+            
+            return []
+        
+        return [{'index': gpu.index,
+                 'memory_total': gpu.memory_total,
+                 'memory_used': gpu.memory_used} for gpu in gpu_stats]
+
+
+class FakeDeviceProbe(object):
+    """Reports a fixed inventory of gpus.
+    
+    Used to check the scheduling on machines without gpus,
+    see the test_scheduler command.
+    
+    """
+    
+    def __init__(self, devices):
+        """
+        Parameters
+        ----------
+        devices : list of dicts
+            See DeviceProbe.get_devices().
+        """
+        
+        self.devices = [dict(device) for device in devices]
+        
+    def set_memory_used(self, device_index, memory_used):
+        
+        for device in self.devices:
+            
+            if device['index'] == device_index:
+                
+                device['memory_used'] = memory_used
+        
+    def get_devices(self):
+        
+        return [dict(device) for device in self.devices]
+
+
+def run_on_device(function, visible_devices, *args):
+    """Runs a task in the process of the pool with the assigned gpu.
+    
+    CUDA_VISIBLE_DEVICES is read by the deep learning frameworks when
+    they initialize cuda, which happens inside of the task, so the
+    task sees only the assigned gpu as the device number 0.
+    
+    Cuda orders the gpus by their speed by default, while the indices of
+    nvidia-smi and gpustat follow the pci bus, so the order is set as well
+    to make the picked index mean the same gpu for cuda.
+    """
+    
+    os.environ['CUDA_DEVICE_ORDER'] = 'PCI_BUS_ID'
+    os.environ['CUDA_VISIBLE_DEVICES'] = visible_devices
+    
+    return function(*args)
+
+
+class ScheduledTask(object):
+    """Task that waits in the queue of the TaskManager until a device is free.
+    
+    Provides the methods of the future object of the process pool that
+    the tasks page uses, the future itself is created when the task is started.
+    
+    """
+    
+    def __init__(self, function, sql_model_instance, device_index=None):
+        """
+        Parameters
+        ----------
+        function : function
+            Function that runs the task.
+        
+        sql_model_instance : sqlalchemy model instance
+            Detached experiment that is passed to the function.
+        
+        device_index : int
+            Index of the gpu the task has to run on. Any
+            gpu is picked if None.
+        """
+        
+        self.function = function
+        self.sql_model_instance = sql_model_instance
+        self.device_index = device_index
+        
+        self.priority = getattr(sql_model_instance, 'priority', None) or 0
+        self.submitted_by = getattr(sql_model_instance, 'submitted_by', None)
+        
+        # Index of the assigned gpu, None for tasks that run on the cpu
+        self.assigned_device_index = None
+        
+        self.future = None
+        self.is_cancelled_in_queue = False
+        
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+    
+    def get_fair_share_keys(self):
+        """Returns the keys that the device time of the task is accounted to."""
+        
+        return [('user', self.submitted_by), ('model', self.sql_model_instance.__tablename__)]
+    
+    @property
+    def state(self):
+        
+        if self.future is not None:
+            
+            # TODO: since we use a non public attribute it might
+            # be changed in a future -- need to investigate more
+            return self.future._state
+        
+        return 'CANCELLED' if self.is_cancelled_in_queue else 'QUEUED'
+    
+    def get_device_name(self):
+        
+        if self.future is None:
+            
+            return 'None'
+        
+        if self.assigned_device_index is None:
+            
+            return 'cpu'
+        
+        return 'gpu {}'.format(self.assigned_device_index)
+    
+    def done(self):
+        
+        if self.future is None:
+            
+            return self.is_cancelled_in_queue
+        
+        return self.future.done()
+    
+    def cancelled(self):
+        
+        if self.future is None:
+            
+            return self.is_cancelled_in_queue
+        
+        return self.future.cancelled()
+    
+    def exception(self):
+        
+        if self.future is None:
+            
+            return None
+        
+        return self.future.exception()
+
 
 class TaskManager():
+    """Runs the tasks started from the pages in separate processes.
+    
+    Tasks are kept in a queue and are started once a gpu has a free job slot
+    (jobs_per_device tasks at once) and at least min_free_memory_mb megabytes
+    of free memory, the gpu with the most free memory is picked. Tasks with
+    gpu_id >= 0 wait for that specific gpu.
+    
+    The queue is ordered by the priority of the tasks, then by fair share
+    (see get_fair_share_score()) and then by the time they were scheduled,
+    so a long sweep of one user doesn't hold back the short jobs of the
+    others. Running tasks are never stopped to make room for other tasks. The assigned gpu is written into the gpu_id column of the
+    experiment and is passed to the task process with CUDA_VISIBLE_DEVICES.
+    If the device probe reports no gpus, cpu_jobs tasks run at once on the cpu.
+    
+    The queue is checked when a task is scheduled or finishes and every
+    poll_interval_s seconds, since the memory of the gpus is also freed by
+    processes that the manager doesn't know about.
+    
+    """
     
-    def __init__(self):
+    def __init__(self,
+                 device_probe=None,
+                 jobs_per_device=scheduler_jobs_per_device,
+                 min_free_memory_mb=scheduler_min_free_memory_mb,
+                 cpu_jobs=scheduler_cpu_jobs,
+                 poll_interval_s=scheduler_poll_interval_s,
+                 user_weights=scheduler_user_weights,
+                 model_weights=scheduler_model_weights,
+                 fair_share_half_life_s=scheduler_fair_share_half_life_s,
+                 fair_share_min_charge_s=scheduler_fair_share_min_charge_s):
+        """
+        Parameters
+        ----------
+        device_probe : DeviceProbe
+            Object that reports the gpus, DeviceProbe() by default.
+        
+        jobs_per_device : int
+            Number of tasks that run on one gpu at once.
+        
+        min_free_memory_mb : int
+            Free memory of a gpu that is needed to start a task on it.
+        
+        cpu_jobs : int
+            Number of tasks that run at once if there are no gpus.
+        
+        poll_interval_s : float
+            Seconds between the checks of the queue.
+        
+        user_weights : dict
+            Maps user name into its fair share weight, 1 by default.
+        
+        model_weights : dict
+            Maps table name of a model class into its fair share weight.
+        
+        fair_share_half_life_s : float
+            Seconds after which the device time of a finished task counts half.
+        
+        fair_share_min_charge_s : float
+            Device time that a running task is charged at least.
+        """
+        
+        self.device_probe = device_probe or DeviceProbe()
+        self.jobs_per_device = jobs_per_device
+        self.min_free_memory_mb = min_free_memory_mb
+        self.cpu_jobs = cpu_jobs
+        self.poll_interval = poll_interval_s
+        self.user_weights = user_weights
+        self.model_weights = model_weights
+        self.fair_share_half_life = fair_share_half_life_s
+        self.fair_share_min_charge = fair_share_min_charge_s
         
         # TODO: forward addtional arguments to ProcessPool()
         # function invocation in order to give users full control
@@ -91,15 +386,34 @@ class TaskManager():
         # way to make deep learning frameworks to fully free up the gpu
         # memory that they have used other than stopping the process.
         # https://pebble.readthedocs.io/en/latest/#pebble.ProcessPool
-        self.process_pool = pebble.ProcessPool(max_tasks=1)
+        #
+        # The number of started tasks is limited by the scheduler, so the
+        # pool has enough workers for all the job slots
+        number_of_devices = len(self.device_probe.get_devices())
+        
+        self.process_pool = pebble.ProcessPool(max_workers=max(number_of_devices * jobs_per_device, cpu_jobs, 1),
+                                               max_tasks=1)
         
-        # This list is responsible for storing 'future' object of every
-        # scheduled task
+        # This list is responsible for storing every scheduled task
+        # in the order they were scheduled, see ScheduledTask
         self.tasks_list = []
         
+        # Tasks that wait for a device
+        self.queued_tasks = []
+        
+        # Maps fair share key into the decayed device time of the
+        # finished tasks and the time it was last updated
+        self.fair_share_usage = {}
+        
+        # Maps table name into the durations of its last finished tasks
+        self.task_durations = {}
+        
+        self.condition = threading.Condition()
+        self.thread = None
+    
     def schedule_task_from_form(self, form):
-        """Spawns a process with task that was attached to a wtform and collected
-        arguments from user.
+        """Puts a task that was attached to a wtform and collected arguments
+        from user into the queue.
     
         Uses a wtform that was filled out by user through web input form and
         validated. ```.actions``` is an additional paramerer added by our library
@@ -126,6 +440,8 @@ class TaskManager():
         form.populate_obj(sql_model_instance)
         
         # Adding the new instance to the session and saving it to a database
+        sql_model_instance.submitted_by = get_request_user_name()
+        
         db.session.add(sql_model_instance)
         db.session.commit()
         
@@ -141,14 +457,345 @@ class TaskManager():
         # in the 'active tasks' table.
         db.session.expunge(sql_model_instance)
         
-        # TODO: add additional field to the  stored future objects that will
-        # store the detached instace of sql model.
+        # The new experiment should appear on the next refresh of the tables.
+        # Imported here, since the cache depends on the models which are
+        # imported after the task manager is created in dash_deep/app.py
+        from dash_deep.table_cache import experiment_table_cache
+        
+        experiment_table_cache.invalidate(form.sql_model_class)
+        
+        # Negative gpu_id lets the scheduler pick the gpu
+        device_index = sql_model_instance.gpu_id if sql_model_instance.gpu_id >= 0 else None
+        
+        self.schedule_task(ScheduledTask(form.actions['main'], sql_model_instance, device_index))
+    
+    def schedule_task(self, task):
+        """Puts a task into the queue and starts it if a device is free.
         
-        future_obj = self.process_pool.schedule(form.actions['main'],
-                                                args=[sql_model_instance])
+        Parameters
+        ----------
+        task : ScheduledTask
+            Task to run.
+        """
+        
+        with self.condition:
+            
+            self.tasks_list.append(task)
+            self.queued_tasks.append(task)
+            
+            if self.thread is None:
+                
+                self.thread = threading.Thread(target=self.process_queue, name='dash-deep-task-scheduler')
+                self.thread.daemon = True
+                self.thread.start()
+            
+            self.condition.notify()
+    
+    def cancel_task(self, task):
+        """Cancels a task, the queued tasks are removed from the queue."""
         
-        self.tasks_list.append(future_obj)
-   
+        with self.condition:
+            
+            if task.future is None:
+                
+                if task in self.queued_tasks:
+                    
+                    self.queued_tasks.remove(task)
+                    task.is_cancelled_in_queue = True
+                
+                return
+        
+        task.future.cancel()
+    
+    def get_free_job_slots(self):
+        """Returns the number of tasks that can start on each device.
+        
+        Returns
+        -------
+        free_job_slots : dict
+            Maps gpu index into the number of tasks that can start on it,
+            the gpus without enough free memory get 0. If there are no gpus,
+            the only key is None -- the cpu.
+        """
+        
+        running_tasks = [task for task in self.tasks_list if task.future is not None and not task.future.done()]
+        
+        def count_running_tasks(device_index):
+            
+            return sum(1 for task in running_tasks if task.assigned_device_index == device_index)
+        
+        devices = self.device_probe.get_devices()
+        
+        if not devices:
+            
+            return {None: max(self.cpu_jobs - count_running_tasks(None), 0)}
+        
+        free_job_slots = {}
+        
+        for device in devices:
+            
+            free_memory = device['memory_total'] - device['memory_used']
+            
+            if free_memory < self.min_free_memory_mb:
+                
+                free_job_slots[device['index']] = 0
+                
+                continue
+            
+            free_job_slots[device['index']] = max(self.jobs_per_device - count_running_tasks(device['index']), 0)
+        
+        return free_job_slots
+    
+    def pick_device(self, task, free_job_slots, free_memory):
+        """Returns the device for a task or False if it has to wait."""
+        
+        if None in free_job_slots:
+            
+            return None if free_job_slots[None] > 0 else False
+        
+        candidate_device_indexes = [device_index for device_index, job_slots in free_job_slots.items()
+                                    if job_slots > 0 and task.device_index in (None, device_index)]
+        
+        if not candidate_device_indexes:
+            
+            return False
+        
+        return max(candidate_device_indexes, key=lambda device_index: (free_memory[device_index], -device_index))
+    
+    def get_fair_share_usage(self, key, now):
+        """Returns the decayed device time used by a fair share key."""
+        
+        usage, updated_at = self.fair_share_usage.get(key, (0.0, now))
+        
+        usage *= 0.5 ** ((now - updated_at) / float(self.fair_share_half_life))
+        
+        # Running tasks are charged up front, so that one user
+        # doesn't take all the free job slots at once
+        for task in self.tasks_list:
+            
+            if task.future is not None and task.finished_at is None and key in task.get_fair_share_keys():
+                
+                usage += max(now - task.started_at, self.fair_share_min_charge)
+        
+        return usage
+    
+    def get_fair_share_score(self, task, now):
+        """Returns the weighted usage of the user and the model class of a task.
+        
+        Tasks with lower scores are started first among the
+        tasks of the same priority.
+        """
+        
+        user_key, model_key = task.get_fair_share_keys()
+        
+        return (self.get_fair_share_usage(user_key, now) / float(self.user_weights.get(user_key[1], 1)) +
+                self.get_fair_share_usage(model_key, now) / float(self.model_weights.get(model_key[1], 1)))
+    
+    def get_ordered_queued_tasks(self):
+        """Returns the queued tasks in the order they are going to be started.
+        
+        Should be called with the condition acquired.
+        """
+        
+        now = time.time()
+        
+        return sorted(self.queued_tasks, key=lambda task: (-task.priority,
+                                                           self.get_fair_share_score(task, now),
+                                                           task.queued_at))
+    
+    def start_queued_tasks(self):
+        """Starts the queued tasks that have a free device, in the order of the queue.
+        
+        The order is computed again after each started task, since
+        the task changes the fair share of its user and model class.
+        
+        Should be called with the condition acquired.
+        """
+        
+        if not self.queued_tasks:
+            
+            return
+        
+        free_job_slots = self.get_free_job_slots()
+        
+        free_memory = dict((device['index'], device['memory_total'] - device['memory_used'])
+                           for device in self.device_probe.get_devices())
+        
+        task_was_started = True
+        
+        while task_was_started:
+            
+            task_was_started = False
+            
+            for task in self.get_ordered_queued_tasks():
+                
+                device_index = self.pick_device(task, free_job_slots, free_memory)
+                
+                if device_index is False:
+                    
+                    # Tasks pinned to a busy gpu don't hold
+                    # back the tasks that can run elsewhere
+                    continue
+                
+                free_job_slots[device_index] -= 1
+                
+                self.start_task(task, device_index)
+                
+                self.queued_tasks.remove(task)
+                
+                task_was_started = True
+                
+                break
+    
+    def record_finished_task(self, task):
+        """Accounts the device time of a finished task and wakes up the scheduling thread."""
+        
+        with self.condition:
+            
+            now = time.time()
+            
+            task.finished_at = now
+            
+            duration = now - task.started_at
+            
+            for key in task.get_fair_share_keys():
+                
+                self.fair_share_usage[key] = (self.get_fair_share_usage(key, now) + duration, now)
+            
+            if not task.future.cancelled() and task.future.exception() is None:
+                
+                table_name = task.sql_model_instance.__tablename__
+                
+                self.task_durations.setdefault(table_name, deque(maxlen=TASK_DURATION_HISTORY_SIZE)).append(duration)
+            
+            self.condition.notify()
+    
+    def estimate_task_duration(self, task):
+        """Returns the mean duration of the finished tasks of the same model
+        class or of all the finished tasks, None if no task finished yet."""
+        
+        durations = self.task_durations.get(task.sql_model_instance.__tablename__)
+        
+        if not durations:
+            
+            durations = [duration for model_durations in self.task_durations.values() for duration in model_durations]
+        
+        if not durations:
+            
+            return None
+        
+        return sum(durations) / float(len(durations))
+    
+    def get_queue_estimates(self):
+        """Estimates when the queued tasks are going to start.
+        
+        Tasks are assumed to take as long as the earlier tasks of the same
+        model class and to start on the first job slot that frees up. The
+        pinned tasks and the free memory of the gpus are not taken into account.
+        
+        Returns
+        -------
+        queue_estimates : dict
+            Maps each queued task into a dict with its 'position' in the queue
+            (starting from 1) and the 'estimated_wait' in seconds, None if
+            it can't be estimated yet.
+        """
+        
+        with self.condition:
+            
+            now = time.time()
+            
+            number_of_devices = len(self.device_probe.get_devices())
+            
+            number_of_job_slots = number_of_devices * self.jobs_per_device if number_of_devices else self.cpu_jobs
+            
+            # Times from now when each of the job slots frees up,
+            # None if the running task has no estimated duration
+            slot_free_times = []
+            
+            for task in self.tasks_list:
+                
+                if task.future is None or task.finished_at is not None:
+                    
+                    continue
+                
+                duration = self.estimate_task_duration(task)
+                
+                slot_free_times.append(None if duration is None else max(duration - (now - task.started_at), 0.0))
+            
+            slot_free_times.extend([0.0] * max(number_of_job_slots - len(slot_free_times), 0))
+            
+            if None in slot_free_times:
+                
+                # Slots with unknown running tasks are considered busy forever
+                slot_free_times = [free_time for free_time in slot_free_times if free_time is not None]
+            
+            heapq.heapify(slot_free_times)
+            
+            queue_estimates = {}
+            
+            for position, task in enumerate(self.get_ordered_queued_tasks()):
+                
+                duration = self.estimate_task_duration(task)
+                
+                estimated_wait = None
+                
+                if slot_free_times:
+                    
+                    estimated_wait = heapq.heappop(slot_free_times)
+                    
+                    if duration is not None:
+                        
+                        heapq.heappush(slot_free_times, estimated_wait + duration)
+                
+                queue_estimates[task] = {'position': position + 1,
+                                         'estimated_wait': estimated_wait}
+            
+            return queue_estimates
+    
+    def start_task(self, task, device_index):
+        
+        task.assigned_device_index = device_index
+        task.started_at = time.time()
+        
+        sql_model_instance = task.sql_model_instance
+        
+        # Recording the assigned gpu, -1 stands for the cpu
+        sql_model_instance.gpu_id = -1 if device_index is None else device_index
+        
+        table = sql_model_instance.__table__
+        
+        with db.engine.begin() as connection:
+            
+            connection.execute(table.update().where(table.c.id == sql_model_instance.id).values(gpu_id=sql_model_instance.gpu_id,
+                                                                                             version=table.c.version + 1))
+        
+        visible_devices = '' if device_index is None else str(device_index)
+        
+        task.future = self.process_pool.schedule(run_on_device,
+                                                 args=[task.function, visible_devices, sql_model_instance])
+        
+        task.future.add_done_callback(lambda future: self.record_finished_task(task))
+    
+    def process_queue(self):
+        """Main loop of the scheduling thread."""
+        
+        while True:
+            
+            with self.condition:
+                
+                try:
+                    
+                    self.start_queued_tasks()
+                    
+                except Exception:
+                    
+                    # The queue is processed again on the next check
+                    # instead of killing the thread
+                    print('Starting the queued tasks failed:\n{}'.format(traceback.format_exc()))
+                
+                self.condition.wait(self.poll_interval)
+    
     def shutdown(self):
         """Stops all the running jobs.
     
@@ -168,7 +815,14 @@ class TaskManager():
 
         """
         
+        with self.condition:
+            
+            for task in self.queued_tasks:
+                
+                task.is_cancelled_in_queue = True
+            
+            self.queued_tasks = []
+        
         self.process_pool.stop()
         
         self.process_pool.join()
-        
\ No newline at end of file
@@ -0,0 +1,154 @@
+from dash_deep.app import server, db, VALID_USERNAME_PASSWORD_PAIRS
+from dash_deep.sql import create_dummy_endovis_records
+from dash_deep.metrics import MetricPoint
+from dash_deep.rollups import MetricRollup
+
+import numpy as np
+from PIL import Image
+
+import base64
+import json
+import os
+import time
+from io import BytesIO
+
+
+# Fakes shared by the test_* commands (see dash_deep/cli/default_commands.py)
+# and by the tests in the tests folder
+
+
+def create_fake_experiments(number_of_experiments, gpu_id=-1):
+    """Saves fake endovis experiments and detaches them from the session.
+
+    The experiments are detached the same way as the task manager does, so
+    that they can be reported from other threads, which have their own session.
+
+    Parameters
+    ----------
+    number_of_experiments : int
+        Number of fake experiments.
+
+    gpu_id : int
+        gpu_id of the experiments, -1 lets the scheduler pick the gpu.
+
+    Returns
+    -------
+    fake_experiments : list of sqlalchemy model instances
+        Detached experiments.
+    """
+
+    fake_experiments = create_dummy_endovis_records(number_of_experiments)
+
+    for fake_experiment in fake_experiments:
+
+        fake_experiment.gpu_id = gpu_id
+
+    db.session.add_all(fake_experiments)
+    db.session.commit()
+
+    for fake_experiment in fake_experiments:
+
+        db.session.refresh(fake_experiment)
+        db.session.expunge(fake_experiment)
+
+    return fake_experiments
+
+
+def delete_fake_experiments(fake_experiments):
+    """Deletes fake experiments together with their metric points and rollups."""
+
+    for fake_experiment in fake_experiments:
+
+        for metric_table in (MetricPoint, MetricRollup):
+
+            metric_table.query.filter(metric_table.experiment_table == fake_experiment.__tablename__,
+                                      metric_table.experiment_id == fake_experiment.id).delete()
+
+        db.session.delete(db.session.merge(fake_experiment))
+
+    db.session.commit()
+
+
+def run_fake_task(duration, sql_model_instance):
+    """Task of the test_scheduler command, returns the gpu it was given and when it ran."""
+
+    start_time = time.time()
+
+    time.sleep(duration)
+
+    return os.environ.get('CUDA_VISIBLE_DEVICES'), start_time, time.time()
+
+
+# Weights of the 1x1 convolution of the tiny model of the test_inference_server command
+TINY_MODEL_WEIGHTS = np.random.RandomState(0).randn(3, 2).astype(np.float32)
+
+
+def run_tiny_model(input_images_np, weights=TINY_MODEL_WEIGHTS):
+    """Segments a batch of rgb images with a 1x1 convolution on the cpu."""
+
+    images = np.stack(input_images_np).astype(np.float32) / 255
+
+    # (n, h, w)
+    segmentations = np.tensordot(images, weights, axes=([3], [0])).argmax(axis=3)
+
+    return list(segmentations.astype(np.uint8) * 100)
+
+
+# Actions of the tiny model, they replace the actions of the experiment
+# that the test_inference_server command sends to the inference endpoint
+
+def load_tiny_model(sql_model_instance):
+
+    return TINY_MODEL_WEIGHTS
+
+
+def run_tiny_model_inference(sql_model_instance, input_image_np, model=TINY_MODEL_WEIGHTS):
+
+    return run_tiny_model([input_image_np], model)[0]
+
+
+def run_tiny_model_batch_inference(sql_model_instance, input_images_np, model):
+
+    return run_tiny_model(input_images_np, model)
+
+
+def send_test_request(url, request_json=None):
+    """Sends a request to the server with its test client and returns the response.
+
+    The request is posted if request_json is given. Each request has its
+    own client, so that the requests can be sent from multiple threads.
+    """
+
+    credentials = base64.b64encode(':'.join(VALID_USERNAME_PASSWORD_PAIRS[0]).encode('utf-8')).decode('ascii')
+
+    headers = {'Authorization': 'Basic ' + credentials}
+
+    if request_json is None:
+
+        return server.test_client().get(url, headers=headers)
+
+    return server.test_client().post(url,
+                                     data=json.dumps(request_json),
+                                     content_type='application/json',
+                                     headers=headers)
+
+
+def run_endpoint_request(url, image):
+    """Runs the inference of an image with the endpoint and decodes the segmentation."""
+
+    image_buffer = BytesIO()
+
+    Image.fromarray(image).save(image_buffer, format='PNG')
+
+    response = send_test_request(url, {'image': base64.b64encode(image_buffer.getvalue()).decode('ascii')})
+
+    response_json = json.loads(response.get_data(as_text=True))
+
+    if response.status_code != 200:
+
+        raise RuntimeError('The endpoint responded with {}: {}'.format(response.status_code,
+                                                                       response_json.get('error')))
+
+    segmentation_string = response_json['result'].split(',', 1)[1]
+
+    return np.array(Image.open(BytesIO(base64.b64decode(segmentation_string))))
@@ -5,26 +5,69 @@ import dash_core_components as dcc
 from dash.dependencies import Input, Output
 
 import os
+import json
 import gpustat
 
 # TODO: so far we just display the output of the gpustat, directly
 # use the libarary and make the output look nicer
 
 
-# Here we apply an interval that refreshes the state of gpu
-# with a specified interval=1000ms
+# The state of gpu is pushed by the metric stream (see dash_deep/stream.py)
+# which runs gpustat once for all the open pages. Polling with an
+# interval=1000ms is left as a fallback.
 
 layout = html.Div([
    
             html.H1('GPU'),
-            dcc.Interval(id='gpu-state-update-interval', interval=1000),
-            html.Div(id='gpu-state-container', style={'text-align': 'left'})
+            dcc.Interval(id='gpu-state-update-interval', interval=60*60*1000),
+            dcc.RadioItems(id='gpu-state-update-mode',
+                           value='push',
+                           options=[
+                                {'label': 'Live update', 'value': 'push'},
+                                {'label': 'Live update (polling)', 'value': 'poll'}
+                            ]),
+            html.Div(id='gpu-state-container', style={'text-align': 'left'}),
+    
+            # Filled by dash_deep/static/live_stream.js, dash never renders
+            # into this element, so that they don't interfere
+            html.Div(id='gpu-state-stream-container',
+                     style={'text-align': 'left', 'white-space': 'pre', 'width': '700px'}),
+            html.Div(id='gpu-stream-config', className='dash-deep-stream-config', style={'display': 'none'})
 ])
 
+
+@app.callback(
+    Output('gpu-stream-config', 'children'),
+    [Input('gpu-state-update-mode', 'value')])
+def update_stream_config(value):
+    
+    if value != 'push':
+        
+        return ''
+    
+    return json.dumps({'channel': 'gpu', 'container_id': 'gpu-state-stream-container'})
+
+
+@app.callback(
+    Output('gpu-state-update-interval', 'interval'),
+    [Input('gpu-state-update-mode', 'value')])
+def update_interval(value):
+    
+    if value != 'poll':
+        
+        return 60*60*1000
+    
+    return 1000
+
 @app.callback(
     Output('gpu-state-container', 'children'),
-    [Input('gpu-state-update-interval', 'n_intervals')])
-def display_output(n):
+    [Input('gpu-state-update-interval', 'n_intervals'),
+     Input('gpu-state-update-mode', 'value')])
+def display_output(n, value):
+    
+    if value != 'poll':
+        
+        return ''
     
     # use the gpustat pythom module to return json
     # and format into table later on
@@ -7,6 +7,7 @@ import dash_table_experiments as dt
 from dash_deep.future import generate_table_from_future_objects
 
 from time import sleep
+import json
 
 layout = html.Div([
     
@@ -23,7 +24,13 @@ layout = html.Div([
     
             # Whenever this element is updated, it triggers
             # refresh of the table -- used in the cancel button callback
-            html.Div(id='tasks-refresh-trigger')
+            html.Div(id='tasks-refresh-trigger'),
+    
+            # Task state changes are pushed by the metric stream and
+            # press the refresh button (see dash_deep/static/live_stream.js)
+            html.Div(json.dumps({'channel': 'tasks', 'refresh_button_id': 'tasks-table-refresh-button'}),
+                     className='dash-deep-stream-config',
+                     style={'display': 'none'})
 ])
 
 @app.callback(
@@ -40,7 +47,7 @@ def callback(n_clicks, selected_row_indices, rows):
     
     for selected_task_id in selected_tasks_ids:
         
-        task_manager.tasks_list[selected_task_id].cancel()
+        task_manager.cancel_task(task_manager.tasks_list[selected_task_id])
     
     # TODO: See if this can be done in a better way
     # Wating here for a while -- sometimes processes take
@@ -61,6 +68,7 @@ def display_output(n_clicks, children):
     # 2) Update of 'tasks-refresh-trigger' element -- it is updated when
     #    cancel button is pressed.
     
-    table_contents = generate_table_from_future_objects(task_manager.tasks_list) 
+    table_contents = generate_table_from_future_objects(task_manager.tasks_list,
+                                                        task_manager.get_queue_estimates()) 
     
     return table_contents
@@ -2,15 +2,25 @@ import dash_html_components as html
 import dash_core_components as dcc
 from dash.dependencies import Input, Output, State, Event
 
-from dash_deep.app import app, task_manager
+from dash_deep.app import app, task_manager, inference_pool
 from dash_deep.sql import (get_column_names_and_values_from_sql_model_instance,
                            get_column_names_from_sql_model_class,
                            generate_script_wtform_class_instance)
 
-from dash_deep.app import db
+from dash_deep.app import db, plot_points_per_trace, experiments_table_page_size
 import dash_table_experiments as dt
-from dash_deep.plot import create_mutual_plot
-from dash_deep.sql import generate_table_contents_from_sql_model_class
+from dash_deep.plot import (create_mutual_plot,
+                            get_axis_ranges_from_relayout_data,
+                            get_graph_layout_template,
+                            convert_column_name_to_legend_name)
+from dash_deep.live import live_trace_cache
+from dash_deep.smoothing import smoothing_methods, get_smoothed_trace_name, get_smoothing_legend_suffix
+from dash_deep.table_cache import experiment_table_cache
+from dash.exceptions import PreventUpdate
+from dash_deep.sql import (generate_table_contents_from_sql_model_class,
+                           get_table_signature,
+                           get_table_columns,
+                           parse_table_filter)
 
 # Temporary solution for the problem of circular imports
 import dash_deep.utils
@@ -73,6 +83,209 @@ def generate_script_navigation_page(title_and_url_endpoint_pairs_list, title):
     
 
     
+def generate_experiments_table_controls(script_sql_class, id_prefix, button_id, data_table_id):
+    """Generates filter, sorting and pagination controls of a data table
+    of experiments and adds the callbacks that fill out the table.
+    
+    Filtering, sorting and pagination are performed by the database and only
+    one page of records is sent to the data table. The first callback stores
+    the query typed by user together with the signature of the matching
+    records (see dash_deep.sql.get_table_signature()) in a hidden div and leaves
+    it untouched if nothing changed, so the callbacks that load the rows are not
+    triggered when the table is refreshed and the experiments are the same.
+    
+    Row indices of the data table point to different experiments once the
+    rows change, so the ids of the selected experiments are kept in another
+    hidden div (id_prefix + '-table-selection', a json list of ids) and the
+    selected rows are restored from them whenever new rows are loaded. The
+    pages should use the ids from this div instead of the selected indices.
+    
+    Parameters
+    ----------
+    script_sql_class : sqlalchemy class
+        Sql alchemy class to extract the records from.
+    
+    id_prefix : string
+        Prefix of the ids of the created elements.
+    
+    button_id : string
+        Id of the refresh button.
+    
+    data_table_id : string
+        Id of the data table.
+    
+    Returns
+    -------
+    layout : dash.html.Div
+        dash.html.Div object containing the controls.
+    """
+    
+    filter_id_name = id_prefix + '-table-filter'
+    sort_column_id_name = id_prefix + '-table-sort-column'
+    sort_order_id_name = id_prefix + '-table-sort-order'
+    page_id_name = id_prefix + '-table-page'
+    table_info_id_name = id_prefix + '-table-info'
+    table_state_id_name = id_prefix + '-table-state'
+    table_selection_id_name = id_prefix + '-table-selection'
+    
+    column_names = [column.name for column in get_table_columns(script_sql_class)]
+    
+    layout = html.Div([
+            dcc.Input(id=filter_id_name,
+                      placeholder='Filter, for example: batch_size>=10, validation_accuracy>0.9',
+                      style={'width': '100%'}),
+            dcc.Dropdown(id=sort_column_id_name,
+                         options=[{'label': 'Sort by {}'.format(column_name), 'value': column_name}
+                                  for column_name in column_names],
+                         value='id',
+                         clearable=False),
+            dcc.RadioItems(id=sort_order_id_name,
+                           value='descending',
+                           options=[
+                                {'label': 'Descending', 'value': 'descending'},
+                                {'label': 'Ascending', 'value': 'ascending'}
+                            ]),
+            html.Div(['Page ', dcc.Input(id=page_id_name, type='number', value=1, min=1)]),
+            html.Div(id=table_info_id_name),
+            html.Div(id=table_state_id_name, style={'display': 'none'}),
+            html.Div(id=table_selection_id_name, children='[]', style={'display': 'none'})
+    ])
+    
+    def parse_table_state(table_state):
+        
+        table_state = json.loads(table_state)
+        
+        # Filter was already validated when the state was created
+        conditions = parse_table_filter(script_sql_class, table_state['filter'])
+        
+        return table_state, conditions
+    
+    
+    @app.callback(
+    Output(table_state_id_name, 'children'),
+    [Input(button_id, 'n_clicks'),
+     Input(filter_id_name, 'value'),
+     Input(sort_column_id_name, 'value'),
+     Input(sort_order_id_name, 'value'),
+     Input(page_id_name, 'value')],
+    [State(table_state_id_name, 'children')])
+    def callback(n_clicks, filter_string, sort_column_name, sort_order, page, previous_table_state):
+        
+        try:
+            
+            conditions = parse_table_filter(script_sql_class, filter_string)
+            error = None
+        
+        except ValueError as parse_error:
+            
+            # Leaving the records as they are while user is typing
+            conditions = []
+            filter_string = ''
+            error = str(parse_error)
+        
+        try:
+            page = max(int(page), 1)
+        
+        except (TypeError, ValueError):
+            
+            page = 1
+        
+        table_state = json.dumps({'filter': filter_string,
+                                  'error': error,
+                                  'sort_column_name': sort_column_name or 'id',
+                                  'descending': sort_order != 'ascending',
+                                  'page': page,
+                                  'signature': get_table_signature(script_sql_class, conditions)},
+                                 sort_keys=True)
+        
+        if table_state == previous_table_state:
+            
+            raise PreventUpdate()
+        
+        return table_state
+    
+    
+    @app.callback(
+    Output(data_table_id, 'rows'),
+    [Input(table_state_id_name, 'children')])
+    def callback(table_state):
+        
+        table_state, conditions = parse_table_state(table_state)
+        
+        # Pages are shared by all the open tabs, see dash_deep/table_cache.py
+        rows = experiment_table_cache.get_rows(script_sql_class,
+                                               table_state['signature'],
+                                               table_state['filter'],
+                                               conditions,
+                                               table_state['sort_column_name'],
+                                               table_state['descending'],
+                                               table_state['page'] - 1,
+                                               experiments_table_page_size)
+        
+        return rows
+    
+    
+    @app.callback(
+    Output(table_info_id_name, 'children'),
+    [Input(table_state_id_name, 'children')])
+    def callback(table_state):
+        
+        table_state, conditions = parse_table_state(table_state)
+        
+        number_of_experiments = (table_state['signature'] or [0])[0]
+        number_of_pages = max((number_of_experiments + experiments_table_page_size - 1) // experiments_table_page_size, 1)
+        
+        table_info = 'Page {} of {}, {} experiments'.format(table_state['page'],
+                                                            number_of_pages,
+                                                            number_of_experiments)
+        
+        if table_state['error']:
+            
+            table_info = 'Filter error: {}. {}'.format(table_state['error'], table_info)
+        
+        return table_info
+    
+    
+    @app.callback(
+    Output(data_table_id, 'selected_row_indices'),
+    [Input(data_table_id, 'rows')],
+    [State(table_selection_id_name, 'children')])
+    def callback(rows, table_selection):
+        
+        selected_experiment_ids = set(json.loads(table_selection or '[]'))
+        
+        return [row_index for row_index, row in enumerate(rows or [])
+                if row.get('id') in selected_experiment_ids]
+    
+    
+    @app.callback(
+    Output(table_selection_id_name, 'children'),
+    [Input(data_table_id, 'selected_row_indices')],
+    [State(data_table_id, 'rows'),
+     State(table_selection_id_name, 'children')])
+    def callback(selected_row_indices, rows, previous_table_selection):
+        
+        rows = rows or []
+        
+        page_experiment_ids = set(row['id'] for row in rows if 'id' in row)
+        
+        # Experiments selected on the other pages stay selected
+        selected_experiment_ids = set(experiment_id for experiment_id in json.loads(previous_table_selection or '[]')
+                                      if experiment_id not in page_experiment_ids)
+        
+        selected_experiment_ids.update(rows[selected_row_index]['id']
+                                       for selected_row_index in (selected_row_indices or [])
+                                       if selected_row_index < len(rows) and 'id' in rows[selected_row_index])
+        
+        table_selection = json.dumps(sorted(selected_experiment_ids))
+        
+        if table_selection == previous_table_selection:
+            
+            raise PreventUpdate()
+        
+        return table_selection
+
+
 def generate_script_inference_widjet(script_sql_class):
     """Generates an inference widjet given the sql alchemy class representing
     experiment.
@@ -97,15 +310,19 @@ def generate_script_inference_widjet(script_sql_class):
     data_table_id = script_type_name_id + '-inference-datatable'
     upload_widjet_id = script_type_name_id + '-inference-upload'
     output_div_id = script_type_name_id + '-inference-output-results'
+    table_selection_id_name = script_type_name_id + '-inference-table-selection'
 
     layout = html.Div([
 
             html.H1(script_sql_class.title),
+            generate_experiments_table_controls(script_sql_class,
+                                                script_type_name_id + '-inference',
+                                                button_id,
+                                                data_table_id),
             dt.DataTable(
                          rows=[{}],
                          id=data_table_id,
                          row_selectable=True,
-                         filterable=True,
                          ),
             html.Button('Refresh Table', id=button_id),
             dcc.Upload(
@@ -130,23 +347,11 @@ def generate_script_inference_widjet(script_sql_class):
     ])
 
 
-    @app.callback(
-    Output(data_table_id, 'rows'),
-    [Input(button_id, 'n_clicks')])
-    def callback(n_clicks):
-
-        rows = generate_table_contents_from_sql_model_class(script_sql_class)
-
-        return rows
-
-
     @app.callback(Output(output_div_id, 'children'),
                   [Input(upload_widjet_id, 'contents'),
-                   Input(data_table_id, 'rows'),
-                   Input(data_table_id, 'selected_row_indices')])
+                   Input(table_selection_id_name, 'children')])
     def update_output(list_of_contents,
-                      rows,
-                      selected_row_indices):
+                      table_selection):
 
         output = []
 
@@ -154,7 +359,10 @@ def generate_script_inference_widjet(script_sql_class):
 
             return output
 
-        if not selected_row_indices:
+        # Ids of the selected experiments, see generate_experiments_table_controls()
+        selected_experiment_ids = tuple(json.loads(table_selection or '[]'))
+
+        if not selected_experiment_ids:
 
             return output
 
@@ -166,16 +374,16 @@ def generate_script_inference_widjet(script_sql_class):
         # When we tried last time it cause the function to be called multiple times instead of
         # just one
 
-        selected_experiments = map(lambda selected_row_index: rows[selected_row_index], selected_row_indices)
-
-        selected_experiment_ids = tuple(map(lambda experiment: experiment['id'], selected_experiments))
-
-        extracted_rows = script_sql_class.query.filter(script_sql_class.id.in_(selected_experiment_ids)).all()
+        # Inference doesn't need the graphs, so they are not loaded
+        extracted_rows = script_sql_class.query.options(db.defer('graphs')).filter(script_sql_class.id.in_(selected_experiment_ids)).all()
 
         # expunge all the models instances (done)
         map(db.session.expunge, extracted_rows)
         
         
+        # Each image is decoded once and is sent to all the selected models
+        uploaded_images = []
+        
         for contents in list_of_contents:
 
             if contents is not None:
@@ -184,23 +392,48 @@ def generate_script_inference_widjet(script_sql_class):
 
                 if 'image' in content_type:
                     
-                    output.append(html.Img(src=contents))
-
-                    for row in extracted_rows:
-
-                        img_np = dash_deep.utils.convert_base64_image_string_to_numpy(content_string)
-
-                        future_obj = task_manager.process_pool.schedule( script_sql_class.actions['inference'],
-                                                                         args=(row, img_np) )
-
-                        result_np = future_obj.result()
-
-                        results_base64 = dash_deep.utils.convert_numpy_to_base64_image_string(result_np)
-
+                    uploaded_images.append((contents, dash_deep.utils.convert_base64_image_string_to_numpy(content_string)))
+        
+        input_images_np = [img_np for _, img_np in uploaded_images]
+        
+        # Scheduling the batches of all the models before waiting for any of
+        # them, so that the models run concurrently on the inference workers
+        scheduled_batches = [(row, inference_pool.schedule(script_sql_class, row, input_images_np))
+                             for row in extracted_rows]
+        
+        # Maps experiment id into the results of the images and whether the model was already loaded
+        model_results = {}
+        
+        for row, futures in scheduled_batches:
+            
+            model_results[row.id] = inference_pool.get_results(futures)
+        
+        for image_index, (contents, _) in enumerate(uploaded_images):
+            
+            output.append(html.Img(src=contents))
+            
+            for row in extracted_rows:
+                
+                results_np, is_hit = model_results[row.id]
+                
+                results_base64 = dash_deep.utils.convert_numpy_to_base64_image_string(results_np[image_index])
 
-                        output.append( html.H1( "Result of model id#{}".format(row.id) ) )
-                        output.append( html.Img(src=results_base64) )
 
+                output.append( html.H1( "Result of model id#{}".format(row.id) ) )
+                output.append( html.Img(src=results_base64) )
+                
+                if is_hit is not None:
+                    
+                    output.append( html.P( "Model was {}".format('already loaded' if is_hit else 'loaded') ) )
+        
+        model_cache_stats = inference_pool.get_stats()
+        
+        output.append( html.P( "Loaded models cache: {} hits, {} misses, {} evictions, "
+                               "{} models ({:.1f} MB)".format(model_cache_stats['hits'],
+                                                             model_cache_stats['misses'],
+                                                             model_cache_stats['evictions'],
+                                                             model_cache_stats['number_of_models'],
+                                                             model_cache_stats['memory_size'] / 1e6) ) )
 
         return output
     
@@ -369,72 +602,224 @@ def generate_script_plots_widjet(script_sql_class):
     graph_id_name = script_type_name_id + '-graph'
     data_table_id = script_type_name_id + '-datatable'
     radio_button_id = script_type_name_id + '-radio-button'
+    plot_state_id_name = script_type_name_id + '-plot-state'
+    group_checklist_id = script_type_name_id + '-group-checklist'
+    smoothing_radio_button_id = script_type_name_id + '-smoothing-radio-button'
+    stream_config_id_name = script_type_name_id + '-stream-config'
+    table_selection_id_name = script_type_name_id + '-table-selection'
     
     #initial_table_contents = generate_table_contents_from_sql_model_class(script_sql_class)
     
     layout = html.Div([
 
             html.H1(script_sql_class.title),
-            dcc.Interval(id=interval_object_name_id, interval=1000),
+            dcc.Interval(id=interval_object_name_id, interval=60*60*1000),
             dcc.Graph(
                       id=graph_id_name,
                       figure={'data':[], 'layout': []}
                      ),
             dcc.RadioItems(id=radio_button_id,
-                           value=1000,
+                           value='push',
                            options=[
-                                {'label': 'Graph live update on', 'value': 1000},
-                                {'label': 'Graph live update off', 'value': 60*60*1000} # One hour -- max possible interval. Now way to just turn off the interval, so we apply this hack
+                                {'label': 'Graph live update on', 'value': 'push'},
+                                {'label': 'Graph live update on (polling)', 'value': 'poll'},
+                                {'label': 'Graph live update off', 'value': 'off'}
+                            ]),
+            dcc.Checklist(id=group_checklist_id,
+                          values=[],
+                          options=[
+                                {'label': 'Group experiments with the same hyperparameters (mean, std, min and max)',
+                                 'value': 'group'}
                             ]),
+            dcc.RadioItems(id=smoothing_radio_button_id,
+                           value='',
+                           options=[{'label': 'No smoothing', 'value': ''}] +
+                                   [{'label': 'Smoothing ' + get_smoothing_legend_suffix(smoothing_method),
+                                     'value': smoothing_method}
+                                    for smoothing_method in smoothing_methods]),
+            generate_experiments_table_controls(script_sql_class,
+                                                script_type_name_id,
+                                                button_id,
+                                                data_table_id),
             dt.DataTable(
                          rows=[{}],#initial_table_contents,
                          id=data_table_id,
                          row_selectable=True,
-                         filterable=True,
                          ),
-            html.Button('Refresh Table', id=button_id)
+            html.Button('Refresh Table', id=button_id),
+            html.Div(id=plot_state_id_name, style={'display': 'none'}),
+            html.Div(id=stream_config_id_name, className='dash-deep-stream-config', style={'display': 'none'})
     ])
         
+    # The graph is updated in two steps. On every interval tick the first
+    # callback fetches only the points reported since the previous tick into
+    # the live trace cache and summarizes what is plotted in a hidden div:
+    # selected experiments, zoomed ranges, versions of the experiments and
+    # the last step of each trace. If neither the selection nor the versions
+    # changed, the traces are not even checked. If the summary didn't change,
+    # nothing is sent to the browser and the graph is not redrawn. Otherwise
+    # the second callback builds the figure from the cached traces without
+    # reading the metric points.
+    # Zooming the graph also triggers the update -- the zoomed window
+    # is reloaded at full resolution while the whole run is downsampled.
+    # Grouping replaces the experiments that share the hyperparameters
+    # with the bands of their statistics (see plot.create_group_traces()).
     @app.callback(
-    Output(data_table_id, 'rows'),
-    [Input(button_id, 'n_clicks')])
-    def callback(n_clicks):
-    
-        rows = generate_table_contents_from_sql_model_class(script_sql_class)
+    Output(plot_state_id_name, 'children'),
+    [Input(table_selection_id_name, 'children'),
+     Input(interval_object_name_id, 'n_intervals'),
+     Input(graph_id_name, 'relayoutData'),
+     Input(group_checklist_id, 'values'),
+     Input(smoothing_radio_button_id, 'value')],
+    [State(plot_state_id_name, 'children')])
+    def callback(table_selection, n_intervals, relayout_data, group_values, smoothing, previous_plot_state):
         
-        return rows
+        grouped = 'group' in (group_values or [])
+        smoothing = smoothing or None
+        
+        # Selection is kept by the ids of the experiments, since the indices
+        # of the rows change with the pages (see generate_experiments_table_controls())
+        selected_experiment_ids = sorted(json.loads(table_selection or '[]'))
+        
+        # Only the ids and versions are loaded, not the rows
+        experiment_versions = []
+        
+        if selected_experiment_ids:
+            
+            query = db.session.query(script_sql_class.id, script_sql_class.version)
+            query = query.filter(script_sql_class.id.in_(selected_experiment_ids))
+            
+            experiment_versions = [list(experiment_version) for experiment_version in query.order_by(script_sql_class.id)]
+        
+        if previous_plot_state:
+            
+            previous_plot_state_dict = json.loads(previous_plot_state)
+            
+            if (previous_plot_state_dict['experiment_ids'] == selected_experiment_ids and
+                previous_plot_state_dict['relayout_data'] == relayout_data and
+                previous_plot_state_dict['versions'] == experiment_versions and
+                previous_plot_state_dict.get('grouped') == grouped and
+                previous_plot_state_dict.get('smoothing') == smoothing):
+                
+                raise PreventUpdate()
+        
+        axis_ranges = get_axis_ranges_from_relayout_data(relayout_data)
+        
+        extracted_rows = []
+        
+        if selected_experiment_ids:
+        
+            extracted_rows = script_sql_class.query.filter(script_sql_class.id.in_(selected_experiment_ids)).all()
+        
+        last_steps = [[sql_model_instance.id, live_trace_cache.update(sql_model_instance, axis_ranges)]
+                      for sql_model_instance in extracted_rows]
+        
+        plot_state = json.dumps({'experiment_ids': selected_experiment_ids,
+                                 'relayout_data': relayout_data,
+                                 'versions': experiment_versions,
+                                 'last_steps': last_steps,
+                                 'grouped': grouped,
+                                 'smoothing': smoothing},
+                                sort_keys=True)
+        
+        if plot_state == previous_plot_state:
+            
+            raise PreventUpdate()
+        
+        return plot_state
+    
     
     @app.callback(
     Output(graph_id_name, 'figure'),
-    [Input(data_table_id, 'rows'),
-     Input(data_table_id, 'selected_row_indices'),
-     Input(interval_object_name_id, 'n_intervals')])
-    def callback(rows, selected_row_indices, n_intervals):
-        
-        print(rows)
-        print(selected_row_indices)
+    [Input(plot_state_id_name, 'children')])
+    def callback(plot_state):
         
-        if not selected_row_indices:
+        if not plot_state:
             
-            return {'data':[], 'layout':[]}
+            raise PreventUpdate()
+        
+        plot_state = json.loads(plot_state)
         
-        selected_experiments = map(lambda selected_row_index: rows[selected_row_index], selected_row_indices)
+        selected_experiment_ids = plot_state['experiment_ids']
         
-        selected_experiment_ids = tuple(map(lambda experiment: experiment['id'], selected_experiments))
+        if not selected_experiment_ids:
+            
+            return {'data':[], 'layout':[]}
         
         extracted_rows = script_sql_class.query.filter(script_sql_class.id.in_(selected_experiment_ids)).all()
         
-        mutual_plot = create_mutual_plot(extracted_rows)
+        # Versions that were read before the live trace cache was updated
+        experiment_versions = dict(plot_state['versions'])
+        
+        mutual_plot = create_mutual_plot(extracted_rows,
+                                         plot_state['relayout_data'],
+                                         live_trace_cache,
+                                         experiment_versions,
+                                         group_by_hyperparameters=plot_state.get('grouped', False),
+                                         smoothing=plot_state.get('smoothing'))
         
         return mutual_plot
     
     
+    # In the push mode new points are appended to the graph in the browser
+    # by dash_deep/static/live_stream.js, which subscribes to the metric
+    # stream according to this config. Polling with the interval
+    # is left as a fallback. Pushed points can't be appended to the
+    # statistics of a group, so grouped graphs are always polled.
+    @app.callback(
+    Output(stream_config_id_name, 'children'),
+    [Input(plot_state_id_name, 'children'),
+     Input(radio_button_id, 'value')])
+    def update_stream_config(plot_state, value):
+        
+        if value != 'push' or not plot_state:
+            
+            return ''
+        
+        plot_state = json.loads(plot_state)
+        
+        if plot_state.get('grouped'):
+            
+            return ''
+        
+        # Pushed points are matched with the plotted traces by their legends
+        legend_names = dict((trace_name, convert_column_name_to_legend_name(trace_name))
+                            for trace_name in get_graph_layout_template(script_sql_class)['trace_axes'])
+        
+        smoothing = plot_state.get('smoothing')
+        
+        if smoothing:
+            
+            for trace_name, legend_name in list(legend_names.items()):
+                
+                legend_names[get_smoothed_trace_name(trace_name, smoothing)] = '{} {}'.format(legend_name,
+                                                                                          get_smoothing_legend_suffix(smoothing))
+        
+        stream_config = {'channel': 'metrics',
+                         'graph_id': graph_id_name,
+                         'experiment_table': script_sql_class.__tablename__,
+                         'experiments': plot_state['last_steps'],
+                         'legend_names': legend_names,
+                         'points_per_trace': plot_points_per_trace}
+        
+        return json.dumps(stream_config)
+    
+    
     @app.callback(
     Output(interval_object_name_id, 'interval'),
-    [Input(radio_button_id, 'value')])
-    def update_interval(value):
+    [Input(radio_button_id, 'value'),
+     Input(group_checklist_id, 'values')])
+    def update_interval(value, group_values):
+        
+        polled = value == 'poll' or (value == 'push' and 'group' in (group_values or []))
+        
+        # One hour -- max possible interval. Now way to just
+        # turn off the interval, so we apply this hack
+        if not polled:
+            
+            return 60*60*1000
         
-        return value
+        return 1000
     
     
     return layout
@@ -0,0 +1,31 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+
+# The tests create and delete experiments, so they never run in the database
+# of the user. The variable has to be set before dash_deep.app is imported.
+temporary_folder_path = tempfile.mkdtemp(prefix='dash-deep-tests-')
+
+os.environ['DASH_DEEP_DATABASE'] = os.path.join(temporary_folder_path, 'experiments.db')
+
+
+def pytest_unconfigure(config):
+
+    shutil.rmtree(temporary_folder_path, ignore_errors=True)
+
+
+@pytest.fixture
+def database():
+    """Creates the tables of the temporary database and empties them afterwards."""
+
+    from dash_deep.app import db
+
+    db.create_all()
+
+    yield db
+
+    db.session.remove()
+    db.drop_all()
@@ -0,0 +1,297 @@
+from dash_deep.serving import MicroBatcher, MicroBatchTimeoutError
+from dash_deep.testing import (create_fake_experiments,
+                               delete_fake_experiments,
+                               run_tiny_model,
+                               send_test_request)
+
+import threading
+from concurrent.futures import TimeoutError
+
+import numpy as np
+import pytest
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class BlockingBatchRunner(object):
+    """run_batch() of a MicroBatcher that holds the first batch until release() is called.
+
+    The requests submitted meanwhile wait in the queue of the batcher,
+    so the following batches are known in advance.
+    """
+
+    def __init__(self, run_batch):
+
+        self.run_batch = run_batch
+
+        self.batches = []
+
+        self.started_event = threading.Event()
+        self.released_event = threading.Event()
+
+    def __call__(self, inputs):
+
+        self.batches.append(list(inputs))
+
+        self.started_event.set()
+        self.released_event.wait(10)
+
+        return self.run_batch(inputs)
+
+    def release(self):
+
+        self.released_event.set()
+
+
+def double_inputs(inputs):
+
+    if any(input_data < 0 for input_data in inputs):
+
+        raise ValueError('Negative input')
+
+    return [input_data * 2 for input_data in inputs]
+
+
+def submit_after_blocked_batch(batcher, batch_runner, inputs):
+    """Submits the first input, waits until its batch runs and submits the rest."""
+
+    requests = [batcher.submit(inputs[0])]
+
+    assert batch_runner.started_event.wait(10)
+
+    requests.extend(batcher.submit(input_data) for input_data in inputs[1:])
+
+    batch_runner.release()
+
+    return requests
+
+
+def test_waiting_requests_are_batched():
+
+    batch_runner = BlockingBatchRunner(double_inputs)
+
+    batcher = MicroBatcher(batch_runner, max_batch_size=4, max_wait_ms=0, max_queue_size=10)
+
+    requests = submit_after_blocked_batch(batcher, batch_runner, list(range(6)))
+
+    try:
+
+        assert [request.wait(10) for request in requests] == [0, 2, 4, 6, 8, 10]
+        assert [request.batch_size for request in requests] == [1, 4, 4, 4, 4, 1]
+        assert batch_runner.batches == [[0], [1, 2, 3, 4], [5]]
+
+        stats = batcher.get_stats()
+
+        assert stats['number_of_batches'] == 3
+        assert stats['number_of_requests'] == 6
+        assert stats['mean_batch_size'] == pytest.approx(2.0)
+
+    finally:
+
+        batcher.stop()
+
+
+def test_every_request_receives_its_own_result():
+
+    batcher = MicroBatcher(run_tiny_model, max_batch_size=8, max_wait_ms=20, max_queue_size=64)
+
+    random_state = np.random.RandomState(1)
+
+    images = [random_state.randint(0, 256, size=(16, 16, 3)).astype(np.uint8) for _ in range(32)]
+
+    results = [None] * len(images)
+
+    def send_request(index):
+
+        results[index] = batcher.submit(images[index]).wait(10)
+
+    clients = [threading.Thread(target=send_request, args=(index,)) for index in range(len(images))]
+
+    try:
+
+        for client in clients:
+
+            client.start()
+
+        for client in clients:
+
+            client.join()
+
+        for image, result in zip(images, results):
+
+            assert np.array_equal(result, run_tiny_model([image])[0])
+
+    finally:
+
+        batcher.stop()
+
+
+def test_bad_input_fails_only_its_own_request():
+
+    batch_runner = BlockingBatchRunner(double_inputs)
+
+    batcher = MicroBatcher(batch_runner, max_batch_size=4, max_wait_ms=0, max_queue_size=10)
+
+    requests = submit_after_blocked_batch(batcher, batch_runner, [0, 1, -1, 2])
+
+    try:
+
+        assert requests[1].wait(10) == 2
+        assert requests[3].wait(10) == 4
+
+        with pytest.raises(ValueError):
+
+            requests[2].wait(10)
+
+        # The failed batch was retried one request at a time
+        assert batch_runner.batches == [[0], [1, -1, 2], [1], [-1], [2]]
+        assert requests[1].batch_size == 1
+
+    finally:
+
+        batcher.stop()
+
+
+def test_timed_out_batch_is_not_retried():
+
+    def time_out(inputs):
+
+        raise TimeoutError()
+
+    batch_runner = BlockingBatchRunner(time_out)
+
+    batcher = MicroBatcher(batch_runner, max_batch_size=4, max_wait_ms=0, max_queue_size=10)
+
+    requests = submit_after_blocked_batch(batcher, batch_runner, [0, 1, 2])
+
+    try:
+
+        for request in requests:
+
+            with pytest.raises(TimeoutError):
+
+                request.wait(10)
+
+        assert batch_runner.batches == [[0], [1, 2]]
+
+    finally:
+
+        batcher.stop()
+
+
+def test_wrong_number_of_results_fails_the_request():
+
+    batcher = MicroBatcher(lambda inputs: [], max_batch_size=4, max_wait_ms=0, max_queue_size=10)
+
+    try:
+
+        with pytest.raises(RuntimeError):
+
+            batcher.submit(0).wait(10)
+
+    finally:
+
+        batcher.stop()
+
+
+def test_full_queue_and_timeout():
+
+    batch_runner = BlockingBatchRunner(double_inputs)
+
+    batcher = MicroBatcher(batch_runner, max_batch_size=4, max_wait_ms=0, max_queue_size=1)
+
+    first_request = batcher.submit(0)
+
+    try:
+
+        assert batch_runner.started_event.wait(10)
+
+        waiting_request = batcher.submit(1)
+
+        with pytest.raises(queue.Full):
+
+            batcher.submit(2)
+
+        with pytest.raises(MicroBatchTimeoutError):
+
+            first_request.wait(0.01)
+
+        batch_runner.release()
+
+        assert waiting_request.wait(10) == 2
+
+    finally:
+
+        batch_runner.release()
+        batcher.stop()
+
+
+def test_stopped_batcher_finishes_the_submitted_requests():
+
+    batcher = MicroBatcher(double_inputs, max_batch_size=4, max_wait_ms=0, max_queue_size=10)
+
+    request = batcher.submit(1)
+
+    batcher.stop()
+
+    assert request.wait(10) == 2
+
+    batcher.thread.join(10)
+
+    assert not batcher.thread.is_alive()
+
+
+def test_batcher_is_idle_after_the_timeout():
+
+    batcher = MicroBatcher(double_inputs, max_batch_size=4, max_wait_ms=0, max_queue_size=10)
+
+    try:
+
+        batcher.submit(1).wait(10)
+
+        assert not batcher.is_idle(60)
+
+        batcher.last_submitted_at -= 120
+
+        assert batcher.is_idle(60)
+
+    finally:
+
+        batcher.stop()
+
+
+def test_request_timeout_covers_the_retries():
+
+    batcher = MicroBatcher(double_inputs, max_batch_size=4, max_wait_ms=500, max_queue_size=10)
+
+    try:
+
+        # Running batch, own batch and its four retries
+        assert batcher.get_request_timeout(10) == pytest.approx(0.5 + 10 * 6)
+
+    finally:
+
+        batcher.stop()
+
+
+def test_endpoint_rejects_broken_images(database):
+
+    fake_experiment = create_fake_experiments(1)[0]
+
+    url = '/inference/{}/{}'.format(fake_experiment.__tablename__, fake_experiment.id)
+
+    try:
+
+        assert send_test_request(url, {'image': 'not an image'}).status_code == 400
+        assert send_test_request(url, {}).status_code == 400
+
+        missing_experiment_url = '/inference/{}/{}'.format(fake_experiment.__tablename__, fake_experiment.id + 1)
+
+        assert send_test_request(missing_experiment_url, {'image': 'not an image'}).status_code == 404
+
+    finally:
+
+        delete_fake_experiments([fake_experiment])
@@ -0,0 +1,141 @@
+import dash_deep.stream
+from dash_deep.stream import (MetricStream,
+                              MetricStreamSubscriber,
+                              get_last_metric_point_id,
+                              load_missed_metric_points)
+from dash_deep.metrics import insert_metric_points
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+def insert_trace(db, experiment, trace_name, steps):
+    """Inserts the points of a trace, each value equals its step."""
+
+    experiment_table, experiment_id = experiment
+
+    with db.engine.begin() as connection:
+
+        insert_metric_points(connection, [{'experiment_table': experiment_table,
+                                           'experiment_id': experiment_id,
+                                           'trace_name': trace_name,
+                                           'step': step,
+                                           'wall_time': 0.0,
+                                           'value': float(step)} for step in steps])
+
+
+def get_events(subscriber):
+
+    events = []
+
+    try:
+
+        while True:
+
+            events.append(subscriber.queue.get_nowait())
+
+    except queue.Empty:
+
+        return events
+
+
+def subscribe_without_thread(metric_stream, experiments):
+    """Subscribes to the metrics of experiments, the test polls the stream itself."""
+
+    subscriber = MetricStreamSubscriber({'metrics'}, set(experiments), queue_size=100)
+
+    metric_stream.subscribers.add(subscriber)
+    metric_stream.last_metric_point_id = get_last_metric_point_id()
+
+    return subscriber
+
+
+def test_missed_points_are_loaded_after_the_last_steps(database):
+
+    experiment = ('fake_experiments', 1)
+
+    insert_trace(database, experiment, 'loss', range(10))
+    insert_trace(database, experiment, 'accuracy', range(5))
+    insert_trace(database, experiment, 'loss:ema0.9', range(10))
+    insert_trace(database, ('fake_experiments', 2), 'loss', range(10))
+
+    traces = load_missed_metric_points(experiment[0], experiment[1], {'loss': 6, 'accuracy': 4})
+
+    # Traces that the page doesn't have yet are sent whole
+    assert traces == {'loss': {'steps': [7, 8, 9], 'values': [7.0, 8.0, 9.0]},
+                      'loss:ema0.9': {'steps': list(range(10)), 'values': [float(step) for step in range(10)]}}
+
+    assert sorted(load_missed_metric_points(experiment[0], experiment[1], {}).keys()) == ['accuracy', 'loss', 'loss:ema0.9']
+
+
+def test_stream_pushes_only_the_points_after_the_last_id(database):
+
+    experiment = ('fake_experiments', 1)
+    other_experiment = ('fake_experiments', 2)
+
+    insert_trace(database, experiment, 'loss', range(5))
+
+    metric_stream = MetricStream()
+
+    subscriber = subscribe_without_thread(metric_stream, [experiment])
+
+    insert_trace(database, experiment, 'loss', range(5, 8))
+    insert_trace(database, other_experiment, 'loss', range(3))
+
+    assert metric_stream.poll_metric_points() is False
+
+    assert get_events(subscriber) == [('metrics', {'experiment_table': experiment[0],
+                                                   'experiment_id': experiment[1],
+                                                   'traces': {'loss': {'steps': [5, 6, 7],
+                                                                       'values': [5.0, 6.0, 7.0]}}})]
+
+    assert metric_stream.last_metric_point_id == get_last_metric_point_id()
+
+    # Nothing new was reported
+    assert metric_stream.poll_metric_points() is False
+    assert get_events(subscriber) == []
+
+
+def test_large_backlog_is_pushed_in_several_polls(database, monkeypatch):
+
+    experiment = ('fake_experiments', 1)
+
+    metric_stream = MetricStream()
+
+    subscriber = subscribe_without_thread(metric_stream, [experiment])
+
+    insert_trace(database, experiment, 'loss', range(5))
+
+    monkeypatch.setattr(dash_deep.stream, 'MAX_POINTS_PER_POLL', 2)
+
+    pushed_steps = []
+
+    while True:
+
+        more_points_pending = metric_stream.poll_metric_points()
+
+        for _, data in get_events(subscriber):
+
+            pushed_steps.extend(data['traces']['loss']['steps'])
+
+        if not more_points_pending:
+
+            break
+
+    # Each point is pushed exactly once and in order
+    assert pushed_steps == list(range(5))
+
+
+def test_slow_subscriber_is_disconnected():
+
+    subscriber = MetricStreamSubscriber({'metrics'}, set(), queue_size=2)
+
+    for event_number in range(3):
+
+        subscriber.put(('metrics', event_number))
+
+    # The page reconnects and loads the missed points itself
+    assert subscriber.closed
+    assert get_events(subscriber) == [None]
@@ -0,0 +1,256 @@
+from dash_deep.task import TaskManager, ScheduledTask, FakeDeviceProbe
+
+import time
+from collections import deque
+
+import pytest
+
+
+class FakeExperiment(object):
+    """Detached experiment of the scheduled tasks, only the fields the scheduler reads."""
+
+    __tablename__ = 'fake_experiments'
+
+    def __init__(self, submitted_by=None, priority=0):
+
+        self.submitted_by = submitted_by
+        self.priority = priority
+
+
+class FakeFuture(object):
+    """Future of a task that keeps running until the end of the test."""
+
+    def done(self):
+
+        return False
+
+    def cancelled(self):
+
+        return False
+
+
+def create_task(submitted_by=None, priority=0, device_index=None):
+
+    return ScheduledTask(None, FakeExperiment(submitted_by, priority), device_index)
+
+
+def create_task_manager(devices, **kwargs):
+    """Creates a task manager that starts the tasks without running them.
+
+    The started tasks are recorded in the started_tasks list
+    of the manager as (task, device index) pairs.
+    """
+
+    task_manager = TaskManager(device_probe=FakeDeviceProbe(devices), **kwargs)
+
+    task_manager.started_tasks = []
+
+    def start_task(task, device_index):
+
+        task.assigned_device_index = device_index
+        task.started_at = time.time()
+        task.future = FakeFuture()
+
+        task_manager.started_tasks.append((task, device_index))
+
+    task_manager.start_task = start_task
+
+    return task_manager
+
+
+def queue_tasks(task_manager, tasks):
+    """Puts tasks into the queue without starting the scheduling thread."""
+
+    task_manager.tasks_list.extend(tasks)
+    task_manager.queued_tasks.extend(tasks)
+
+
+@pytest.fixture
+def two_gpus():
+    """Fake inventory of a free gpu and of a gpu without enough free memory."""
+
+    return [{'index': 0, 'memory_total': 8000, 'memory_used': 0},
+            {'index': 1, 'memory_total': 8000, 'memory_used': 7500}]
+
+
+def test_pick_device_prefers_the_most_free_memory():
+
+    task_manager = create_task_manager([])
+
+    free_job_slots = {0: 1, 1: 1, 2: 0}
+    free_memory = {0: 2000, 1: 6000, 2: 8000}
+
+    try:
+
+        assert task_manager.pick_device(create_task(), free_job_slots, free_memory) == 1
+        assert task_manager.pick_device(create_task(device_index=0), free_job_slots, free_memory) == 0
+        assert task_manager.pick_device(create_task(device_index=2), free_job_slots, free_memory) is False
+
+    finally:
+
+        task_manager.shutdown()
+
+
+def test_pick_device_falls_back_to_the_cpu():
+
+    task_manager = create_task_manager([], cpu_jobs=1)
+
+    try:
+
+        assert task_manager.get_free_job_slots() == {None: 1}
+        assert task_manager.pick_device(create_task(), {None: 1}, {}) is None
+        assert task_manager.pick_device(create_task(), {None: 0}, {}) is False
+
+    finally:
+
+        task_manager.shutdown()
+
+
+def test_tasks_wait_for_free_job_slots_and_memory(two_gpus):
+
+    task_manager = create_task_manager(two_gpus, jobs_per_device=2, min_free_memory_mb=1000)
+
+    tasks = [create_task() for _ in range(3)] + [create_task(device_index=1)]
+
+    queue_tasks(task_manager, tasks)
+
+    try:
+
+        task_manager.start_queued_tasks()
+
+        # The second gpu doesn't have enough free memory
+        assert task_manager.started_tasks == [(tasks[0], 0), (tasks[1], 0)]
+        assert task_manager.get_free_job_slots() == {0: 0, 1: 0}
+
+        task_manager.device_probe.set_memory_used(1, 0)
+
+        task_manager.start_queued_tasks()
+
+        assert task_manager.started_tasks[2:] == [(tasks[2], 1), (tasks[3], 1)]
+        assert task_manager.queued_tasks == []
+
+    finally:
+
+        task_manager.shutdown()
+
+
+def test_pinned_task_does_not_hold_back_the_queue(two_gpus):
+
+    task_manager = create_task_manager(two_gpus, jobs_per_device=2, min_free_memory_mb=1000)
+
+    tasks = [create_task(device_index=1), create_task()]
+
+    queue_tasks(task_manager, tasks)
+
+    try:
+
+        task_manager.start_queued_tasks()
+
+        assert task_manager.started_tasks == [(tasks[1], 0)]
+        assert task_manager.queued_tasks == [tasks[0]]
+
+    finally:
+
+        task_manager.shutdown()
+
+
+def test_higher_priority_starts_first():
+
+    task_manager = create_task_manager([], cpu_jobs=1)
+
+    tasks = [create_task(priority=0), create_task(priority=5), create_task(priority=1)]
+
+    queue_tasks(task_manager, tasks)
+
+    try:
+
+        assert task_manager.get_ordered_queued_tasks() == [tasks[1], tasks[2], tasks[0]]
+
+        task_manager.start_queued_tasks()
+
+        assert task_manager.started_tasks == [(tasks[1], None)]
+
+    finally:
+
+        task_manager.shutdown()
+
+
+def test_fair_share_interleaves_the_users():
+
+    task_manager = create_task_manager([], cpu_jobs=4)
+
+    tasks = [create_task('alice'), create_task('alice'), create_task('alice'), create_task('bob')]
+
+    queue_tasks(task_manager, tasks)
+
+    try:
+
+        task_manager.start_queued_tasks()
+
+        # Running tasks are charged up front, so the task of bob
+        # goes right after the first task of alice
+        assert [task for task, _ in task_manager.started_tasks] == [tasks[0], tasks[3], tasks[1], tasks[2]]
+
+    finally:
+
+        task_manager.shutdown()
+
+
+def test_fair_share_usage_decays_and_is_weighted():
+
+    task_manager = create_task_manager([],
+                                       user_weights={'alice': 2},
+                                       fair_share_half_life_s=3600)
+
+    now = time.time()
+
+    task_manager.fair_share_usage[('user', 'alice')] = (200.0, now - 3600)
+    task_manager.fair_share_usage[('user', 'bob')] = (60.0, now)
+
+    tasks = [create_task('bob'), create_task('alice')]
+
+    queue_tasks(task_manager, tasks)
+
+    try:
+
+        assert task_manager.get_fair_share_usage(('user', 'alice'), now) == pytest.approx(100.0)
+
+        # 100 / 2 of alice is less than 60 of bob
+        assert task_manager.get_fair_share_score(tasks[1], now) < task_manager.get_fair_share_score(tasks[0], now)
+        assert task_manager.get_ordered_queued_tasks() == [tasks[1], tasks[0]]
+
+    finally:
+
+        task_manager.shutdown()
+
+
+def test_queue_estimates_follow_the_order_of_the_queue():
+
+    task_manager = create_task_manager([], cpu_jobs=1)
+
+    task_manager.task_durations[FakeExperiment.__tablename__] = deque([10.0])
+
+    running_task = create_task()
+    queued_tasks = [create_task(), create_task(priority=1)]
+
+    queue_tasks(task_manager, [running_task])
+
+    try:
+
+        task_manager.start_queued_tasks()
+
+        running_task.started_at -= 4
+
+        queue_tasks(task_manager, queued_tasks)
+
+        queue_estimates = task_manager.get_queue_estimates()
+
+        assert queue_estimates[queued_tasks[1]]['position'] == 1
+        assert queue_estimates[queued_tasks[1]]['estimated_wait'] == pytest.approx(6.0, abs=0.5)
+
+        assert queue_estimates[queued_tasks[0]]['position'] == 2
+        assert queue_estimates[queued_tasks[0]]['estimated_wait'] == pytest.approx(16.0, abs=0.5)
+
+    finally:
+
+        task_manager.shutdown()